@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Rebuilds the factory .spk files of a mangOH release from the binary deltas in its
+# "mangOH-<board>-<module>-delta" leaf package and the .spk files of an earlier release, and
+# checks that each one is exactly the .spk file that was released. The package directory (where
+# the package was installed or unpacked) contains a deltas.json file describing each delta, the
+# deltas themselves, and this script. Applying the deltas needs zstd 1.4.5 or newer.
+#
+# Usage: apply_spk_delta.py [--from-dir DIR] [--output-dir DIR] [--from VERSION] DELTA_DIR
+#
+# The earlier release's .spk files are looked for in --from-dir (by default, the current
+# directory), under their released names. The rebuilt .spk files are written to --output-dir
+# (by default, the current directory). Exits with an error status if any .spk file can't be
+# rebuilt exactly.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import sys
+import os
+import json
+import hashlib
+import argparse
+import subprocess
+
+
+def file_hash(path):
+    """Get the SHA-256 hash of a file's contents, in hex."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def apply_delta(delta, delta_dir, from_dir, output_dir):
+    """
+    Rebuild one .spk file from a delta (an entry in deltas.json) and the .spk file it was made
+    from. Returns an error message, or None if the .spk file was rebuilt exactly.
+    """
+    base_file = f"{from_dir}/{delta['from']}"
+    delta_file = f"{delta_dir}/{delta['delta']}"
+    output_file = f"{output_dir}/{delta['to']}"
+    if not os.path.exists(base_file):
+        return f"{base_file} not found."
+    if file_hash(base_file) != delta["from_sha256"]:
+        return f"{base_file} isn't the {delta['from']} that was released."
+    if file_hash(delta_file) != delta["delta_sha256"]:
+        return f"{delta_file} is corrupt."
+    # The deltas are made with the window covering the whole of the earlier .spk file, so
+    # decompressing them needs as much memory.
+    result = subprocess.run(["zstd", "-d", "-q", "-f", "--long=31", f"--patch-from={base_file}",
+                             delta_file, "-o", f"{output_file}.new"])
+    if result.returncode != 0:
+        return f"zstd failed to apply {delta_file}."
+    if file_hash(f"{output_file}.new") != delta["to_sha256"]:
+        os.remove(f"{output_file}.new")
+        return f"{delta['to']} rebuilt from {delta_file} doesn't match the released file."
+    os.replace(f"{output_file}.new", output_file)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild mangOH factory .spk files from the binary deltas between releases,"
+                    " and check them against the released files.")
+    parser.add_argument("delta_dir", metavar="DELTA_DIR",
+                        help="directory containing deltas.json and the deltas")
+    parser.add_argument("--from-dir", default=".",
+                        help="directory containing the earlier release's .spk files")
+    parser.add_argument("--output-dir", default=".",
+                        help="directory in which to write the rebuilt .spk files")
+    parser.add_argument("--from", dest="from_version", metavar="VERSION",
+                        help="only apply the deltas from this earlier release")
+    args = parser.parse_args()
+
+    with open(f"{args.delta_dir}/deltas.json") as json_file:
+        deltas = json.load(json_file)
+    selected = [delta for delta in deltas["deltas"]
+                if args.from_version in [None, delta["from_version"]]]
+    if not selected:
+        sys.exit(f"There are no deltas from {args.from_version} to"
+                 f" mangOH {deltas['board']} {deltas['module']} {deltas['version']}.")
+    os.makedirs(args.output_dir, exist_ok=True)
+    failed = False
+    for delta in selected:
+        error = apply_delta(delta, args.delta_dir, args.from_dir, args.output_dir)
+        if error:
+            print(f"**** {error}")
+            failed = True
+        else:
+            print(f"Rebuilt {delta['to']} from {delta['from']}.")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
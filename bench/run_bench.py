@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the orchestration overhead of mangoh_release.py: everything it does other than
+# compiling (setting up leaf profiles, re-indexing, staging, packing, rendering manifests,
+# cleaning, checkpointing, etc.).
+#
+# The real script is run end-to-end on a synthetic release spec with N boards x M modules,
+# entirely offline. The sources are small synthetic git repositories, which the spec (and git's
+# "insteadOf" configuration, for the repositories whose URLs are built into the script) point
+# at, and "leaf", "repo" and "make" are replaced by the fast stand-ins in bench/stubs, which
+# produce dummy build outputs of roughly realistic size. Each build's report (see BuildReport in
+# mangoh_release.py) is then broken down by kind of stage, into the time spent in the commands
+# the stage ran and the time spent in the script itself.
+#
+# Each size of release is built three times: from scratch ("cold"), again with nothing changed
+# ("warm"), and from scratch but with the build cache, git mirrors and Yocto caches kept
+# ("cached"). The results can be compared against a baseline file, to catch orchestration
+# regressions before they slow down a real release build. The baseline is only comparable on a
+# machine with the same number of CPUs, with the same number of jobs.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import sys
+import os
+import json
+import shutil
+import argparse
+import subprocess
+import time
+import zipfile
+import tempfile
+
+# The directory containing this script, the stubs and the baseline.
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The release build script being benchmarked.
+RELEASE_SCRIPT = f"{os.path.dirname(BENCH_DIR)}/mangoh_release.py"
+
+DEFAULT_BASELINE = f"{BENCH_DIR}/baseline.json"
+
+# The version of the synthetic release.
+VERSION = "0.0.0-bench"
+
+# The build scenarios run for each size of release, in order, and whether each one starts
+# with an empty build directory and whether it also starts with empty caches.
+SCENARIOS = {
+    "cold": (True, True),
+    "warm": (False, False),
+    "cached": (True, False),
+}
+
+# Commands that a stage only runs if another stage running at the same time hasn't run them
+# already, so how many are run by each kind of stage depends on timing. They are counted
+# separately, and not checked against the baseline.
+RACING_COMMANDS = ["leaf remote fetch"]
+
+# Repository URLs built into mangoh_release.py, which are redirected to the synthetic ones.
+MANGOH_MAIN_REPO = "git@github.com:mangOH/mangOH.git"
+OCTAVE_REPO = "git@github.com:flowthings/brkedgepkg.git"
+
+
+def git(*args, cwd):
+    """Run a git command in cwd, returning its output."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, universal_newlines=True,
+                          stdout=subprocess.PIPE).stdout.strip()
+
+
+def make_git_repo(path, files, kind=None):
+    """
+    Create a git repository at path with one commit, containing files (a dict mapping each file's
+    path to its contents) and, if kind is given, a ".bench-kind" file telling the make stub what
+    sort of tree it is.
+    """
+    os.makedirs(path)
+    git("init", "-q", "-b", "master", cwd=path)
+    if kind:
+        files = dict(files, **{".bench-kind": kind})
+    for name, contents in files.items():
+        os.makedirs(os.path.dirname(f"{path}/{name}"), exist_ok=True)
+        with open(f"{path}/{name}", "w") as f:
+            f.write(contents)
+    git("add", "-A", cwd=path)
+    git("commit", "-q", "-m", "Initial commit", cwd=path)
+
+
+def add_commit(path, name, contents, branch):
+    """Add a commit adding a file to a branch (created if needed). Returns the commit ID."""
+    git("checkout", "-q", "-B", branch, cwd=path)
+    with open(f"{path}/{name}", "w") as f:
+        f.write(contents)
+    git("add", name, cwd=path)
+    git("commit", "-q", "-m", f"Add {name}", cwd=path)
+    commit = git("rev-parse", "HEAD", cwd=path)
+    git("checkout", "-q", "master", cwd=path)
+    return commit
+
+
+def source_files(count, prefix):
+    """Get a dict of count small source files, spread over subdirectories."""
+    return {f"{prefix}/dir{i % 20}/file{i}.c": f"/* {prefix} {i} */\n" + "int x;\n" * 100
+            for i in range(count)}
+
+
+def module_name(index):
+    return f"wp7{index}xx"
+
+
+def create_sources(sources_dir, modules, patches, legato_files):
+    """
+    Create the synthetic source repositories, the repo manifests listing them and the file
+    downloaded by the "wget" list, for up to the given number of modules. Returns the list of
+    the IDs of the commits that the Legato patches cherry-pick.
+    """
+    make_git_repo(f"{sources_dir}/legato",
+                  dict(source_files(legato_files, "framework"), version="19.11.3-bench\n"),
+                  "legato")
+    patch_commits = [add_commit(f"{sources_dir}/legato", f"fix{i}.txt", f"Fix {i}\n", "fixes")
+                     for i in range(patches)]
+    make_git_repo(f"{sources_dir}/meta-swi", source_files(100, "recipes"), "yocto none")
+    for i in range(modules):
+        add_commit(f"{sources_dir}/meta-swi", ".bench-kind", f"yocto {module_name(i)}\n",
+                   module_name(i))
+    make_git_repo(f"{sources_dir}/meta-mangoh", source_files(20, "recipes-mangoh"))
+    make_git_repo(f"{sources_dir}/brkedgepkg", source_files(300, "apps"), "octave")
+    make_git_repo(f"{sources_dir}/mangOH", source_files(500, "components"), "mangoh")
+
+    def manifest(project, revision, copy_kind=False):
+        copy = '<copyfile src=".bench-kind" dest=".bench-kind"/>' if copy_kind else ""
+        return (f'<manifest>\n  <remote name="bench" fetch="{sources_dir}"/>\n'
+                f'  <default remote="bench" revision="master"/>\n'
+                f'  <project name="{project}" path="{project}" revision="{revision}">{copy}'
+                f'</project>\n</manifest>\n')
+
+    make_git_repo(f"{sources_dir}/manifest", dict(
+        {"legato.xml": manifest("legato", "master")},
+        **{f"yocto/{module_name(i)}.xml": manifest("meta-swi", module_name(i), copy_kind=True)
+           for i in range(modules)}))
+    with zipfile.ZipFile(f"{sources_dir}/bsec.zip", "w") as archive:
+        for i in range(10):
+            archive.writestr(f"BSEC/lib{i}.a", os.urandom(64 * 1024))
+    return patch_commits
+
+
+def write_git_config(path, sources_dir):
+    """Write the git configuration used by the builds (see GIT_CONFIG_GLOBAL)."""
+    with open(path, "w") as f:
+        f.write("[user]\n\tname = Benchmark\n\temail = bench@example.com\n"
+                "[advice]\n\tdetachedHead = false\n"
+                "[protocol \"file\"]\n\tallow = always\n"
+                f"[url \"{sources_dir}/mangOH\"]\n\tinsteadOf = {MANGOH_MAIN_REPO}\n"
+                f"[url \"{sources_dir}/brkedgepkg\"]\n\tinsteadOf = {OCTAVE_REPO}\n")
+
+
+def release_spec(sources_dir, boards, modules, patch_commits):
+    """
+    Get the synthetic release spec for boards x modules. Every other board builds its own Yocto
+    toolchain and linux image for each module, and the others use pre-built ones.
+    """
+    spec = {
+        "mangoh": {
+            "version": VERSION,
+            "ref": "master",
+            "wget": [{"url": f"file://{sources_dir}/bsec.zip", "dir": "components/boschBsec",
+                      "unpack": "unzip"}],
+            "requires": ["swi-license_1.2", "swi-verify-license_latest"],
+            "depends": ["swi-legato_latest", "swi-vscode-support_latest"],
+        },
+        "legato": {
+            "manifest_repo": f"{sources_dir}/manifest",
+            "base_manifest": "legato.xml",
+            "patches": [{"purpose": f"Fix {i}", "dir": "", "cherry_pick": commit}
+                        for i, commit in enumerate(patch_commits)],
+        },
+        "octave": {"ref": "master", "version": "3.1.0-bench"},
+        "boards": {},
+    }
+    for board in range(boards):
+        board_spec = spec["boards"][f"board{board + 1}"] = {}
+        for i in range(modules):
+            abbreviation = module_name(i).rstrip("x0")
+            module_spec = board_spec[module_name(i)] = {
+                "depends": [f"{abbreviation}-modem-image_1"],
+                "modem_firmware": "firmware.spk",
+            }
+            if board % 2 == 0:
+                module_spec["yocto"] = {
+                    "manifest_repo": f"{sources_dir}/manifest",
+                    "base_manifest": f"yocto/{module_name(i)}.xml",
+                    "add": [{"url": f"{sources_dir}/meta-mangoh", "ref": "master",
+                             "dir": "meta-mangoh"}],
+                }
+            else:
+                module_spec["depends"] += [f"{abbreviation}-toolchain_BENCH-linux64",
+                                           f"{abbreviation}-linux-image_BENCH"]
+    return spec
+
+
+def run_build(work_dir, spec_file, env, jobs):
+    """Run the release build script in work_dir. Returns its wall time and build report."""
+    command = [sys.executable, RELEASE_SCRIPT, "--jobs", str(jobs),
+               "--cache-dir", f"{work_dir}/caches/build",
+               "--mirror-dir", f"{work_dir}/caches/mirrors",
+               "--yocto-cache-dir", f"{work_dir}/caches/yocto", "--no-ccache", spec_file]
+    start_time = time.time()
+    with open(f"{work_dir}/build.log", "a") as log:
+        result = subprocess.run(command, cwd=work_dir, env=env, stdout=log,
+                                stderr=subprocess.STDOUT)
+    wall_time = time.time() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"Build failed. See {work_dir}/build.log and {work_dir}/build/logs.")
+    with open(f"{work_dir}/build/reports/build-report-{VERSION}.json") as f:
+        return wall_time, json.load(f)
+
+
+def summarize(wall_time, report):
+    """
+    Break a build report down by kind of stage: how many stages and commands (other than
+    RACING_COMMANDS, which are counted as "racing_commands") were run, their total wall time,
+    the time spent in the commands, and the time spent in the script itself.
+    """
+    kinds = {}
+    for stage in report["stages"]:
+        kind = kinds.setdefault(stage["kind"], {"stages": 0, "commands": 0, "racing_commands": 0,
+                                                "wall_time": 0, "command_time": 0,
+                                                "script_time": 0})
+        command_time = sum(command["wall_time"] for command in stage["commands"])
+        racing = sum(1 for command in stage["commands"] if command["command"] in RACING_COMMANDS)
+        kind["stages"] += 1
+        kind["commands"] += len(stage["commands"]) - racing
+        kind["racing_commands"] += racing
+        kind["wall_time"] += stage["wall_time"]
+        kind["command_time"] += command_time
+        # Commands run in parallel within a stage can add up to more than the stage took.
+        kind["script_time"] += max(stage["wall_time"] - command_time, 0)
+    return {"wall_time": wall_time, "kinds": kinds}
+
+
+def print_results(results):
+    """Print the breakdown of each build, and how the total time scales with the target count."""
+    for scale, scenarios in results.items():
+        for scenario, result in scenarios.items():
+            print(f"{scale} {scenario}: {result['wall_time']:.1f} s")
+            print(f"    {'stage kind':<14} {'stages':>7} {'commands':>9} {'racing':>7}"
+                  f" {'wall (s)':>9} {'commands (s)':>13} {'script (s)':>11}")
+            for kind, numbers in sorted(result["kinds"].items()):
+                print(f"    {kind:<14} {numbers['stages']:>7} {numbers['commands']:>9}"
+                      f" {numbers['racing_commands']:>7} {numbers['wall_time']:>9.2f}"
+                      f" {numbers['command_time']:>13.2f} {numbers['script_time']:>11.2f}")
+    if len(results) > 1:
+        print("Scaling (total wall time per target, and for each target added):")
+        scales = sorted(results, key=target_count)
+        for scenario in SCENARIOS:
+            per_target = ", ".join(
+                f"{scale}: {results[scale][scenario]['wall_time'] / target_count(scale):.2f} s"
+                for scale in scales)
+            added = ((results[scales[-1]][scenario]["wall_time"]
+                      - results[scales[0]][scenario]["wall_time"])
+                     / (target_count(scales[-1]) - target_count(scales[0])))
+            print(f"    {scenario:<7} {per_target}; {added:.2f} s per added target")
+
+
+def target_count(scale):
+    boards, modules = map(int, scale.split("x"))
+    return boards * modules
+
+
+def compare(results, baseline, tolerance, slack, check_times):
+    """
+    Compare the results against a baseline, printing every regression: more commands run by a
+    kind of stage than in the baseline (not counting RACING_COMMANDS), or, if check_times is
+    True, a total or per-kind wall time more than tolerance (a fraction) plus slack (in seconds)
+    over the baseline's. Returns True if there were none.
+    """
+    regressions = []
+
+    def check_time(name, time, baseline_time):
+        if check_times and time > baseline_time * (1 + tolerance) + slack:
+            regressions.append(f"{name}: {time:.2f} s, baseline {baseline_time:.2f} s")
+
+    for scale, scenarios in results.items():
+        for scenario, result in scenarios.items():
+            baseline_result = baseline.get(scale, {}).get(scenario)
+            if not baseline_result:
+                print(f"No baseline for {scale} {scenario}.")
+                continue
+            check_time(f"{scale} {scenario}", result["wall_time"], baseline_result["wall_time"])
+            for kind, numbers in result["kinds"].items():
+                baseline_numbers = baseline_result["kinds"].get(kind)
+                if not baseline_numbers:
+                    continue
+                name = f"{scale} {scenario} {kind}"
+                check_time(name, numbers["wall_time"], baseline_numbers["wall_time"])
+                if numbers["commands"] > baseline_numbers["commands"]:
+                    regressions.append(f"{name}: {numbers['commands']} commands, baseline"
+                                       f" {baseline_numbers['commands']}")
+    for regression in regressions:
+        print(f"**** Regression in {regression}")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the orchestration overhead of mangoh_release.py, using stub tools"
+                    " and synthetic sources")
+    parser.add_argument("--scales", default="1x1,2x2,4x2",
+                        help="comma-separated list of release sizes to build, as <boards>x<modules>"
+                             " (default: %(default)s)")
+    # With more jobs than CPUs, the stages' times depend on how they happen to be scheduled.
+    parser.add_argument("-j", "--jobs", type=int, default=min(os.cpu_count(), 4),
+                        help="--jobs to build with (default: the number of CPUs, up to 4)")
+    parser.add_argument("--patches", type=int, default=3,
+                        help="number of Legato patches in the spec (default: %(default)s)")
+    parser.add_argument("--legato-files", type=int, default=1000,
+                        help="number of files in the synthetic Legato sources"
+                             " (default: %(default)s)")
+    parser.add_argument("--size-scale", type=float, default=1,
+                        help="factor by which to scale the size of the dummy build outputs"
+                             " (default: %(default)s)")
+    parser.add_argument("--work-dir",
+                        default=os.path.join(tempfile.gettempdir(), "mangoh-release-bench"),
+                        help="directory in which to build (default: %(default)s)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE,
+                        help="baseline file (default: %(default)s)")
+    parser.add_argument("--check", action="store_true",
+                        help="compare the results against the baseline, and exit with an error"
+                             " status if anything regressed")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="write the results to the baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction by which a time may exceed the baseline's"
+                             " (default: %(default)s)")
+    parser.add_argument("--slack", type=float, default=1.0,
+                        help="seconds by which a time may exceed the baseline's, on top of the"
+                             " tolerance (default: %(default)s)")
+    args = parser.parse_args()
+    scales = args.scales.split(",")
+    try:
+        dimensions = [tuple(map(int, scale.split("x"))) for scale in scales]
+    except ValueError:
+        parser.error(f"bad --scales: {args.scales}")
+
+    if os.path.exists(args.work_dir):
+        shutil.rmtree(args.work_dir)
+    sources_dir = f"{args.work_dir}/sources"
+    os.makedirs(sources_dir)
+    env = dict(os.environ, GIT_CONFIG_GLOBAL=f"{args.work_dir}/gitconfig",
+               GIT_CONFIG_NOSYSTEM="1", GERRIT_USER="bench",
+               BENCH_SIZE_SCALE=str(args.size_scale),
+               PATH=f"{BENCH_DIR}/stubs:{os.environ['PATH']}")
+    write_git_config(env["GIT_CONFIG_GLOBAL"], sources_dir)
+    os.environ["GIT_CONFIG_GLOBAL"] = env["GIT_CONFIG_GLOBAL"]
+    patch_commits = create_sources(sources_dir, max(modules for _, modules in dimensions),
+                                   args.patches, args.legato_files)
+
+    results = {}
+    for scale, (boards, modules) in zip(scales, dimensions):
+        work_dir = f"{args.work_dir}/{scale}"
+        os.makedirs(work_dir)
+        spec_file = f"{work_dir}/{VERSION}.json"
+        with open(spec_file, "w") as f:
+            json.dump(release_spec(sources_dir, boards, modules, patch_commits), f, indent=4)
+        results[scale] = {}
+        for scenario, (clean_build, clean_caches) in SCENARIOS.items():
+            if clean_build:
+                shutil.rmtree(f"{work_dir}/build", ignore_errors=True)
+            if clean_caches:
+                shutil.rmtree(f"{work_dir}/caches", ignore_errors=True)
+            print(f"Building {scale} ({scenario})...")
+            results[scale][scenario] = summarize(*run_build(work_dir, spec_file, env, args.jobs))
+    print_results(results)
+
+    ok = True
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # The times (and how the stages overlap) depend on the machine and on how many stages
+        # run at the same time, but the numbers of commands don't.
+        check_times = [baseline["cpus"], baseline["jobs"]] == [os.cpu_count(), args.jobs]
+        if not check_times:
+            print(f"The baseline was made with {baseline['jobs']} jobs on a machine with"
+                  f" {baseline['cpus']} CPUs, so only the numbers of commands are compared with"
+                  f" this build, with {args.jobs} jobs on {os.cpu_count()} CPUs. Make a baseline"
+                  f" for this machine with --update-baseline to compare the times too.")
+        ok = compare(results, baseline["results"], args.tolerance, args.slack, check_times)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"jobs": args.jobs, "cpus": os.cpu_count(), "results": results}, f,
+                      indent=4)
+        print(f"Baseline written to {args.baseline}")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,7 @@
 #
 # Release build script for mangOH Red and newer mangOH boards.
 # The specification of what is to be included in the build is stored in JSON format
-# in another file. The path to that file is passed as the first (and only) argument
+# in another file. The path to that file is passed as the first positional argument
 # to this script.
 #
 # Copyright (C) Sierra Wireless Inc.
@@ -14,15 +14,32 @@ import os
 import shutil
 import pathlib
 import glob
+import argparse
+import threading
+import concurrent.futures
+import hashlib
+import re
+import time
+import html
+import fcntl
+import fnmatch
+import errno
+import urllib.request
+import urllib.parse
+import urllib.error
+import http.client
+import zipfile
+import socket
+import socketserver
+import shlex
+import contextlib
+import tempfile
+import xml.etree.ElementTree as ElementTree
 
 # All build artifacts will appear under here, including source code.
 # This makes it easy to clean up or to archive the entire results of a release build.
 BUILD_DIR = f"{os.getcwd()}/build"
 
-# The BUILD_DIR is the root of the leaf workspace used to build, so the leaf-data for the
-# workspace's current profile will be found there.
-LEAF_DATA = f"{BUILD_DIR}/leaf-data"
-
 # Variables that need to be set in the environment to "sandbox" leaf (i.e., to make sure
 # leaf doesn't change the user's leaf configuration and to make sure that the user's leaf
 # configuration doesn't contaminate the release).
@@ -30,55 +47,278 @@ LEAF_CONFIG = f"{BUILD_DIR}/leaf/config"
 LEAF_CACHE = f"{BUILD_DIR}/leaf/cache"
 LEAF_USER_ROOT = f"{BUILD_DIR}/leaf/installed-packages"
 
-# Directory in which the built leaf packages will be placed and indexed to form a "remote"
-# that we can use to install those packages and add them to profiles.
-LEAF_REMOTE = f"{BUILD_DIR}/leaf/remote"
+# Directory under which each release being built gets its own directory (see Release), in
+# which everything specific to that release is placed, including its leaf packages.
+RELEASES_DIR = f"{BUILD_DIR}/releases"
+
+# The directory containing this script and the leaf manifest templates.
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Directories in which the per-stage build logs and the build reports are written.
+LOG_DIR = f"{BUILD_DIR}/logs"
+REPORT_DIR = f"{BUILD_DIR}/reports"
+
+# Directory in which the journal of each build's completed stages is kept (see RunJournal).
+JOURNAL_DIR = f"{BUILD_DIR}/journals"
 
-# Directory in which leaf packages will be assembled in preparation for packing.
-LEAF_STAGING_DIR = f"{BUILD_DIR}/leaf/staging"
+# Default location of the cache of build stage outputs. This is outside of BUILD_DIR so that it
+# survives a "make clean" and can be shared between release builds.
+DEFAULT_CACHE_DIR = os.environ.get("MANGOH_BUILD_CACHE",
+                                   os.path.expanduser("~/.cache/mangoh-release"))
 
-# The directory in which the Legato sources will be cloned and built.
-LEGATO_REPO_ROOT = f"{BUILD_DIR}/legato"
-LEGATO_ROOT = f"{LEGATO_REPO_ROOT}/legato"
+# Default location of the local mirrors of the git repositories that the build fetches from.
+DEFAULT_MIRROR_DIR = os.environ.get("MANGOH_GIT_MIRRORS",
+                                    os.path.expanduser("~/.cache/mangoh-release-mirrors"))
 
-# The directory in which the mangOH sources will be cloned and built.
-MANGOH_ROOT = f"{BUILD_DIR}/mangOH"
+# Default location of the Yocto download directory and shared state cache shared by all the
+# Yocto builds.
+DEFAULT_YOCTO_CACHE_DIR = os.environ.get("MANGOH_YOCTO_CACHE",
+                                         os.path.expanduser("~/.cache/mangoh-release-yocto"))
 
-# The directory in which the Octave app sources will be cloned and built.
-OCTAVE_ROOT = f"{BUILD_DIR}/brkedgepkg"
+# Default location of the compiler caches shared by the Legato, Octave and mangOH builds (see
+# CompilerCache).
+DEFAULT_CCACHE_DIR = os.environ.get("MANGOH_CCACHE",
+                                    os.path.expanduser("~/.cache/mangoh-release-ccache"))
 
-# The directory in which the Data Hub sources can be found.
-DHUB_ROOT = f"{MANGOH_ROOT}/apps/DataHub"
+# Increment this when a change to this script changes what a build stage produces from the same
+# inputs, so that outputs cached by older versions of the script don't get reused.
+CACHE_FORMAT_VERSION = 2
+
+# Where releases are published (see make_publish_target()), and the default location of the local
+# copies of the metadata of the published leaf remotes.
+DEFAULT_PUBLISH_TARGET = "sftp:sierra.upload.akamai.com:mangOH/leaf"
+DEFAULT_PUBLISH_MIRROR_DIR = os.environ.get(
+    "MANGOH_PUBLISH_MIRRORS", os.path.expanduser("~/.cache/mangoh-release-publish"))
+
+# Directory (relative to the home directory) in which an SshExecutor's workers build.
+SSH_WORKER_DIR = "mangoh-release-worker"
 
 # Repository URLs.
-MANGOH_MAIN_REPO = "https://github.com/mangOH/mangOH"
+MANGOH_MAIN_REPO = "git@github.com:mangOH/mangOH.git"
+OCTAVE_REPO = "git@github.com:flowthings/brkedgepkg.git"
+
+# If True, resolve_git_ref() must not contact any remote repositories (see plan_build()).
+offline = False
+
+# The BuildCache in which build stage outputs are stored, or None if caching is disabled.
+build_cache = None
+
+# Serializes everything that changes the leaf cache or the installed packages, which are shared
+# by the builds for all boards and modules.
+leaf_install_lock = threading.Lock()
+
+# The GitMirrors through which all git and repo fetches are made, or None if fetches should go
+# directly to the remote repositories.
+git_mirrors = None
+
+
+class Release:
+    """
+    A mangOH release to be built, as specified by a JSON release specification file named
+    "<version>.json".
+
+    Everything specific to the release (its leaf remote, the staging area for its leaf packages,
+    and the workspaces of its boards and modules) goes in its own directory under RELEASES_DIR,
+    so several releases can be built side by side. The fetched sources and the Yocto and Legato
+    build trees are shared with any other releases being built whose specs make them identical
+    (see assign_shared_dirs()).
+    """
+    def __init__(self, spec_file):
+        # Extract the release version from the specification file name.
+        filename = os.path.basename(spec_file.strip())
+        assert filename.endswith('.json')
+        self.version = filename[:-5]
+        assert self.version
+        with open(spec_file) as json_file:
+            self.spec = json.load(json_file)
+        self.root = f"{RELEASES_DIR}/{self.version}"
+        # Directory in which the built leaf packages will be placed and indexed to form a "remote"
+        # that we can use to install those packages and add them to profiles.
+        self.leaf_remote = get_leaf_remote(f"{self.root}/leaf/remote")
+        # Directory in which leaf packages will be assembled in preparation for packing.
+        self.staging_dir = f"{self.root}/leaf/staging"
+        # Maps the name of each shared directory (see assign_shared_dirs()) to the suffix that
+        # distinguishes the copy this release uses from those used by other releases, and to the
+        # part of the spec that determines its contents.
+        self.variants = {}
+        self.shared_specs = {}
+        # Put in front of the targets in the names of the release's build stages, to tell them
+        # apart from other releases' when several releases are built at the same time.
+        self.stage_prefix = ""
+
+    def shared_dir(self, name):
+        """Get the path to the copy of a shared directory in BUILD_DIR that the release uses."""
+        return f"{BUILD_DIR}/{name}{self.variants.get(name, '')}"
+
+    def fetch_stage(self, sources):
+        """Get the name of the stage that fetches the "legato", "octave" or "mangoh" sources."""
+        name = {"legato": "legato", "octave": "brkedgepkg", "mangoh": "mangOH"}[sources]
+        return f"fetch {sources}{self.variants.get(name, '')}"
+
+    def yocto_fetch_stage(self, board, module):
+        """Get the name of the stage that fetches the Yocto sources for a board and module."""
+        return f"fetch {os.path.basename(yocto_build_dir(self, board, module))}"
+
+    def target(self, board, module):
+        """Get the name of a board and module in the names of the release's build stages."""
+        return f"{self.stage_prefix}{board}-{module}"
+
+    @property
+    def legato_repo_root(self):
+        """The directory in which the Legato sources are fetched."""
+        return self.shared_dir("legato")
+
+    @property
+    def legato_root(self):
+        return f"{self.legato_repo_root}/legato"
+
+    @property
+    def mangoh_root(self):
+        """The directory in which the mangOH sources are fetched."""
+        return self.shared_dir("mangOH")
+
+    @property
+    def octave_root(self):
+        """The directory in which the Octave app sources are fetched."""
+        return self.shared_dir("brkedgepkg")
+
+
+def assign_shared_dirs(releases, in_use=None):
+    """
+    Decide which copies of the fetched sources and Yocto build trees each of the releases uses.
+    Releases whose specs say to fetch the same sources (or build the same Yocto distro) share one
+    copy, and the stage that fetches (or builds) it, so only the parts that differ are fetched and
+    built separately. The first distinct copy is kept where a single release would put it, so
+    building one release after another updates the same directories incrementally.
+
+    in_use maps the name of each shared directory to a dict mapping the suffixes of the copies
+    that other builds running at the same time are using to the spec parts they were assigned
+    for (see shared_dirs_in_use()). Those copies are only shared if the spec part is the same.
+    """
+    occupied = {name: dict(copies) for name, copies in (in_use or {}).items()}
+
+    def assign(release, name, spec_part):
+        copies = occupied.setdefault(name, {})
+        suffix = next((suffix for suffix, part in copies.items() if part == spec_part), None)
+        if suffix is None:
+            index = 1
+            while (f"-{index}" if index > 1 else "") in copies:
+                index += 1
+            suffix = f"-{index}" if index > 1 else ""
+            copies[suffix] = spec_part
+        release.variants[name] = suffix
+        release.shared_specs[name] = spec_part
+
+    for release in releases:
+        spec = release.spec
+        assign(release, "legato", spec.get("legato"))
+        assign(release, "brkedgepkg", spec["octave"]["ref"])
+        assign(release, "mangOH", [spec["mangoh"]["ref"], spec["mangoh"].get("wget", [])])
+        for board, board_spec in spec["boards"].items():
+            for module, module_spec in board_spec.items():
+                assign(release, f"yocto-{board}-{module}", module_spec.get("yocto"))
+        if len(releases) > 1:
+            release.stage_prefix = f"{release.version}:"
+
+
+def shared_dirs_in_use(releases):
+    """Get the copies of the shared directories that the releases use (see assign_shared_dirs())."""
+    in_use = {}
+    for release in releases:
+        for name, suffix in release.variants.items():
+            in_use.setdefault(name, {})[suffix] = release.shared_specs[name]
+    return in_use
 
-# The mangOH release version identifier, taken from the release specification file name.
-version = None
 
+def yocto_build_dir(release, board, module):
+    return release.shared_dir(f"yocto-{board}-{module}")
 
-def yocto_build_dir(board, module):
-    return f"{BUILD_DIR}/yocto-{board}-{module}"
+
+def target_dir(release, board, module):
+    """
+    Get the directory in which everything specific to a board and module is built for a release.
+    This is also the root of a leaf workspace that is only used for that board and module, so
+    builds for different boards and modules can't interfere with each other's leaf profiles.
+    """
+    return f"{release.root}/target-{board}-{module}"
+
+
+def legato_toolchain_name(release, board, module):
+    """
+    Identify the toolchain that Legato is built with for a board and module, in a way that
+    doesn't need any remotes to be contacted, so it is known when planning the build (see
+    plan_build()): a toolchain built with Yocto by a hash of its Yocto spec, which is what
+    get_toolchain_key() is computed from (and the refs in it resolve to the same commits
+    throughout a build), and any other toolchain by the ID of its leaf package. Leaf packages of
+    toolchains built with Yocto are named after the board, so they can't be used.
+    """
+    yocto_spec = release.spec["boards"][board][module].get("yocto")
+    if yocto_spec:
+        return f"yocto-{build_stage_key('yocto toolchain', yocto_spec)[:12]}"
+    return get_toolchain_package(release, board, module)
+
+
+def legato_build_dir(release, board, module):
+    """
+    Get the directory in which Legato is built for a board and module. What gets built only
+    depends on the module, the toolchain (see legato_toolchain_name()) and the Legato sources
+    (which only differ between releases built at the same time if they have different variants
+    of the Legato sources, see assign_shared_dirs()), so the directory is named after those, and
+    Legato builds are kept between releases and boards, so rebuilds are incremental.
+    """
+    return (f"{BUILD_DIR}/legato-{module}-{legato_toolchain_name(release, board, module)}"
+            f"{release.variants.get('legato', '')}")
+
+
+def octave_build_dir(release, board, module):
+    return f"{target_dir(release, board, module)}/brkedgepkg"
+
+
+def mangoh_build_dir(release, board, module, octave=True):
+    """
+    Get the directory in which mangOH is built for a board and module, either with or without
+    Octave. The two variants are built in separate copies of the sources, so they can be built
+    at the same time.
+    """
+    if octave:
+        return f"{target_dir(release, board, module)}/mangOH"
+    return f"{target_dir(release, board, module)}/mangOH-no-octave"
+
+
+def spk_file_name(release, board, module, octave, version=None):
+    """
+    Get the name of the factory .spk file built for a board and module, in the release or (if
+    version is given) in an earlier release.
+    """
+    version = version or release.version
+    if octave:
+        return f"mangOH-{board}-{module}_{version}-octave.spk"
+    return f"mangOH-{board}-{module}_{version}.spk"
+
+
+def leaf_data_dir(release, board, module):
+    """Get the leaf-data directory of the board and module's leaf workspace."""
+    return f"{target_dir(release, board, module)}/leaf-data"
 
 
-def legato_build_dir(board, module):
-    return f"{BUILD_DIR}/legato-{board}-{module}"
+def toolchain_package_id(release, board, module):
+    return f"mangOH-{board}-{module}-toolchain_{release.version}-linux64"
 
 
-def toolchain_package_id(board, module):
-    return f"mangOH-{board}-{module}-toolchain_{version}-linux64"
+def linux_package_id(release, board, module):
+    return f"mangOH-{board}-{module}-linux-image_{release.version}"
 
 
-def linux_package_id(board, module):
-    return f"mangOH-{board}-{module}-linux-image_{version}"
+def legato_package_id(release, board, module):
+    return f"mangOH-{board}-{module}-legato_{release.version}"
 
 
-def legato_package_id(board, module):
-    return f"mangOH-{board}-{module}-legato_{version}"
+def octave_package_id(release, board, module):
+    return f"Octave-mangOH-{board}-{module}_{release.version}"
 
 
-def octave_package_id(board, module):
-    return f"Octave-mangOH-{board}-{module}_{version}"
+def delta_package_id(release, board, module):
+    return f"mangOH-{board}-{module}-delta_{release.version}"
 
 
 def get_abbreviated_module(module):
@@ -87,6 +327,79 @@ def get_abbreviated_module(module):
     return module.rstrip('x0')
 
 
+# Variables in leaf manifest templates are surrounded by '%' characters, like "%TARGET%".
+MANIFEST_VARIABLE_PATTERN = re.compile("%([A-Za-z_][A-Za-z0-9_]*)%")
+
+
+def manifest_variables(release, board, module, **extra_variables):
+    """
+    Get the values of the variables that can be used in the leaf manifest templates for a board
+    and module in a release, plus any extra_variables.
+    """
+    variables = {
+        "MANGOH_BOARD": board,
+        "VERSION": release.version,
+        "TARGET": module,
+        "TARGET_UPPERCASE": module.upper(),
+    }
+    variables.update(extra_variables)
+    return variables
+
+
+def render_manifest(template, variables):
+    """
+    Render a leaf manifest template file (relative to SCRIPT_DIR), replacing every variable in it
+    with its value. The variables are all inside JSON strings, so the values are escaped as
+    JSON string contents. Raises a ValueError listing all the variables that have no (or an
+    empty) value, or if the result isn't valid JSON. Returns the rendered text.
+    """
+    text = pathlib.Path(f"{SCRIPT_DIR}/{template}").read_text()
+    unresolved = sorted({name for name in MANIFEST_VARIABLE_PATTERN.findall(text)
+                         if not variables.get(name)})
+    if unresolved:
+        raise ValueError(f"{template}: no value for {', '.join(unresolved)}")
+    text = MANIFEST_VARIABLE_PATTERN.sub(
+        lambda match: json.dumps(str(variables[match.group(1)]))[1:-1], text)
+    try:
+        json.loads(text)
+    except ValueError as e:
+        raise ValueError(f"{template}: rendered manifest is not valid JSON: {e}")
+    return text
+
+
+def write_manifest(template, package_dir, variables):
+    """Render a leaf manifest template into the manifest.json file in a package staging dir."""
+    pathlib.Path(f"{package_dir}/manifest.json").write_text(render_manifest(template, variables))
+
+
+def check_manifests(release):
+    """
+    Render all of the leaf manifests that the build would generate for every board and module in
+    the release, without writing them, and print every problem found. The Legato version isn't
+    known until the Legato sources are fetched, so a placeholder is used for it.
+    Returns True if no problems were found.
+    """
+    spec = release.spec
+    problems = []
+    for board, board_spec in spec["boards"].items():
+        for module, module_spec in board_spec.items():
+            templates = []
+            if module_spec.get("yocto"):
+                templates += ["toolchainManifest.json", "linuxManifest.json"]
+            if spec.get("legato"):
+                templates.append("legatoManifest.json")
+            variables = manifest_variables(release, board, module,
+                                           LEGATO_VERSION="<Legato version>")
+            for template in templates:
+                try:
+                    render_manifest(template, variables)
+                except ValueError as e:
+                    problems.append(f"{release.version} {board} {module}: {e}")
+    for problem in problems:
+        print(f"**** {problem}")
+    return not problems
+
+
 def sandbox_leaf():
     """Set the the process environment variables needed to sandbox leaf."""
     os.environ["LEAF_CONFIG"] = LEAF_CONFIG
@@ -94,9 +407,410 @@ def sandbox_leaf():
     os.environ["LEAF_USER_ROOT"] = LEAF_USER_ROOT
 
 
-def shell(cmd, cwd=None, check=True):
+def leaf_env(release, board, module):
+    """
+    Get the process environment needed to run leaf in the sandbox for a board and module.
+    Each board and module gets its own leaf configuration and workspace (and therefore its own
+    profiles), but the download cache and installed packages are shared by all of them, so each
+    package only gets downloaded and installed once. Anything that may install packages must be
+    done with the leaf_install_lock held.
+    """
+    env = dict(os.environ)
+    env["LEAF_CONFIG"] = f"{target_dir(release, board, module)}/leaf/config"
+    env["LEAF_CACHE"] = LEAF_CACHE
+    env["LEAF_USER_ROOT"] = LEAF_USER_ROOT
+    env["LEAF_WORKSPACE"] = target_dir(release, board, module)
+    return env
+
+
+def run_command(cmd, cwd=None, check=True, env=None, capture_output=False):
+    """
+    Run a shell command and record its resource usage in the build report of the stage running it
+    (see BuildReport.current()). When run from a build stage, the command's output goes to the
+    stage's log file. Returns the command's standard output if capture_output is True.
+    """
+    report = BuildReport.current()
+    stage = report.current_stage()
+    log_file = None
+    if stage:
+        report.progress(f"[{stage['name']}] $ {cmd}")
+        log_file = open(stage["log"], "a")
+        log_file.write(f"$ {cmd}\n")
+        log_file.flush()
+    try:
+        start_time = time.time()
+        process = subprocess.Popen(cmd, shell=True, cwd=cwd, env=env, universal_newlines=True,
+                                   stdout=subprocess.PIPE if capture_output else log_file,
+                                   stderr=log_file)
+        output = process.stdout.read() if capture_output else None
+        # Reap the child ourselves so that we get its resource usage (which includes the
+        # usage of all of its descendants).
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if capture_output:
+            process.stdout.close()
+    finally:
+        if log_file:
+            log_file.close()
+    report.add_command({
+        "command": cmd,
+        "cwd": cwd or os.getcwd(),
+        "wall_time": time.time() - start_time,
+        "cpu_time": usage.ru_utime + usage.ru_stime,
+        "max_rss_kib": usage.ru_maxrss,
+        "bytes_written": usage.ru_oublock * 512,
+        "exit_status": process.returncode,
+    })
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output
+
+
+def shell(cmd, cwd=None, check=True, env=None):
     """Run a shell command. Throw an exception if it fails."""
-    subprocess.run(cmd, check=check, shell=True, cwd=cwd)
+    run_command(cmd, cwd=cwd, check=check, env=env)
+
+
+def shell_output(cmd, cwd=None):
+    """Run a shell command and return its standard output. Throw an exception if it fails."""
+    return run_command(cmd, cwd=cwd, capture_output=True)
+
+
+class UnresolvedRefError(LookupError):
+    """Raised when a git ref can't be resolved without contacting the remote while offline."""
+
+
+# A lock for each ref that has been resolved (see resolve_git_ref()), by URL and ref.
+_resolve_locks = {}
+_resolve_locks_lock = threading.Lock()
+
+def resolve_git_ref(url, ref="HEAD"):
+    """
+    Get the ID of the commit that a ref currently resolves to in a remote git repository.
+    Full commit IDs are returned as is, without contacting the remote. If the ref can't be found
+    on the remote (e.g., because it is an abbreviated commit ID), it is returned unchanged.
+    Raises an UnresolvedRefError if the remote would have to be contacted while offline.
+
+    Each ref is only resolved once per build (see BuildReport.resolved_refs), so every stage
+    sees the same commit, even if a branch moves while the build is running.
+    """
+    if re.fullmatch("[0-9a-f]{40}", ref):
+        return ref
+    if offline:
+        raise UnresolvedRefError(f"'{ref}' in {url} is not a commit ID")
+    resolved_refs = BuildReport.current().resolved_refs
+    with _resolve_locks_lock:
+        resolve_lock = _resolve_locks.setdefault((url, ref), threading.Lock())
+    # Stages resolving the same ref at the same time wait for the first one's answer.
+    with resolve_lock:
+        if f"{url} {ref}" not in resolved_refs:
+            commit = ref
+            for line in shell_output(f"git ls-remote {url} '{ref}' '{ref}^{{}}'").splitlines():
+                commit_id, name = line.split()
+                # Prefer the commit that an annotated tag points to over the tag object itself.
+                if commit == ref or name.endswith("^{}"):
+                    commit = commit_id
+            resolved_refs[f"{url} {ref}"] = commit
+        return resolved_refs[f"{url} {ref}"]
+
+
+def build_stage_key(stage, inputs):
+    """
+    Compute the key identifying the output of a build stage from everything that goes into
+    producing it. The inputs must be JSON serializable.
+    """
+    text = json.dumps([stage, CACHE_FORMAT_VERSION, inputs], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def file_hash(path, algorithm="sha256"):
+    """Get the hash of a file's contents, in hex, using a hashlib algorithm."""
+    hasher = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def read_checkpoint(checkpoint_file):
+    """Get the key recorded in a checkpoint file, or None if the checkpoint hasn't been reached."""
+    if not os.path.exists(checkpoint_file):
+        return None
+    return pathlib.Path(checkpoint_file).read_text().strip()
+
+
+class BuildCache:
+    """
+    A local content-addressed store of build stage outputs, keyed on a hash of the stage's inputs
+    (see build_stage_key()). When the total size of the stored outputs goes over max_size bytes,
+    the least recently used entries are evicted.
+
+    Each entry is a directory named after its key holding copies of the stored files and
+    directories, plus a "<key>.json" file holding its size. The metadata file is written last,
+    so an entry without one is incomplete and is ignored. Its modification time records when the
+    entry was last used. The metadata of all the entries is read the first time it is needed,
+    and then kept up to date in memory, so a long-running process (see BuildDaemon) doesn't
+    re-read it every time something is stored.
+
+    The cache may be shared by several builds (in this and other processes), so entries are
+    only copied out with a shared lock on the cache held (see _locked()), and only replaced or
+    evicted with an exclusive one.
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.lock_file = f"{cache_dir}/.lock"
+        # Maps the key of each entry to a list containing the time it was last used and its size.
+        # None until loaded.
+        self.entries = None
+        os.makedirs(cache_dir, exist_ok = True)
+
+    def _metadata_file(self, key):
+        return f"{self.cache_dir}/{key}.json"
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """
+        Used in a "with" block to hold a lock on the cache, shared (fcntl.LOCK_SH) or exclusive
+        (fcntl.LOCK_EX). Each block opens the lock file itself, so the lock also works between
+        threads.
+        """
+        with open(self.lock_file, "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def contains(self, key):
+        """Check whether there is a complete entry stored under key."""
+        return os.path.exists(self._metadata_file(key))
+
+    def restore(self, key, dest_dir):
+        """
+        Copy the files and directories stored under key into dest_dir, replacing any that are
+        already there. Returns False if there is no such entry.
+        """
+        metadata_file = self._metadata_file(key)
+        # The entry can't be replaced or evicted while it is being copied.
+        with self._locked(fcntl.LOCK_SH):
+            with self.lock:
+                if not os.path.exists(metadata_file):
+                    return False
+                os.utime(metadata_file)
+                if self.entries is not None and key in self.entries:
+                    self.entries[key][0] = os.path.getmtime(metadata_file)
+            os.makedirs(dest_dir, exist_ok = True)
+            entry_dir = f"{self.cache_dir}/{key}"
+            for name in os.listdir(entry_dir):
+                dest = f"{dest_dir}/{name}"
+                if os.path.isdir(dest) and not os.path.islink(dest):
+                    shutil.rmtree(dest)
+                elif os.path.lexists(dest):
+                    os.remove(dest)
+                shell(f"cp -a --reflink=auto {entry_dir}/{name} {dest}")
+            print(f"Restored {', '.join(os.listdir(entry_dir))} from the build cache.")
+        return True
+
+    def store(self, key, paths):
+        """
+        Store copies of the files and directories in the list of paths under key. They are
+        copied into a directory of their own, which then replaces any existing entry.
+        """
+        entry_dir = f"{self.cache_dir}/{key}"
+        temp_dir = tempfile.mkdtemp(prefix=f".incomplete-{key}-", dir=self.cache_dir)
+        for path in paths:
+            shell(f"cp -a --reflink=auto {path} {temp_dir}/{os.path.basename(path)}")
+        size = int(shell_output(f"du -sb {temp_dir}").split()[0])
+        old_dir = None
+        with self._locked(fcntl.LOCK_EX), self.lock:
+            # Invalidate the old entry before moving it out of the way.
+            if os.path.exists(self._metadata_file(key)):
+                os.remove(self._metadata_file(key))
+            if os.path.exists(entry_dir):
+                old_dir = f"{temp_dir}.old"
+                os.rename(entry_dir, old_dir)
+            os.rename(temp_dir, entry_dir)
+            with open(self._metadata_file(key), "w") as metadata_file:
+                json.dump({"size": size, "contents": list(map(os.path.basename, paths))},
+                          metadata_file)
+            self._load_entries()
+            self.entries[key] = [os.path.getmtime(self._metadata_file(key)), size]
+            self._evict(keep=key)
+        if old_dir:
+            shutil.rmtree(old_dir)
+
+    def _load_entries(self):
+        """Make sure the metadata of the entries is loaded. Must be called with the lock held."""
+        if self.entries is None:
+            self.entries = {}
+            for metadata_file in glob.glob(f"{self.cache_dir}/*.json"):
+                with open(metadata_file) as f:
+                    size = json.load(f)["size"]
+                key = os.path.basename(metadata_file)[:-5]
+                self.entries[key] = [os.path.getmtime(metadata_file), size]
+
+    def _evict(self, keep):
+        """
+        Remove the least recently used entries (other than keep) until the cache fits within
+        its size limit. Must be called with the lock and the exclusive lock on the cache held.
+        """
+        total_size = sum(size for _, size in self.entries.values())
+        for key, (_, size) in sorted(self.entries.items(), key=lambda entry: entry[1]):
+            if total_size <= self.max_size:
+                break
+            if key != keep:
+                print(f"Evicting {key} from the build cache.")
+                os.remove(self._metadata_file(key))
+                shutil.rmtree(f"{self.cache_dir}/{key}", ignore_errors=True)
+                del self.entries[key]
+                total_size -= size
+
+
+def fetch_stage_key(description, inputs):
+    """Compute the key identifying the sources fetched with given inputs."""
+    return build_stage_key(f"fetch {description}", inputs)
+
+
+def checkpointed_fetch(description, root, inputs, fetch):
+    """
+    Make sure that root contains the sources fetched by calling fetch(), given inputs that
+    completely determine what will be fetched. Fetching can be very time consuming and requires
+    a fast Internet connection, so if the sources have already been fetched (or are in the
+    build cache) using the same inputs, they are reused.
+    The key computed from the inputs is recorded in a ".fetched" checkpoint file in root.
+    """
+    key = fetch_stage_key(description, inputs)
+    checkpoint_file = f"{root}/.fetched"
+    recorded_key = read_checkpoint(checkpoint_file)
+    if recorded_key == key:
+        return
+    if recorded_key is not None:
+        print(f"The inputs for the {description} sources have changed since they were fetched.")
+    prep_clean_dir(root)
+    # The cache entry holds the contents of root, rather than root itself, because the same
+    # sources may be fetched into different directories (see assign_shared_dirs()).
+    if build_cache and build_cache.restore(key, root):
+        pathlib.Path(checkpoint_file).write_text(key)
+        return
+    print(f"Fetching {description} sources...")
+    fetch()
+    # Checkpoint reached.
+    pathlib.Path(checkpoint_file).write_text(key)
+    if build_cache:
+        build_cache.store(key, [f"{root}/{name}" for name in os.listdir(root)])
+
+
+class GitMirrors:
+    """
+    Local mirrors of the remote git repositories (and repo tool manifests) that the build
+    fetches from, shared by all fetches and kept between builds. Each mirror is updated
+    incrementally (at most once per build, see BuildReport.refresh_after) the first time it is
+    used, so each git object is only downloaded once, no matter how many source trees it ends up
+    in.
+
+    Plain git repositories are mirrored as bare repositories under "git/". The projects listed in
+    a repo manifest are mirrored under "repo/", in a repo mirror shared by all the manifests in
+    the same manifest repository.
+
+    The mirrors may be shared by several builds at the same time (e.g., the build daemon's jobs,
+    process workers, and other builds on the same machine), so each mirror is only updated with
+    a lock on a file next to it held (see _lock()).
+    """
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+        # Maps each mirror path (or repo mirror path and manifest) to when it was last updated.
+        self.updated = {}
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def _mirror_path(self, kind, url):
+        name = os.path.basename(url.rstrip("/"))
+        if name.endswith(".git"):
+            name = name[:-4]
+        url_hash = hashlib.sha1(url.encode()).hexdigest()[:12]
+        return f"{self.mirror_dir}/{kind}/{name}-{url_hash}"
+
+    @contextlib.contextmanager
+    def _lock(self, path):
+        """
+        Used in a "with" block to hold the lock that serializes updates to the mirror at path, in
+        this and any other process.
+        """
+        with self.locks_lock:
+            lock = self.locks.setdefault(path, threading.Lock())
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with lock, open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def git_mirror_path(self, url):
+        """Get the path to the mirror of a git repository, whether or not it has been made."""
+        return self._mirror_path("git", url) + ".git"
+
+    def update(self, url):
+        """Create or update the mirror of a git repository. Returns the path to the mirror."""
+        path = self.git_mirror_path(url)
+        with self._lock(path):
+            if self.updated.get(path, 0) < BuildReport.current().refresh_after:
+                if os.path.exists(path):
+                    print(f"Updating the mirror of {url}...")
+                    shell("git fetch --prune origin '+refs/*:refs/*'", cwd=path)
+                else:
+                    print(f"Mirroring {url}...")
+                    shell(f"rm -rf {path}.incomplete && git clone --mirror {url} {path}.incomplete"
+                          f" && mv {path}.incomplete {path}")
+                self.updated[path] = time.time()
+        return path
+
+    def update_repo_mirror(self, manifest_repo, base_manifest):
+        """
+        Create or update the repo mirror of all the projects in a repo manifest. Returns the path
+        to the mirror, for use as a "repo init --reference".
+        """
+        path = self._mirror_path("repo", manifest_repo)
+        with self._lock(path):
+            if self.updated.get((path, base_manifest), 0) < BuildReport.current().refresh_after:
+                print(f"Updating the mirror of {base_manifest} from {manifest_repo}...")
+                os.makedirs(path, exist_ok = True)
+                shell(f"repo init -u {manifest_repo} -m {base_manifest} --mirror"
+                      f" && repo sync -j{os.cpu_count()}", cwd=path)
+                self.updated[(path, base_manifest)] = time.time()
+        return path
+
+    def clone(self, url, dest):
+        """
+        Clone a repository from its mirror, leaving the clone's "origin" pointing at the real
+        remote repository.
+        """
+        mirror = self.update(url)
+        shell(f"git clone {mirror} {dest}")
+        shell(f"git remote set-url origin {url}", cwd=dest)
+
+    def update_submodules(self, repo_path):
+        """
+        Recursively initialize and check out all the submodules of a repository, fetching them
+        from their mirrors.
+        """
+        shell("git submodule init", cwd=repo_path)
+        submodule_urls = shell_output(
+            "git config --get-regexp '^submodule\\..*\\.url$' || true", cwd=repo_path)
+        for line in submodule_urls.splitlines():
+            key, url = line.split(maxsplit=1)
+            name = key[len("submodule."):-len(".url")]
+            submodule_path = shell_output(
+                f"git config -f .gitmodules submodule.{name}.path", cwd=repo_path).strip()
+            # Point the submodule at its mirror just long enough to check it out.
+            shell(f"git config {key} {self.update(url)}", cwd=repo_path)
+            shell(f"git -c protocol.file.allow=always submodule update -- {submodule_path}",
+                  cwd=repo_path)
+            shell(f"git config {key} {url}", cwd=repo_path)
+            shell(f"git remote set-url origin {url}", cwd=f"{repo_path}/{submodule_path}")
+            self.update_submodules(f"{repo_path}/{submodule_path}")
 
 
 def fetch_git_repo(url, ref, dest=None):
@@ -104,415 +818,1943 @@ def fetch_git_repo(url, ref, dest=None):
 
     The repository is cloned recursively, so submodules will also be retrieved. Note that the
     repository is cloned into the current working directory and that the name of the directory will
-    be derived from the URL.
+    be derived from the URL. If git_mirrors is set, everything is fetched through the mirrors.
     """
     if dest is None:
         dest = url.split("/")[-1]
         if dest.endswith('.git'):
             dest = dest[:-4]
-    shell(f"git clone {url} {dest}")
+    if git_mirrors:
+        git_mirrors.clone(url, dest)
+    else:
+        shell(f"git clone {url} {dest}")
     shell(f"git checkout {ref}", cwd=dest)
-    shell("git submodule update --recursive --init", cwd=dest)
+    if git_mirrors:
+        git_mirrors.update_submodules(dest)
+    else:
+        shell("git submodule update --recursive --init", cwd=dest)
 
 
-def force_clean_git_repo(repo_path):
+def repo_sync(manifest_repo, base_manifest, dest, manifest_commit):
     """
-    Recursively find all git repositories under repo_path and remove untracked files;
-    excluding the ".fetched" checkpoint file.
+    Fetch the sources listed in a repo manifest into dest using Google's "repo" tool, with the
+    manifest repository at manifest_commit (see resolve_git_ref()).
+    If git_mirrors is set, the objects are fetched through the mirrors.
     """
-    for directory, subdirs, files in os.walk(repo_path):
-        if '.git' in subdirs or '.git' in files:
-            print(f"cleaning: {directory}")
-            shell("git clean -xfd -e /.fetched", cwd=directory)
+    reference = ""
+    if git_mirrors:
+        reference = f" --reference={git_mirrors.update_repo_mirror(manifest_repo, base_manifest)}"
+    shell(f"repo init -u {manifest_repo} -b {manifest_commit} -m {base_manifest}{reference}"
+          f" && repo sync -j{os.cpu_count()}", cwd=dest)
 
 
-def fetch_mangoh(spec):
-    """Clone the mangOH repository and all submodules."""
-    fetch_git_repo(MANGOH_MAIN_REPO, spec["mangoh"]["ref"], dest=MANGOH_ROOT);
+# The projects listed in each repo manifest that has been read (see manifest_projects()), by
+# manifest repository, commit and manifest. They can't change, so they're kept between builds.
+_manifest_projects = {}
+_manifest_projects_lock = threading.Lock()
 
+def manifest_projects(manifest_repo, manifest_commit, base_manifest):
+    """
+    Get the URL and revision of each project listed in a repo manifest (and the manifests it
+    includes), with the manifest repository at manifest_commit (see resolve_git_ref()), without
+    fetching the projects. The manifest is read from git_mirrors if it is set, or else from a
+    temporary clone of the manifest repository.
+    Raises an UnresolvedRefError if the remote would have to be contacted while offline.
+    """
+    key = (manifest_repo, manifest_commit, base_manifest)
+    with _manifest_projects_lock:
+        if key in _manifest_projects:
+            return _manifest_projects[key]
+    with contextlib.ExitStack() as stack:
+        if git_mirrors and not offline:
+            repo_path = git_mirrors.update(manifest_repo)
+        elif git_mirrors and os.path.exists(git_mirrors.git_mirror_path(manifest_repo)):
+            repo_path = git_mirrors.git_mirror_path(manifest_repo)
+        elif offline:
+            raise UnresolvedRefError(f"{base_manifest} in {manifest_repo} has not been mirrored")
+        else:
+            repo_path = stack.enter_context(tempfile.TemporaryDirectory(prefix="manifest-"))
+            shell(f"git clone --bare --quiet {manifest_repo} {repo_path}")
 
-def prep_clean_dir(build_dir):
-    """If the directory is there already, delete it. Then create an empty one."""
-    if os.path.exists(build_dir):
-        shutil.rmtree(build_dir)
-    os.makedirs(build_dir)
+        def read(name):
+            try:
+                text = shell_output(f"git show {manifest_commit}:{shlex.quote(name)}",
+                                    cwd=repo_path)
+            except subprocess.CalledProcessError:
+                if offline:
+                    raise UnresolvedRefError(f"{manifest_commit} in {manifest_repo} has not been"
+                                             f" mirrored")
+                raise
+            root = ElementTree.fromstring(text)
+            for include in list(root.iter("include")):
+                root.extend(read(include.get("name")))
+            return root
 
+        manifest = read(base_manifest)
+    remotes = {remote.get("name"): remote for remote in manifest.iter("remote")}
+    default = manifest.find("default")
+    if default is None:
+        default = ElementTree.Element("default")
+    projects = []
+    for project in manifest.iter("project"):
+        remote = remotes[project.get("remote") or default.get("remote")]
+        fetch = remote.get("fetch")
+        # A relative fetch URL is relative to the manifest repository's URL, as repo resolves
+        # it. urljoin() needs a scheme, so one stands in for it in URLs without one (e.g.,
+        # "git@github.com:mangOH/manifest").
+        if fetch.startswith("."):
+            base = manifest_repo.rstrip("/")
+            placeholder = base.find(":") != base.find("/") - 1
+            if placeholder:
+                base = f"gopher://{base}"
+            fetch = urllib.parse.urljoin(base, fetch.rstrip("/"))
+            if placeholder:
+                fetch = fetch[len("gopher://"):]
+        revision = (project.get("revision") or remote.get("revision")
+                    or default.get("revision") or "HEAD")
+        projects.append((f"{fetch.rstrip('/')}/{project.get('name')}", revision))
+    with _manifest_projects_lock:
+        _manifest_projects[key] = projects
+    return projects
 
-def index_leaf_remote():
-    """Build the leaf remote's index"""
-    shell("leaf build index -o mangOH.json *.leaf", cwd=LEAF_REMOTE)
 
+def manifest_project_commits(manifest_repo, manifest_commit, base_manifest):
+    """
+    Resolve the revision of each project listed in a repo manifest to a commit (see
+    resolve_git_ref()), so that a key computed from them changes when a project's branch moves,
+    not just when the manifest does. Returns a sorted list of "<url> <commit>" strings.
+    """
+    return sorted(f"{url} {resolve_git_ref(url, revision)}"
+                  for url, revision in manifest_projects(manifest_repo, manifest_commit,
+                                                         base_manifest))
 
-def create_leaf_package(package_id, staging_dir):
+
+def git_repos(repo_path):
     """
-    Create a package file in the leaf remote with a given package_id whose files are waiting
-    in the staging_dir. The package_id should include the version, but NOT the '.leaf' suffix.
+    Get the list of paths to the git repository at repo_path and all of its checked out
+    submodules, recursively. The submodules are found from git's own records (i.e., .gitmodules),
+    rather than by walking the whole tree, which can be huge once it has been built.
     """
-    os.makedirs(LEAF_REMOTE, exist_ok = True)
-    package_file = f"{LEAF_REMOTE}/{package_id}.leaf"
-    shell(f"leaf build pack -o {package_file} -i {staging_dir} -- -J .")
-    index_leaf_remote()
+    if not os.path.exists(f"{repo_path}/.gitmodules"):
+        return [repo_path]
+    submodules = shell_output("git submodule foreach --quiet --recursive"
+                              " 'echo \"$toplevel/$sm_path\"'", cwd=repo_path)
+    return [repo_path] + submodules.splitlines()
 
 
-def remove_leaf_package(package_id):
+def force_clean_git_repo(repo_path):
     """
-    Remove a package from the leaf remote and the installed packages, and clean the leaf cache.
-    The package_id should include the version, but NOT the '.leaf' suffix.
+    Remove the untracked files from the git repository at repo_path and all of its submodules,
+    excluding the ".fetched" and ".cloned" checkpoint files. The repositories are cleaned at the
+    same time.
     """
-    shell(f"rm -f {package_id}.leaf*", cwd=LEAF_REMOTE)
-    shell(f"rm -rf {LEAF_CACHE}/*")
-    shell(f"rm -rf {package_id}", cwd=LEAF_USER_ROOT)
-    index_leaf_remote()
+    repos = git_repos(repo_path)
+    print(f"Cleaning {len(repos)} git repositories in {repo_path}...")
+    clean = BuildReport.current().bind_stage(
+        lambda directory: shell("git clean -xfdq -e /.fetched -e /.cloned", cwd=directory))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        for future in [pool.submit(clean, directory) for directory in repos]:
+            future.result()
 
 
-class LeafProfile:
+def invalidate_toolchain_artifacts(repo_path, toolchain_key, cloned):
     """
-    Used to create a leaf profile based on the base_package using a "with" block, so it gets
-    deleted on exit from the with block.
+    Make sure that everything that has been built in the git repository at repo_path was built
+    with the toolchain identified by toolchain_key, so it can be built incrementally.
+    The toolchain that the repository was last built with is recorded in a ".toolchain" stamp
+    file in it. If that is a different toolchain (or isn't known), everything built with it is
+    removed (see force_clean_git_repo()), unless the repository has just been cloned, and so
+    hasn't been built at all. The stamp is written before the build, rather than after it,
+    because whatever a failed build leaves behind was also built with the new toolchain.
+    Returns True if anything was cleaned.
     """
-    def __init__(self, base_packages):
-        self.packages = map(remove_latest, base_packages)
+    stamp_file = f"{repo_path}/.toolchain"
+    cleaned = False
+    if not cloned and read_checkpoint(stamp_file) != toolchain_key:
+        print(f"{repo_path} was last built with a different toolchain.")
+        force_clean_git_repo(repo_path)
+        shell("make clean", cwd=repo_path)
+        cleaned = True
+    pathlib.Path(stamp_file).write_text(toolchain_key)
+    return cleaned
 
-    def __enter__(self):
-        shell("leaf remote fetch", cwd=BUILD_DIR)
-        package_args = ' '.join([f'-p {pkg} ' for pkg in self.packages])
-        shell(f"yes | leaf setup profile {package_args}", cwd=BUILD_DIR)
-        return self
 
-    def __exit__(self, exception_type, value, traceback):
-        shell("leaf profile delete profile", cwd=BUILD_DIR)
+def prep_clean_dir(build_dir):
+    """If the directory is there already, delete it. Then create an empty one."""
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
 
 
-def get_depends(spec, board, module):
+def clone_source_tree(src, dest, checkpoint_file):
     """
-    Get a list of strings, each of which contains the ID of a leaf package that
-    the spec says a given board and module depends on.
+    Make a private copy of a fetched source tree for building a single board and module.
+    The copy is only refreshed if the sources have been re-fetched since it was made (i.e., if the
+    fetch checkpoint_file is newer than the copy). Returns True if a new copy was made.
     """
-    mangoh_spec = spec["mangoh"]
-    module_spec = spec["boards"][board][module]
-    depends = mangoh_spec["depends"] + module_spec.get("depends", [])
-    yocto_spec = module_spec.get("yocto")
-    if yocto_spec:
-        depends.append(toolchain_package_id(board, module))
-        depends.append(linux_package_id(board, module))
-    return depends
+    stamp_file = f"{dest}/.cloned"
+    if (not os.path.exists(stamp_file)
+            or os.path.getmtime(stamp_file) < os.path.getmtime(checkpoint_file)):
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.makedirs(os.path.dirname(dest), exist_ok = True)
+        # Let the file system share the data blocks between the copies, if it can.
+        shell(f"cp -a --reflink=auto {src} {dest}")
+        pathlib.Path(stamp_file).touch()
+        return True
+    return False
 
 
-def remove_latest(s):
-    """Remove the '_latest' from the end of a string, if present."""
-    if s.endswith("_latest"):
-        s = s[:-7]
-    return s
+# The ioctl request that makes a file share (clone) another file's data blocks, on file systems
+# that support it (e.g., btrfs and XFS).
+FICLONE = 0x40049409
+
+# The ways in which stage_file() can stage a file, in order of preference: a reflink (which
+# shares the data blocks, but is still an independent file), a hard link, or a full copy.
+STAGING_METHODS = ["reflink", "hardlink", "copy"]
 
 
-def build_yocto(spec, board, module):
+def stage_file(src, dest):
     """
-    Build a custom Yocto-based distro.
-    The output of this, if any, is a set of leaf packages for the toolchain, kernel,
-    root file system, etc., added to the leaf "remote".
-    """
-    def fetch_yocto(yocto_spec, board, module):
-        """Fetch the source code for the Yocto toolchain, if it hasn't already been fetched."""
-        build_dir = yocto_build_dir(board, module)
-        # This can be very time consuming and requires a fast Internet connection,
-        # so checkpoint this.
-        checkpoint_file = f"{build_dir}/.fetched"
-        if not os.path.exists(checkpoint_file):
-            print(f"Fetching Yocto sources for mangOH {board} with {module}...")
-            prep_clean_dir(build_dir)
-            manifest_repo = yocto_spec["manifest_repo"]
-            base_manifest = yocto_spec["base_manifest"]
-            shell(f"repo init -u {manifest_repo} -m {base_manifest} && repo sync", cwd=build_dir)
-            for add_on in yocto_spec.get("add", []):
-                fetch_git_repo(add_on["url"], add_on["ref"], dest=f"{build_dir}/{add_on['dir']}")
-            # Checkpoint reached.
-            pathlib.Path(checkpoint_file).touch()
+    Put a file at dest with the same content and mode as the file at src, without copying the
+    data if the file system allows it. Only use this for files that won't be modified in place,
+    because dest may be a hard link to src. Returns the method used (one of STAGING_METHODS).
+    """
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        try:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            reflinked = True
+        except OSError:
+            reflinked = False
+    if reflinked:
+        shutil.copystat(src, dest)
+        return "reflink"
+    os.remove(dest)
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+    shutil.copy2(src, dest)
+    return "copy"
 
-    def package_toolchain(board, module):
-        """Build the leaf package for a module's toolchain."""
-        package_dir = f"{LEAF_STAGING_DIR}/{board}-{module}-toolchain"
-        prep_clean_dir(package_dir)
-        manifest_file = f"{package_dir}/manifest.json"
-        shutil.copy("toolchainManifest.json", manifest_file)
-        shell(f"MANGOH_BOARD={board} VERSION={version} TARGET={module} ./replaceVars {manifest_file}")
-        self_extracting_toolchain = glob.glob(
-            f"{yocto_build_dir(board, module)}/build_bin/tmp/deploy/sdk/"
-            "poky-swi-ext-glibc-x86_64-meta-toolchain-swi-armv7a-neon-toolchain-swi-*.sh")
-        assert len(self_extracting_toolchain) is 1
-        shutil.copy(self_extracting_toolchain[0], f"{package_dir}/toolChainExtractor.sh")
-        create_leaf_package(toolchain_package_id(board, module), package_dir)
 
-    def package_linux(board, module):
-        """Build the leaf package for a linux distro .cwe (kernel, root file system, etc.)."""
-        package_dir = f"{LEAF_STAGING_DIR}/{board}-{module}-linux"
-        prep_clean_dir(package_dir)
-        manifest_file = f"{package_dir}/manifest.json"
-        shutil.copy("linuxManifest.json", manifest_file)
-        shell(f"MANGOH_BOARD={board} VERSION={version} TARGET={module} ./replaceVars {manifest_file}")
-        shutil.copy(f"{yocto_build_dir(board, module)}/build_bin/tmp/deploy/images/swi-mdm9x28-wp/yocto_{module}.4k.cwe",
-                f"{package_dir}/linux.cwe")
-        create_leaf_package(linux_package_id(board, module), package_dir)
+def stage_tree(src, dest, exclude=()):
+    """
+    Stage the directory tree at src into dest (see stage_file()), skipping (without descending
+    into) any file or directory whose name matches one of the glob patterns in exclude.
+    Symbolic links are reproduced, not followed. Prints and returns a dict mapping each of the
+    STAGING_METHODS to the number of bytes staged that way.
+    """
+    staged_bytes = dict.fromkeys(STAGING_METHODS, 0)
 
-    yocto_spec = spec["boards"][board][module].get("yocto")
-    if yocto_spec:
-        build_dir = yocto_build_dir(board, module)
-        # This can be slow, even when already built, so checkpoint it.
-        checkpoint_file = f"{build_dir}/.built"
-        if not os.path.exists(checkpoint_file):
-            fetch_yocto(yocto_spec, board, module)
-            print(f"Building Yocto distro for mangOH {board} with {module}...")
-            #shell("USE_DOCKER=1 make image_bin", cwd=build_dir)
-            #shell("USE_DOCKER=1 make toolchain_bin", cwd=build_dir)
-            shell("make image_bin", cwd=build_dir)
-            shell("make toolchain_bin", cwd=build_dir)
-            package_toolchain(board, module)
-            package_linux(board, module)
-            # Checkpoint reached.
-            pathlib.Path(checkpoint_file).touch()
+    def excluded(name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+    for directory, subdirs, files in os.walk(src):
+        dest_dir = os.path.join(dest, os.path.relpath(directory, src))
+        os.makedirs(dest_dir, exist_ok = True)
+        shutil.copystat(directory, dest_dir)
+        subdirs[:] = [name for name in subdirs if not excluded(name)]
+        for name in list(subdirs):
+            # os.walk() doesn't follow symbolic links to directories, but lists them as dirs.
+            if os.path.islink(f"{directory}/{name}"):
+                os.symlink(os.readlink(f"{directory}/{name}"), f"{dest_dir}/{name}")
+                subdirs.remove(name)
+        for name in files:
+            if excluded(name):
+                continue
+            path = f"{directory}/{name}"
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), f"{dest_dir}/{name}")
+            else:
+                method = stage_file(path, f"{dest_dir}/{name}")
+                staged_bytes[method] += os.path.getsize(path)
+    report_staging(dest, staged_bytes)
+    return staged_bytes
 
 
-def fetch_legato(spec):
+def report_staging(dest, staged_bytes):
+    """Print how much data was staged into dest and how much copying was saved."""
+    saved = staged_bytes.get("reflink", 0) + staged_bytes.get("hardlink", 0)
+    print(f"Staged {sum(staged_bytes.values()) / 1024**2:.1f} MiB into {dest}"
+          f" ({saved / 1024**2:.1f} MiB shared with the original, not copied).")
+
+
+class LeafRemote:
     """
-    Fetch and patch up the Legato sources in LEGATO_ROOT.
+    The local leaf remote into which the packages we build are placed.
+
+    Re-indexing the remote every time a package is added or removed would re-read every package
+    built so far, so instead the changes are just recorded, and the index (mangOH.json) is
+    regenerated once, when something actually needs to read it (see refresh()).
+    The index is generated from the ".leaf.info" metadata file that "leaf build pack" writes next
+    to each package, which holds the package's entry in the index, so the package archives
+    themselves don't have to be re-read. Only if a package has no such metadata file does the
+    whole remote get re-indexed with "leaf build index".
+
+    Builds for different boards and modules may be running concurrently, so all changes to
+    the remote are serialized.
     """
+    def __init__(self, remote_dir):
+        self.remote_dir = remote_dir
+        self.lock = threading.Lock()
+        # Maps package file name to its index entry. None until loaded from the remote.
+        self.entries = None
+        self.dirty = True
+        # Incremented every time the index is regenerated, so the workspaces that use the remote
+        # can tell whether they have fetched the latest index (see LeafProfile).
+        self.generation = 0
 
-    def apply_patch(patch_spec):
+    def _load_entry(self, package_file):
+        """Get a package's index entry from its .info file, or None if it doesn't have one."""
+        info_file = f"{self.remote_dir}/{package_file}.info"
+        if not os.path.exists(info_file):
+            return None
+        with open(info_file) as f:
+            entry = json.load(f)
+        # The package may have been renamed since it was packed (e.g., the Octave packages).
+        entry["file"] = package_file
+        return entry
+
+    def _load(self):
+        """Make sure the index entries for the packages already in the remote are loaded."""
+        if self.entries is None:
+            os.makedirs(self.remote_dir, exist_ok = True)
+            self.entries = {}
+            for package_path in glob.glob(f"{self.remote_dir}/*.leaf"):
+                package_file = os.path.basename(package_path)
+                self.entries[package_file] = self._load_entry(package_file)
+
+    def add(self, package_files):
         """
-        Apply a patch to the Legato source tree, as specified in a member of the "patches" list.
+        Move a list of package files (.leaf files and their .leaf.info files) into the remote.
+        The files must be on the same file system as the remote.
         """
+        with self.lock:
+            self._load()
+            for package_path in package_files:
+                os.replace(package_path, f"{self.remote_dir}/{os.path.basename(package_path)}")
+            for package_path in package_files:
+                package_file = os.path.basename(package_path)
+                if package_file.endswith(".leaf"):
+                    self.entries[package_file] = self._load_entry(package_file)
+            self.dirty = True
 
-        def cherry_pick(path, cherry_pick_spec):
-            assert(isinstance(cherry_pick_spec, str))
-            shell(f"git cherry-pick {cherry_pick_spec}", cwd=path)
+    def remove(self, package_id):
+        """
+        Remove a package from the remote, if it's there.
+        The package_id should include the version, but NOT the '.leaf' suffix.
+        """
+        with self.lock:
+            self._load()
+            package_file = f"{package_id}.leaf"
+            for path in glob.glob(f"{self.remote_dir}/{glob.escape(package_file)}*"):
+                os.remove(path)
+            if self.entries.pop(package_file, 0) != 0:
+                self.dirty = True
 
-        def apply_gerrit_changeset(path, gerrit_review_spec):
-            project = gerrit_review_spec.get("project")
-            if not isinstance(project, str):
-                raise TypeError("'project' is not a string in gerrit_review patch.")
-            patch_set = gerrit_review_spec.get("patch_set")
-            if not isinstance(patch_set, str):
-                raise TypeError("'patch_set' is not a string in gerrit_review patch.")
-            command = ( f'git fetch "ssh://{gerrit_user}@master.gerrit.legato:29418/{project}"'
-                        f' refs/changes/{patch_set}'
-                        f' && git cherry-pick FETCH_HEAD' )
-            shell(command, cwd=path)
-
-        # If "dir" is missing or empty, the patch should be applied directly to LEGATO_ROOT.
-        subdir = patch_spec.get("dir")
-        path = LEGATO_ROOT
-        if subdir not in [ None, "", "."]:
-            if not isinstance(subdir, str):
-                raise TypeError("dir is not a string")
-            path = f"{path}/{subdir}"
-        print(f"Applying patch to {path}")
-        print("Reason:", patch_spec.get("purpose"))
-        cherry_pick_spec = patch_spec.get("cherry_pick")
-        gerrit_review_spec = patch_spec.get("gerrit_review")
-        if cherry_pick_spec and gerrit_review_spec:
-            raise AssertionError("Both gerrit_review and cherry_pick used"
-                                 " in same patch specification.")
-        elif cherry_pick_spec:
-            cherry_pick(path, cherry_pick_spec)
-        elif gerrit_review_spec:
-            apply_gerrit_changeset(path, gerrit_review_spec)
-        else:
-            raise AssertionError("Neither gerrit_review nor cherry_pick found"
-                                 " in patch specification.")
+    def refresh(self):
+        """
+        Regenerate the index, if the remote has changed since it was last generated.
+        The index is replaced atomically, because other builds may be reading it at the same time.
+        """
+        with self.lock:
+            self._load()
+            if not self.dirty:
+                return
+            new_index_file = f"{self.remote_dir}/.mangOH-new.json"
+            if None in self.entries.values():
+                shell("leaf build index -o .mangOH-new.json *.leaf", cwd=self.remote_dir)
+            else:
+                index = {
+                    "info": {"date": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())},
+                    "packages": [self.entries[name] for name in sorted(self.entries)],
+                }
+                with open(new_index_file, "w") as f:
+                    json.dump(index, f, indent=4)
+            os.replace(new_index_file, f"{self.remote_dir}/mangOH.json")
+            self.dirty = False
+            self.generation += 1
 
-    legato_spec = spec.get("legato")
-    if legato_spec:
-        # Fetching all Legato sources takes a while and requires a solid Internet connection,
-        # so checkpoint it.
-        checkpoint_file = f"{LEGATO_REPO_ROOT}/.fetched"
-        if not os.path.exists(checkpoint_file):
-            prep_clean_dir(LEGATO_REPO_ROOT)
-            manifest_repo = legato_spec["manifest_repo"]
-            base_manifest = legato_spec["base_manifest"]
-            # Get the Legato sources
-            shell(f"repo init -u {manifest_repo} -m {base_manifest} && repo sync",
-                  cwd=LEGATO_REPO_ROOT)
-            # Patch it up.
-            patches = legato_spec.get("patches")
-            if not isinstance(patches, list):
-                raise TypeError("legato patches list is not a list")
-            for patch in patches:
-                if not isinstance(patch, dict):
-                    raise TypeError("legato patch list entry is not a JSON object")
-                apply_patch(patch)
-            # Checkpoint reached.
-            pathlib.Path(checkpoint_file).touch()
-
-
-# Cached legato version string.
-# Don't use this directly. Call get_legato_version().
-_legato_version = None
 
-def get_legato_version():
+# The LeafRemote of each leaf remote directory. Don't use this directly. Call get_leaf_remote().
+_leaf_remotes = {}
+_leaf_remotes_lock = threading.Lock()
+
+def get_leaf_remote(remote_dir):
     """
-    Get the legato version string.
+    Get the LeafRemote for a leaf remote directory. There is only one per directory, so that
+    a long-running process (see BuildDaemon) only loads each remote's index entries once.
     """
-    global _legato_version
-    # If we've fetched it already, don't re-fetch it.
-    if not _legato_version:
-        # Extract the version string from Legato's "version" file.
-        with open(f"{LEGATO_ROOT}/version", "r") as f:
-            _legato_version = f.readline().strip()
-        assert _legato_version
-    return _legato_version
+    with _leaf_remotes_lock:
+        if remote_dir not in _leaf_remotes:
+            _leaf_remotes[remote_dir] = LeafRemote(remote_dir)
+        return _leaf_remotes[remote_dir]
+
+
+# The compression programs that tar can be told to use when packing leaf packages, by name.
+# Leaf must be able to read the packages, and it understands xz and gzip, so the parallel
+# compressors here all produce standard xz or gzip streams.
+COMPRESSORS = {
+    "xz": "xz",
+    "xz-mt": "xz -T0",
+    "pixz": "pixz",
+    "gzip": "gzip",
+    "pigz": "pigz",
+}
 
-def build_legato(spec, board, module):
+# The types of leaf package that we pack, each of which can be given its own compressor in the
+# "packing" member of the spec.
+PACKAGE_TYPES = ["toolchain", "linux", "legato", "master", "delta"]
+
+
+def get_compressor(spec, package_type):
     """
-    Build the custom Legato framework for a specific module using the appropriate toolchain
-    for the board and module. The output of this is a leaf package for Legato.
+    Get the name of the compressor (see COMPRESSORS) to use when packing a type of package.
+    The spec's optional "packing" member can name a compressor for each package type, plus a
+    "default" for the others. Without one, the multi-threaded xz compressor is used.
     """
-    legato_spec = spec.get("legato")
-    if legato_spec:
-        print(f"Building the Legato Framework for {module} on {board}...")
-        # If there's a Legato leaf package for this board+module in the remote already,
-        # remove it.
-        package_id = legato_package_id(board, module)
-        remove_leaf_package(package_id)
-        # Clean the legato directory, because it may have been built for the same target
-        # already but with a different toolchain for a different module.
-        shell("make clean", cwd=LEGATO_ROOT)
-        # Before we can run the build, we need to set up the leaf workspace with a profile that
-        # contains all the required packages.
-        with LeafProfile(get_depends(spec, board, module)):
-            shell(f"leaf shell -c 'make {module}'", cwd=LEGATO_ROOT)
-            # Package as leaf package and add to remote.
-            legato_version = get_legato_version()
-            package_dir = f"{LEAF_STAGING_DIR}/{board}-{module}-legato"
-            if os.path.exists(package_dir):
-                shutil.rmtree(package_dir)
-            shell(f"cp -r {LEGATO_ROOT} {package_dir}")
-            shutil.rmtree(f"{package_dir}/.git")
-            shutil.copy("legatoManifest.json", f"{package_dir}/manifest.json")
-            shell(f"MANGOH_BOARD={board} VERSION={version} TARGET={module} "
-                  f"LEGATO_VERSION={legato_version} ./replaceVars {package_dir}/manifest.json")
-            create_leaf_package(package_id, package_dir)
-
-
-def fetch_octave(spec):
-    """Fetch the Octave Edge Package sources."""
-    checkpoint_file = f"{OCTAVE_ROOT}/.fetched"
-    if not os.path.exists(checkpoint_file):
-        prep_clean_dir(OCTAVE_ROOT)
-        fetch_git_repo("git@github.com:flowthings/brkedgepkg.git",
-                       spec["octave"]["ref"],
-                       dest=OCTAVE_ROOT)
-        # Checkpoint reached.
-        pathlib.Path(checkpoint_file).touch()
+    packing_spec = spec.get("packing", {})
+    compressor = packing_spec.get(package_type, packing_spec.get("default", "xz-mt"))
+    if compressor not in COMPRESSORS:
+        raise ValueError(f"Unknown compressor '{compressor}' for {package_type} packages."
+                         f" Expected one of: {', '.join(COMPRESSORS)}.")
+    return compressor
 
 
-def build_octave(spec, board, module):
+def create_leaf_package(release, package_id, staging_dir, compressor):
     """
-    Build the Octave Edge Package apps and create a Leaf package containing them.
+    Create a package file in the release's leaf remote with a given package_id whose files are
+    waiting in the staging_dir, compressed using the named compressor (see COMPRESSORS).
+    The package_id should include the version, but NOT the '.leaf' suffix.
     """
-    print(f"Building the Octave Edge Package for {module} on {board}...")
-    # If there's an Octave leaf package for this board+module in the remote already, remove it.
-    package_id = octave_package_id(board, module)
-    remove_leaf_package(package_id)
-    # It seems that it is necessary to clean the brkedgepkg between each
-    # build for a different module. I suspect that the build system for
-    # jerryscript isn't smart enough to know that it needs to re-build
-    # certain artifacts when the toolchain is swapped out.
-    force_clean_git_repo(OCTAVE_ROOT)
-    shell("make clean", cwd=OCTAVE_ROOT)
-    depends = get_depends(spec, board, module)
-    depends.append(legato_package_id(board, module))
-    with LeafProfile(depends):
-        octave_version = spec["octave"]["version"]
-        shell('leaf shell -c leaf profile', cwd=BUILD_DIR)
-        shell('leaf shell -c leaf env', cwd=BUILD_DIR)
-        cmd = (
-            f"leaf shell -c 'make MANGOH_ROOT={MANGOH_ROOT} DHUB_ROOT={DHUB_ROOT}"
-            f" MANGOH_BOARD={board} VERSION={octave_version}'"
-        )
-        shell(cmd, cwd=OCTAVE_ROOT)
-    # The Octave build already creates the leaf packages, so they just need to be
-    # copied into remote.
-    shutil.copy(
-        f"{OCTAVE_ROOT}/build/Octave-mangOH-{board}-{module}.leaf",
-        f"{LEAF_REMOTE}/{package_id}.leaf")
-    shutil.copy(
-        f"{OCTAVE_ROOT}/build/Octave-mangOH-{board}-{module}.leaf.info",
-        f"{LEAF_REMOTE}/{package_id}.leaf.info")
-    index_leaf_remote()
-
-
-def fetch_mangoh(spec):
-    """Fetch the mangOH sources."""
-    checkpoint_file = f"{MANGOH_ROOT}/.fetched"
-    if not os.path.exists(checkpoint_file):
-        prep_clean_dir(MANGOH_ROOT)
-        fetch_git_repo("git@github.com:mangOH/mangOH.git",
-                       spec["mangoh"]["ref"],
-                       dest=MANGOH_ROOT)
-        for download in spec["mangoh"]["wget"]:
-            url = download["url"]
-            dest_dir = f"{MANGOH_ROOT}/{download['dir']}"
-            shell(f"wget {url}", cwd=dest_dir)
-            if download.get("unpack") == "unzip":
-                shell(f"unzip {os.path.basename(url)}", cwd=dest_dir)
-        # Checkpoint reached.
-        pathlib.Path(checkpoint_file).touch()
+    # Pack outside of the remote so that a half-written package never gets indexed by a
+    # concurrent build.
+    package_file = f"{release.staging_dir}/{package_id}.leaf"
+    shell(f"leaf build pack -o {package_file} -i {staging_dir}"
+          f" -- '--use-compress-program={COMPRESSORS[compressor]}' .")
+    release.leaf_remote.add(glob.glob(f"{package_file}*"))
 
 
-def build_mangoh(spec, board, module):
+def create_leaf_packages(packages):
     """
-    Build the factory .spk files for both the Octave and non-Octave versions for a particular
-    mangOH board and module. Generate the master leaf package and add it to the leaf remote.
+    Create several leaf packages at the same time. packages is a list of tuples containing the
+    arguments to create_leaf_package().
     """
-    module_spec = spec["boards"][board][module]
-    module_abbreviation = get_abbreviated_module(module)
-    staging_dir = f"{LEAF_STAGING_DIR}/{board}-{module}-master"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(packages)) as pool:
+        futures = [pool.submit(BuildReport.current().bind_stage(create_leaf_package), *package)
+                   for package in packages]
+        for future in futures:
+            future.result()
 
-    def get_requires_list():
-        """
-        Get a list of strings, each of which contains the ID of a leaf package that
-        should be in the "requires" list of the master package.
-        """
-        return spec["mangoh"]["requires"] + module_spec.get("requires", [])
 
-    def get_modem_firmware():
+def benchmark_compressors(staging_dirs):
+    """
+    Compare the compressors in COMPRESSORS (and zstd, which leaf can't read yet, for reference)
+    by packing and unpacking each of the staging_dirs with each of them, printing the size of
+    the archive and the time taken to pack and unpack it.
+    """
+    compressors = dict(COMPRESSORS, zstd="zstd -T0")
+    for staging_dir in staging_dirs:
+        size = int(shell_output(f"du -sb {staging_dir}").split()[0])
+        print(f"{staging_dir} ({size / 1024**2:.1f} MiB):")
+        print(f"    {'compressor':<12} {'size (MiB)':>12} {'ratio':>7} {'pack (s)':>10}"
+              f" {'unpack (s)':>11}")
+        for name, program in compressors.items():
+            if not shutil.which(program.split()[0]):
+                print(f"    {name:<12} (not installed)")
+                continue
+            work_dir = f"{BUILD_DIR}/packing-benchmark"
+            prep_clean_dir(f"{work_dir}/unpacked")
+            archive = f"{work_dir}/archive"
+            start_time = time.time()
+            shell(f"tar -c '--use-compress-program={program}' -f {archive} .", cwd=staging_dir)
+            pack_time = time.time() - start_time
+            start_time = time.time()
+            shell(f"tar -x '--use-compress-program={program}' -f {archive}",
+                  cwd=f"{work_dir}/unpacked")
+            unpack_time = time.time() - start_time
+            archive_size = os.path.getsize(archive)
+            print(f"    {name:<12} {archive_size / 1024**2:>12.1f}"
+                  f" {size / max(archive_size, 1):>7.2f} {pack_time:>10.1f} {unpack_time:>11.1f}")
+            shutil.rmtree(work_dir)
+
+
+def remove_leaf_package(release, package_id):
+    """
+    Remove a package from the release's leaf remote and the installed packages, and remove it
+    from the leaf cache. The rest of the cache is left alone, so other packages don't have to be
+    downloaded again. The package_id should include the version, but NOT the '.leaf' suffix.
+    """
+    release.leaf_remote.remove(package_id)
+    with leaf_install_lock:
+        for cached_file in glob.glob(f"{LEAF_CACHE}/**/*{glob.escape(package_id)}.leaf*",
+                                     recursive=True):
+            os.remove(cached_file)
+        shell(f"rm -rf {LEAF_USER_ROOT}/{package_id}")
+
+
+# The leaf workspaces that prepare_leaf_workspace() has already set up in this process.
+_prepared_workspaces = set()
+
+def prepare_leaf_workspace(release, board, module):
+    """
+    Set up the board and module's leaf workspace and sandbox, with the local file system
+    directory into which we place the leaf packages we create for the release added as a leaf
+    remote. This only needs doing once per process (see BuildDaemon), unless the workspace's leaf
+    configuration has been removed.
+    """
+    workspace = target_dir(release, board, module)
+    if (workspace in _prepared_workspaces
+            and os.path.exists(f"{workspace}/leaf/config")):
+        return
+    os.makedirs(workspace, exist_ok = True)
+    env = leaf_env(release, board, module)
+    shell("leaf remote remove local 2> /dev/null", cwd=workspace, check=False, env=env)
+    shell(f"leaf remote add local file://{release.leaf_remote.remote_dir}/mangOH.json",
+          cwd=workspace, env=env)
+    _prepared_workspaces.add(workspace)
+
+
+class LeafProfile:
+    """
+    Used to select a leaf profile containing the base_packages using a "with" block.
+    The profile is set up in the leaf workspace of a given board and module in a release.
+
+    Profiles are pooled rather than deleted after use: each distinct list of packages gets its
+    own profile, named after a hash of the list, which is kept in the workspace. Re-entering a
+    profile just syncs it, which only installs the packages that are missing (e.g., because they
+    were rebuilt and removed by remove_leaf_package()). Packages already installed for any board
+    and module are reused.
+
+    The workspace's remote indexes are only fetched again if the local remote's index has been
+    regenerated, or the build has started (see BuildReport.refresh_after), since they were last
+    fetched.
+    """
+
+    # Maps each workspace to a tuple containing the generation of the local remote's index (see
+    # LeafRemote) that it last fetched and when it fetched it. Must be used with the
+    # leaf_install_lock held.
+    fetched = {}
+
+    def __init__(self, base_packages, release, board, module):
+        # Remove duplicates, but keep the order.
+        self.packages = list(dict.fromkeys(map(remove_latest, base_packages)))
+        packages_hash = hashlib.sha1(" ".join(self.packages).encode()).hexdigest()[:12]
+        self.name = f"mangOH-{packages_hash}"
+        self.release = release
+        self.board = board
+        self.module = module
+        self.leaf_remote = release.leaf_remote
+        self.workspace = target_dir(release, board, module)
+        self.env = leaf_env(release, board, module)
+        self.data_dir = leaf_data_dir(release, board, module)
+        # The key of the toolchain and its wrapper directories (see
+        # CompilerCache.toolchain_dirs()), once shell() has looked them up for compiler_cache.
+        self.toolchain = None
+
+    def __enter__(self):
+        self.leaf_remote.refresh()
+        with leaf_install_lock:
+            generation, fetch_time = self.fetched.get(self.workspace, (None, 0))
+            if (generation != self.leaf_remote.generation
+                    or fetch_time < BuildReport.current().refresh_after):
+                fetch_time = time.time()
+                shell("leaf remote fetch", cwd=self.workspace, env=self.env)
+                self.fetched[self.workspace] = (self.leaf_remote.generation, fetch_time)
+            if os.path.isdir(f"{self.data_dir}/{self.name}"):
+                shell(f"leaf select {self.name} && yes | leaf profile sync",
+                      cwd=self.workspace, env=self.env)
+            else:
+                package_args = ' '.join([f'-p {pkg} ' for pkg in self.packages])
+                shell(f"yes | leaf setup {self.name} {package_args}",
+                      cwd=self.workspace, env=self.env)
+        return self
+
+    def __exit__(self, exception_type, value, traceback):
+        pass
+
+    def shell(self, cmd, cwd):
+        """
+        Run a shell command inside a leaf shell for this profile. If compiler_cache is set, the
+        cross compilers that the command runs go through it.
+        """
+        if not compiler_cache:
+            shell(f"leaf shell -c '{cmd}'", cwd=cwd, env=self.env)
+            return
+        if self.toolchain is None:
+            self.toolchain = (get_toolchain_key(self.release, self.board, self.module),
+                              compiler_cache.toolchain_dirs(self.workspace, self.env))
+        toolchain_key, toolchain_dirs = self.toolchain
+        with compiler_cache.in_use(toolchain_key) as stats_log:
+            wrapped_cmd = compiler_cache.command(cmd, toolchain_key, toolchain_dirs, stats_log)
+            shell(f"leaf shell -c '{wrapped_cmd}'", cwd=cwd, env=self.env)
+
+
+def get_depends(release, board, module):
+    """
+    Get a list of strings, each of which contains the ID of a leaf package that
+    the release spec says a given board and module depends on.
+    """
+    mangoh_spec = release.spec["mangoh"]
+    module_spec = release.spec["boards"][board][module]
+    depends = mangoh_spec["depends"] + module_spec.get("depends", [])
+    yocto_spec = module_spec.get("yocto")
+    if yocto_spec:
+        depends.append(toolchain_package_id(release, board, module))
+        depends.append(linux_package_id(release, board, module))
+    return depends
+
+
+def get_toolchain_package(release, board, module):
+    """Get the ID of the toolchain leaf package used to build software for a board and module."""
+    toolchains = [pkg for pkg in get_depends(release, board, module) if "-toolchain_" in pkg]
+    if len(toolchains) != 1:
+        raise ValueError(f"Expected exactly one toolchain package for {module} on {board},"
+                         f" found {toolchains}.")
+    return toolchains[0]
+
+
+def get_legato_board(release, board, module):
+    """
+    Building Legato only depends on the module, the toolchain and the Legato sources, so all the
+    boards that use the same toolchain for a module share one Legato build directory (see
+    legato_build_dir()) and leaf package. Get the board that the shared build and package are
+    named after: the first board in the release spec that uses the module with the same
+    toolchain.
+    """
+    build_dir = legato_build_dir(release, board, module)
+    for other_board, board_spec in release.spec["boards"].items():
+        if module in board_spec and legato_build_dir(release, other_board, module) == build_dir:
+            return other_board
+
+
+def remove_latest(s):
+    """Remove the '_latest' from the end of a string, if present."""
+    if s.endswith("_latest"):
+        s = s[:-7]
+    return s
+
+
+def yocto_source_inputs(yocto_spec):
+    """Get the inputs that determine what Yocto sources get fetched."""
+    manifest_commit = resolve_git_ref(yocto_spec["manifest_repo"])
+    return {
+        "spec": yocto_spec,
+        "manifest_commit": manifest_commit,
+        "project_commits": manifest_project_commits(
+            yocto_spec["manifest_repo"], manifest_commit, yocto_spec["base_manifest"]),
+        "add_commits": [resolve_git_ref(add_on["url"], add_on["ref"])
+                        for add_on in yocto_spec.get("add", [])],
+    }
+
+
+def yocto_tree_key(source_inputs):
+    """
+    Compute the key identifying what gets built in a Yocto build tree from sources fetched with
+    the given source_inputs. This doesn't depend on the release, so the tree can be shared.
+    """
+    return build_stage_key("build yocto tree", source_inputs)
+
+
+def yocto_build_key(release, board, module, source_inputs):
+    """
+    Compute the key identifying the Yocto leaf packages built for a board and module in a release
+    from sources fetched with the given source_inputs.
+    """
+    variables = manifest_variables(release, board, module)
+    return build_stage_key("build yocto", {
+        "sources": source_inputs,
+        "manifests": [render_manifest(template, variables)
+                      for template in ["toolchainManifest.json", "linuxManifest.json"]],
+    })
+
+
+class YoctoCaches:
+    """
+    The Yocto download directory (DL_DIR) and shared state cache (SSTATE_DIR) shared by all the
+    Yocto builds, for all boards, modules and releases. They are kept outside of BUILD_DIR, so
+    they survive a "make clean", and BitBake only has to run the tasks whose inputs have changed
+    since any build ran them, and only downloads each source once.
+
+    Each build holds a shared lock on the caches (see in_use()), in this and any other process.
+    Whenever a build finishes, and no other build is running, the least recently used entries
+    are pruned until the caches fit within max_size bytes (see prune()).
+    """
+    def __init__(self, cache_dir, max_size):
+        self.download_dir = f"{cache_dir}/downloads"
+        self.sstate_dir = f"{cache_dir}/sstate-cache"
+        self.max_size = max_size
+        self.lock_file = f"{cache_dir}/.lock"
+        os.makedirs(self.download_dir, exist_ok = True)
+        os.makedirs(self.sstate_dir, exist_ok = True)
+
+    def configure(self, build_dir):
+        """
+        Point the Yocto build tree in build_dir at the shared caches. The tree's local.conf is
+        generated by its own build scripts, so the settings go in conf/auto.conf, which BitBake
+        reads along with it.
+        """
+        conf_dir = f"{build_dir}/build_bin/conf"
+        os.makedirs(conf_dir, exist_ok = True)
+        pathlib.Path(f"{conf_dir}/auto.conf").write_text(
+            "# Written by mangoh_release.py, to share these between all the Yocto builds.\n"
+            f'DL_DIR = "{self.download_dir}"\n'
+            f'SSTATE_DIR = "{self.sstate_dir}"\n')
+
+    @contextlib.contextmanager
+    def in_use(self):
+        """Used in a "with" block around a build that uses the caches."""
+        with open(self.lock_file, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.prune()
+
+    def _entries(self):
+        """
+        Get a dict mapping each entry in the caches to a list containing when it was last used
+        and its size. An entry is a file together with its ".done" (download finished) or
+        ".siginfo" (task signature) companion, or a whole git repository (e.g., in the download
+        directory's "git2" directory), which is named after the file or directory.
+        """
+        entries = {}
+        for cache_dir in [self.download_dir, self.sstate_dir]:
+            for directory, subdirs, files in os.walk(cache_dir):
+                if os.path.exists(f"{directory}/HEAD") and os.path.isdir(f"{directory}/objects"):
+                    subdirs[:] = []
+                    stats = [os.lstat(os.path.join(walk_dir, name))
+                             for walk_dir, _, walk_files in os.walk(directory)
+                             for name in walk_files]
+                    entries[directory] = [max([stat.st_mtime for stat in stats], default=0),
+                                          sum(stat.st_size for stat in stats)]
+                    continue
+                for name in files:
+                    path = os.path.join(directory, name)
+                    if path == self.lock_file:
+                        continue
+                    stat = os.lstat(path)
+                    entry = entries.setdefault(re.sub(r"\.(done|siginfo)$", "", path), [0, 0])
+                    entry[0] = max(entry[0], stat.st_atime, stat.st_mtime)
+                    entry[1] += stat.st_size
+        return entries
+
+    def prune(self):
+        """
+        Remove the least recently used entries from the caches until they fit within max_size,
+        unless a build is using them.
+        """
+        with open(self.lock_file, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = self._entries()
+            total_size = sum(size for _, size in entries.values())
+            removed = 0
+            for path, (_, size) in sorted(entries.items(), key=lambda entry: entry[1]):
+                if total_size <= self.max_size:
+                    break
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    for companion in [path, f"{path}.done", f"{path}.siginfo"]:
+                        if os.path.lexists(companion):
+                            os.remove(companion)
+                total_size -= size
+                removed += 1
+            if removed:
+                print(f"Pruned {removed} entries from the Yocto caches, leaving"
+                      f" {total_size / 1024**3:.1f} GiB.")
+
+
+# The YoctoCaches shared by the Yocto builds, or None if each build tree keeps its own.
+yocto_caches = None
+
+# The "Sstate summary" that BitBake logs at the start of a build, e.g.:
+# "Sstate summary: Wanted 1234 Local 1000 Mirrors 0 Missed 234 Current 10 (81% match, 1% complete)"
+# (older versions say "Found" instead of "Local", and don't have "Mirrors").
+SSTATE_SUMMARY_PATTERN = re.compile(
+    r"Sstate summary: Wanted (\d+) (?:Found|Local) (\d+)(?: Mirrors (\d+))? Missed (\d+)"
+    r" Current (\d+)")
+
+
+def sstate_stats(build_dir, since):
+    """
+    Add up the Sstate summaries logged by the BitBake runs in a Yocto build tree that started
+    after time since. Returns a dict with the numbers of tasks that were "wanted" from the shared
+    state cache, "found" in it, "missed" (and so had to be run), and already "current".
+    """
+    stats = dict.fromkeys(["wanted", "found", "missed", "current"], 0)
+    for log_file in glob.glob(f"{build_dir}/build_bin/tmp/log/cooker/*/*.log"):
+        if os.path.getmtime(log_file) < since:
+            continue
+        for match in SSTATE_SUMMARY_PATTERN.finditer(pathlib.Path(log_file).read_text()):
+            wanted, found, mirrors, missed, current = match.groups()
+            stats["wanted"] += int(wanted)
+            stats["found"] += int(found) + int(mirrors or 0)
+            stats["missed"] += int(missed)
+            stats["current"] += int(current)
+    return stats
+
+
+def report_sstate(board, module, stats):
+    """Print the sstate hit rate of a Yocto build and record it in the build report."""
+    hit_rate = 100 * stats["found"] / stats["wanted"] if stats["wanted"] else 0
+    print(f"Yocto shared state for mangOH {board} with {module}: {stats['found']} of"
+          f" {stats['wanted']} tasks restored ({hit_rate:.0f}% hit rate), {stats['missed']}"
+          f" missed, {stats['current']} already current.")
+    BuildReport.current().record("sstate", dict(stats, hit_rate=hit_rate))
+
+
+def yocto_toolchain_file(build_dir):
+    """Get the path to the self-extracting toolchain built in a Yocto build tree."""
+    self_extracting_toolchain = glob.glob(
+        f"{build_dir}/build_bin/tmp/deploy/sdk/"
+        "poky-swi-ext-glibc-x86_64-meta-toolchain-swi-armv7a-neon-toolchain-swi-*.sh")
+    assert len(self_extracting_toolchain) == 1
+    return self_extracting_toolchain[0]
+
+
+def yocto_linux_file(build_dir, module):
+    """Get the path to the linux distro .cwe built for a module in a Yocto build tree."""
+    return f"{build_dir}/build_bin/tmp/deploy/images/swi-mdm9x28-wp/yocto_{module}.4k.cwe"
+
+
+def fetch_yocto_tree(yocto_spec, board, module, build_dir, source_inputs):
+    """Fetch the Yocto sources for a board and module into build_dir, if not already fetched."""
+    def fetch():
+        repo_sync(yocto_spec["manifest_repo"], yocto_spec["base_manifest"], build_dir,
+                  source_inputs["manifest_commit"])
+        for add_on, commit in zip(yocto_spec.get("add", []), source_inputs["add_commits"]):
+            fetch_git_repo(add_on["url"], commit, dest=f"{build_dir}/{add_on['dir']}")
+
+    checkpointed_fetch(f"Yocto {board} {module}", build_dir, source_inputs, fetch)
+
+
+def fetch_yocto(release, board, module):
+    """
+    Fetch the Yocto sources for a board and module in a release, ahead of its build (see
+    build_graph()). Nothing is fetched if the tree has already been built from the same sources,
+    if what would be built from it can be restored from the build cache, or if the tree is built
+    elsewhere (see Executor).
+    """
+    yocto_spec = release.spec["boards"][board][module].get("yocto")
+    if not yocto_spec or not executor.fetches_locally:
+        return
+    build_dir = yocto_build_dir(release, board, module)
+    source_inputs = yocto_source_inputs(yocto_spec)
+    if read_checkpoint(f"{build_dir}/.built") == yocto_tree_key(source_inputs):
+        return
+    if build_cache and build_cache.contains(
+            yocto_build_key(release, board, module, source_inputs)):
+        return
+    fetch_yocto_tree(yocto_spec, board, module, build_dir, source_inputs)
+
+
+def build_yocto_tree(yocto_spec, board, module, build_dir, source_inputs, tree_key):
+    """
+    Fetch the Yocto sources for a board and module into build_dir and build the distro and
+    toolchain there, unless that has already been done with the same tree_key (see
+    yocto_tree_key()), which is recorded in a ".built" checkpoint file. If yocto_caches is set,
+    the build uses the shared caches. Returns the sstate statistics of the build (see
+    sstate_stats()), or None if there was nothing to build.
+    """
+    tree_checkpoint_file = f"{build_dir}/.built"
+    if read_checkpoint(tree_checkpoint_file) == tree_key:
+        return None
+    fetch_yocto_tree(yocto_spec, board, module, build_dir, source_inputs)
+    print(f"Building Yocto distro for mangOH {board} with {module}...")
+    start_time = time.time()
+    with yocto_caches.in_use() if yocto_caches else contextlib.nullcontext():
+        if yocto_caches:
+            yocto_caches.configure(build_dir)
+        #shell("USE_DOCKER=1 make image_bin", cwd=build_dir)
+        #shell("USE_DOCKER=1 make toolchain_bin", cwd=build_dir)
+        shell("make image_bin", cwd=build_dir)
+        shell("make toolchain_bin", cwd=build_dir)
+    pathlib.Path(tree_checkpoint_file).write_text(tree_key)
+    stats = sstate_stats(build_dir, start_time)
+    report_sstate(board, module, stats)
+    return stats
+
+
+def build_yocto(release, board, module):
+    """
+    Build a custom Yocto-based distro.
+    The output of this, if any, is a set of leaf packages for the toolchain, kernel,
+    root file system, etc., added to the release's leaf "remote".
+    The Yocto build tree may be shared with other releases being built (see
+    assign_shared_dirs()), in which case only the first of them builds it, and the others just
+    package what it built. The tree is built by the executor (see Executor), which may build
+    it on another machine, and only bring back what gets packaged.
+    """
+    spec = release.spec
+
+    def package_toolchain(board, module):
+        """
+        Stage the leaf package for a module's toolchain.
+        Returns the arguments to create_leaf_package() needed to pack it.
+        """
+        package_dir = f"{release.staging_dir}/{board}-{module}-toolchain"
+        prep_clean_dir(package_dir)
+        write_manifest("toolchainManifest.json", package_dir,
+                       manifest_variables(release, board, module))
+        staged_file = f"{package_dir}/toolChainExtractor.sh"
+        method = stage_file(yocto_toolchain_file(yocto_build_dir(release, board, module)),
+                            staged_file)
+        report_staging(staged_file, {method: os.path.getsize(staged_file)})
+        return (release, toolchain_package_id(release, board, module), package_dir,
+                get_compressor(spec, "toolchain"))
+
+    def package_linux(board, module):
+        """
+        Stage the leaf package for a linux distro .cwe (kernel, root file system, etc.).
+        Returns the arguments to create_leaf_package() needed to pack it.
+        """
+        package_dir = f"{release.staging_dir}/{board}-{module}-linux"
+        prep_clean_dir(package_dir)
+        write_manifest("linuxManifest.json", package_dir,
+                       manifest_variables(release, board, module))
+        staged_file = f"{package_dir}/linux.cwe"
+        method = stage_file(yocto_linux_file(yocto_build_dir(release, board, module), module),
+                            staged_file)
+        report_staging(staged_file, {method: os.path.getsize(staged_file)})
+        return (release, linux_package_id(release, board, module), package_dir,
+                get_compressor(spec, "linux"))
+
+    yocto_spec = spec["boards"][board][module].get("yocto")
+    if yocto_spec:
+        build_dir = yocto_build_dir(release, board, module)
+        package_ids = [toolchain_package_id(release, board, module),
+                       linux_package_id(release, board, module)]
+        remote_dir = release.leaf_remote.remote_dir
+        source_inputs = yocto_source_inputs(yocto_spec)
+        key = yocto_build_key(release, board, module, source_inputs)
+        # This can be slow, even when already built, so checkpoint it.
+        checkpoint_file = f"{target_dir(release, board, module)}/.yocto-packaged"
+        if (read_checkpoint(checkpoint_file) == key
+                and all(os.path.exists(f"{remote_dir}/{package_id}.leaf")
+                        for package_id in package_ids)):
+            return
+        cached_dir = f"{release.staging_dir}/{board}-{module}-yocto-cached"
+        prep_clean_dir(cached_dir)
+        if build_cache and build_cache.restore(key, cached_dir):
+            release.leaf_remote.add(glob.glob(f"{cached_dir}/*"))
+        else:
+            tree_key = yocto_tree_key(source_inputs)
+            if read_checkpoint(f"{build_dir}/.built") != tree_key:
+                executor.build_yocto_tree(yocto_spec, board, module, build_dir, source_inputs,
+                                          tree_key)
+            create_leaf_packages([package_toolchain(board, module), package_linux(board, module)])
+            if build_cache:
+                build_cache.store(key, [path for package_id in package_ids
+                                        for path in glob.glob(f"{remote_dir}/{package_id}.leaf*")])
+        # Checkpoint reached.
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok = True)
+        pathlib.Path(checkpoint_file).write_text(key)
+
+
+class Executor:
+    """
+    Builds Yocto trees (see build_yocto_tree()), the stages that take hours, for build_yocto().
+    Executors other than LocalExecutor build the trees elsewhere, and only bring back the files
+    that get packaged, so that builds for different modules can run on different machines.
+    """
+    # Whether the trees are built in the local build directories, so their sources should be
+    # fetched there ahead of the builds (see fetch_yocto()).
+    fetches_locally = False
+
+    def build_yocto_tree(self, yocto_spec, board, module, build_dir, source_inputs, tree_key):
+        """
+        Make sure that build_dir contains the files built for a board and module from the Yocto
+        sources fetched with source_inputs, and a ".built" checkpoint file holding tree_key.
+        """
+        raise NotImplementedError
+
+
+class LocalExecutor(Executor):
+    """Builds the Yocto trees right here, in this process."""
+    fetches_locally = True
+
+    def build_yocto_tree(self, yocto_spec, board, module, build_dir, source_inputs, tree_key):
+        build_yocto_tree(yocto_spec, board, module, build_dir, source_inputs, tree_key)
+
+
+def run_yocto_worker(request):
+    """
+    Build a Yocto tree for a WorkerExecutor, as described by a request made by
+    WorkerExecutor.build_yocto_tree(), in BUILD_DIR. Returns the result to send back, which gives
+    the path to the tree, the SHA-256 hash of each of the files in it that get packaged, and the
+    sstate statistics of the build (see sstate_stats()), if it had to be built.
+    """
+    build_dir = f"{BUILD_DIR}/{request['name']}"
+    stats = build_yocto_tree(request["spec"], request["board"], request["module"], build_dir,
+                             request["source_inputs"], request["tree_key"])
+    outputs = [yocto_toolchain_file(build_dir), yocto_linux_file(build_dir, request["module"])]
+    return {
+        "build_dir": build_dir,
+        "outputs": {os.path.relpath(path, build_dir): file_hash(path) for path in outputs},
+        "sstate": stats,
+    }
+
+
+class WorkerExecutor(Executor):
+    """
+    Builds the Yocto trees by running this script as a worker (with --yocto-worker, see
+    run_yocto_worker()) in each of a list of workers, one tree per worker at a time. A tree is
+    built by the worker that built it last, if that one is free, so that it gets rebuilt
+    incrementally, and otherwise by the free worker that has built the fewest trees, so the
+    trees for different modules get spread out. The files that get packaged are then copied back
+    into the local tree, and checked against the hashes the worker gives for them.
+    Subclasses say how to run a worker and how to copy files back from it.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.condition = threading.Condition()
+        self.busy = set()
+        # Maps the name of each Yocto build tree to the worker that built it last.
+        self.last_workers = {}
+
+    def _acquire(self, name):
+        """Wait for a worker to build the tree with the given name."""
+        with self.condition:
+            while len(self.busy) == len(self.workers):
+                self.condition.wait()
+            free = [worker for worker in self.workers if worker not in self.busy]
+            worker = self.last_workers.get(name)
+            if worker not in free:
+                assigned = list(self.last_workers.values())
+                worker = min(free, key=assigned.count)
+            self.busy.add(worker)
+            self.last_workers[name] = worker
+            return worker
+
+    def _release(self, worker):
+        with self.condition:
+            self.busy.remove(worker)
+            self.condition.notify_all()
+
+    def worker_command(self, request):
+        """Get the arguments of this script that make it run a request as a worker."""
+        return f"--yocto-worker {shlex.quote(json.dumps(request))}"
+
+    def run_worker(self, worker, request):
+        """Run a worker on a request. Returns the worker's standard output."""
+        raise NotImplementedError
+
+    def copy_output(self, worker, path, dest):
+        """Copy the file at path on a worker to dest."""
+        raise NotImplementedError
+
+    def describe(self, worker):
+        return worker
+
+    def build_yocto_tree(self, yocto_spec, board, module, build_dir, source_inputs, tree_key):
+        request = {
+            "name": os.path.basename(build_dir),
+            "spec": yocto_spec,
+            "board": board,
+            "module": module,
+            "source_inputs": source_inputs,
+            "tree_key": tree_key,
+        }
+        worker = self._acquire(request["name"])
+        try:
+            print(f"Building Yocto distro for mangOH {board} with {module}"
+                  f" on {self.describe(worker)}...")
+            result = json.loads(self.run_worker(worker, request))
+            if result["sstate"]:
+                report_sstate(board, module, result["sstate"])
+            prep_clean_dir(build_dir)
+            for path, sha256 in result["outputs"].items():
+                dest = f"{build_dir}/{path}"
+                os.makedirs(os.path.dirname(dest), exist_ok = True)
+                self.copy_output(worker, f"{result['build_dir']}/{path}", dest)
+                if file_hash(dest) != sha256:
+                    raise ValueError(f"{path} was corrupted when copied from"
+                                     f" {self.describe(worker)}.")
+        finally:
+            self._release(worker)
+        pathlib.Path(f"{build_dir}/.built").write_text(tree_key)
+
+
+class ProcessExecutor(WorkerExecutor):
+    """
+    A WorkerExecutor whose workers are separate processes on this machine, each with its own
+    work directory under BUILD_DIR/workers, sharing this build's cache and mirrors. This works
+    just like building on other machines, so it's a way of trying that out on one.
+    """
+    def __init__(self, count, options):
+        super().__init__([f"{BUILD_DIR}/workers/{i}" for i in range(1, count + 1)])
+        # The command line options that set up the build cache and mirrors.
+        self.options = options
+
+    def describe(self, worker):
+        return f"worker {os.path.basename(worker)}"
+
+    def run_worker(self, worker, request):
+        os.makedirs(worker, exist_ok = True)
+        return run_command(f"{sys.executable} {SCRIPT_DIR}/mangoh_release.py {self.options}"
+                           f" {self.worker_command(request)}", cwd=worker, capture_output=True)
+
+    def copy_output(self, worker, path, dest):
+        shell(f"cp --reflink=auto {path} {dest}")
+
+
+class SshExecutor(WorkerExecutor):
+    """
+    A WorkerExecutor whose workers are other Linux machines, reached with ssh (which must be able
+    to log in without prompting). Each worker builds in SSH_WORKER_DIR in the user's home
+    directory, using its own build cache and mirrors, and is sent a fresh copy of this script
+    every time. Python 3 and everything needed to build Yocto must be installed on it.
+    """
+    def run_worker(self, worker, request):
+        shell(f"ssh {worker} mkdir -p {SSH_WORKER_DIR}")
+        shell(f"scp -q {SCRIPT_DIR}/mangoh_release.py {worker}:{SSH_WORKER_DIR}/")
+        command = (f"cd {SSH_WORKER_DIR}"
+                   f" && GERRIT_USER={shlex.quote(os.environ.get('GERRIT_USER', ''))}"
+                   f" python3 mangoh_release.py {self.worker_command(request)}")
+        return run_command(f"ssh {worker} {shlex.quote(command)}", capture_output=True)
+
+    def copy_output(self, worker, path, dest):
+        shell(f"scp -q {worker}:{shlex.quote(path)} {dest}")
+
+
+def make_executor(description, options):
+    """
+    Get the Executor described by a --executor option value: "local", "processes:<count>", or
+    "ssh:<host>,<host>,...". options are the command line options that set up the build cache
+    and mirrors, for the process workers. Raises a ValueError if the description is invalid.
+    """
+    kind, _, workers = description.partition(":")
+    if kind == "local" and not workers:
+        return LocalExecutor()
+    if kind == "processes" and workers.isdigit() and int(workers) > 0:
+        return ProcessExecutor(int(workers), options)
+    if kind == "ssh" and workers:
+        return SshExecutor(workers.split(","))
+    raise ValueError(f"Invalid executor '{description}'. Expected local, processes:<count>,"
+                     f" or ssh:<host>,<host>,...")
+
+
+# The Executor that builds the Yocto trees.
+executor = LocalExecutor()
+
+
+def legato_source_inputs(spec):
+    """Get the inputs that determine what Legato sources get fetched (and patched)."""
+    legato_spec = spec["legato"]
+    manifest_commit = resolve_git_ref(legato_spec["manifest_repo"])
+    return {
+        "spec": legato_spec,
+        "manifest_commit": manifest_commit,
+        "project_commits": manifest_project_commits(
+            legato_spec["manifest_repo"], manifest_commit, legato_spec["base_manifest"]),
+    }
+
+
+class PatchSnapshots:
+    """
+    Snapshots of a source tree fetched with repo_sync(), taken as a list of patches is applied
+    to it, so that when the list changes, only the patches after the longest prefix that it shares
+    with a list applied before need to be applied, rather than fetching the whole tree again.
+
+    A snapshot records the HEAD commit of each git repository in the tree that has been patched,
+    keyed on the key of the unpatched tree and the patches applied so far. The commits stay in
+    their repositories, so restoring a snapshot is just a checkout. The snapshots are kept in a
+    ".patch-snapshots" file in root, which is only used if the unpatched tree has the same key.
+    """
+    def __init__(self, root, base_key):
+        self.root = root
+        self.base_key = base_key
+        self.snapshot_file = f"{root}/.patch-snapshots"
+        # Maps the path (relative to root) of each repository that has been patched to its HEAD
+        # commit before it was patched, or None if the snapshots aren't usable.
+        self.base_heads = None
+        # Maps the key of each list of patches applied to the snapshot taken after applying it.
+        self.snapshots = {}
+        try:
+            with open(self.snapshot_file) as f:
+                state = json.load(f)
+            if state["base"] == base_key:
+                self.base_heads = state["base_heads"]
+                self.snapshots = state["snapshots"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def start(self):
+        """Start over, with the unpatched tree just fetched into root."""
+        self.base_heads = {}
+        self.snapshots = {}
+        self._save()
+
+    def _save(self):
+        with open(self.snapshot_file, "w") as f:
+            json.dump({"base": self.base_key, "base_heads": self.base_heads,
+                       "snapshots": self.snapshots}, f)
+
+    def _key(self, patches):
+        return build_stage_key("patch", {"base": self.base_key, "patches": patches})
+
+    def _head(self, path):
+        return shell_output("git rev-parse HEAD", cwd=f"{self.root}/{path}").strip()
+
+    def restore_longest_prefix(self, patches):
+        """
+        Restore the snapshot taken after applying the longest prefix of a list of patches.
+        Returns the number of patches in that prefix, or None if no snapshot can be restored.
+        """
+        if self.base_heads is None:
+            return None
+        count = max(n for n in range(len(patches) + 1)
+                    if n == 0 or self._key(patches[:n]) in self.snapshots)
+        snapshot = self.snapshots.get(self._key(patches[:count]), {})
+        for path, base_head in self.base_heads.items():
+            # A patch that failed to apply may have left a cherry-pick in progress.
+            shell("git cherry-pick --quit", cwd=f"{self.root}/{path}", check=False)
+            shell(f"git checkout -q -f --detach {snapshot.get(path, base_head)}",
+                  cwd=f"{self.root}/{path}")
+        return count
+
+    def patching(self, path):
+        """Note that the repository at path (relative to root) is about to be patched."""
+        if path not in self.base_heads:
+            self.base_heads[path] = self._head(path)
+            self._save()
+
+    def take(self, patches):
+        """Take a snapshot after applying a list of patches."""
+        self.snapshots[self._key(patches)] = {path: self._head(path) for path in self.base_heads}
+        self._save()
+
+
+def legato_patch_dir(patch_spec):
+    """
+    Get the path, relative to the Legato root, of the repository that a member of the Legato
+    "patches" list applies to.
+    """
+    # If "dir" is missing or empty, the patch should be applied directly to the legato root.
+    subdir = patch_spec.get("dir")
+    if subdir in [None, "", "."]:
+        return "."
+    if not isinstance(subdir, str):
+        raise TypeError("dir is not a string")
+    return subdir
+
+
+def fetch_gerrit_changes(patches, root):
+    """
+    Fetch the Gerrit changes in a list of Legato patches into local refs (see
+    gerrit_change_ref()), with a single fetch from each project into each repository under
+    root (the Legato root), rather than one per change. The repositories are fetched into
+    concurrently.
+    """
+    # Maps each repository to a map of each Gerrit project to the patch sets fetched from it.
+    changes = {}
+    for patch_spec in patches:
+        gerrit_review_spec = patch_spec.get("gerrit_review")
+        if not gerrit_review_spec:
+            continue
+        project = gerrit_review_spec.get("project")
+        if not isinstance(project, str):
+            raise TypeError("'project' is not a string in gerrit_review patch.")
+        patch_set = gerrit_review_spec.get("patch_set")
+        if not isinstance(patch_set, str):
+            raise TypeError("'patch_set' is not a string in gerrit_review patch.")
+        projects = changes.setdefault(legato_patch_dir(patch_spec), {})
+        projects.setdefault(project, []).append(patch_set)
+
+    def fetch(path, projects):
+        for project, patch_sets in projects.items():
+            refspecs = " ".join(f"+refs/changes/{patch_set}:{gerrit_change_ref(patch_set)}"
+                                for patch_set in dict.fromkeys(patch_sets))
+            print(f"Fetching {len(patch_sets)} change(s) from {project} into {path}")
+            shell(f'git fetch "ssh://{gerrit_user}@master.gerrit.legato:29418/{project}"'
+                  f' {refspecs}', cwd=f"{root}/{path}")
+
+    if changes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(changes)) as pool:
+            for future in [pool.submit(fetch, path, projects)
+                           for path, projects in changes.items()]:
+                future.result()
+
+
+def gerrit_change_ref(patch_set):
+    """Get the local ref that fetch_gerrit_changes() fetches a Gerrit patch set into."""
+    return f"refs/mangoh-release/changes/{patch_set}"
+
+
+def legato_unpatched_key(inputs):
+    """Get the key identifying the Legato sources fetched with given inputs, before patching."""
+    spec = {name: value for name, value in inputs["spec"].items() if name != "patches"}
+    return fetch_stage_key("Legato (unpatched)", dict(inputs, spec=spec))
+
+
+def fetch_legato(release):
+    """
+    Fetch and patch up the Legato sources for a release.
+    The unpatched tree is snapshotted as each patch is applied (see PatchSnapshots), so when
+    only the patches change, the tree isn't fetched again, and only the patches after the
+    longest prefix of the list applied before are applied.
+    """
+
+    def apply_patch(patch_spec):
         """
-        Return a tuple containing:
-        1. the file system path to the modem firmware file to be used to build the SPK,
-        2. a string containing the modem firmware version number (e.g., "13.3").
+        Apply a patch to the Legato source tree, as specified in a member of the "patches" list.
+        Gerrit changes must have been fetched already (see fetch_gerrit_changes()).
         """
-        path = f"{LEAF_DATA}/current/{module_abbreviation}-modem-image/{module_spec['modem_firmware']}"
-        # The firmware version number can be found in the leaf manifest for the firmware package.
-        firmware_manifest = None
-        with open(f"{os.path.dirname(path)}/manifest.json") as json_file:
-            firmware_manifest = json.load(json_file)
-        release = firmware_manifest["info"]["version"]
-        return path, release
+        path = f"{release.legato_root}/{legato_patch_dir(patch_spec)}"
+        print(f"Applying patch to {path}")
+        print("Reason:", patch_spec.get("purpose"))
+        cherry_pick_spec = patch_spec.get("cherry_pick")
+        gerrit_review_spec = patch_spec.get("gerrit_review")
+        if cherry_pick_spec and gerrit_review_spec:
+            raise AssertionError("Both gerrit_review and cherry_pick used"
+                                 " in same patch specification.")
+        elif cherry_pick_spec:
+            assert(isinstance(cherry_pick_spec, str))
+            shell(f"git cherry-pick {cherry_pick_spec}", cwd=path)
+        elif gerrit_review_spec:
+            shell(f"git cherry-pick {gerrit_change_ref(gerrit_review_spec['patch_set'])}",
+                  cwd=path)
+        else:
+            raise AssertionError("Neither gerrit_review nor cherry_pick found"
+                                 " in patch specification.")
+
+    legato_spec = release.spec.get("legato")
+    if not legato_spec:
+        return
+    patches = legato_spec.get("patches")
+    if not isinstance(patches, list):
+        raise TypeError("legato patches list is not a list")
+    for patch in patches:
+        if not isinstance(patch, dict):
+            raise TypeError("legato patch list entry is not a JSON object")
+    root = release.legato_repo_root
+    inputs = legato_source_inputs(release.spec)
+    # Fetching all Legato sources takes a while and requires a solid Internet connection,
+    # so checkpoint it, like checkpointed_fetch() does, but only fetch it again if the unpatched
+    # sources have changed.
+    key = fetch_stage_key("Legato", inputs)
+    checkpoint_file = f"{root}/.fetched"
+    recorded_key = read_checkpoint(checkpoint_file)
+    if recorded_key == key:
+        return
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    snapshots = PatchSnapshots(root, legato_unpatched_key(inputs))
+    applied = snapshots.restore_longest_prefix(patches)
+    if applied is not None:
+        print(f"Reusing the Legato sources, with {applied} of the {len(patches)} patches"
+              f" already applied.")
+    else:
+        if recorded_key is not None:
+            print("The inputs for the Legato sources have changed since they were fetched.")
+        prep_clean_dir(root)
+        # The cache entry holds the contents of root, rather than root itself, because the same
+        # sources may be fetched into different directories (see assign_shared_dirs()).
+        if build_cache and build_cache.restore(key, root):
+            pathlib.Path(checkpoint_file).write_text(key)
+            return
+        print("Fetching Legato sources...")
+        repo_sync(legato_spec["manifest_repo"], legato_spec["base_manifest"], root,
+                  inputs["manifest_commit"])
+        snapshots.start()
+        applied = 0
+    # Patch it up.
+    fetch_gerrit_changes(patches[applied:], release.legato_root)
+    for i in range(applied, len(patches)):
+        snapshots.patching(os.path.normpath(f"legato/{legato_patch_dir(patches[i])}"))
+        apply_patch(patches[i])
+        snapshots.take(patches[:i + 1])
+    # Checkpoint reached.
+    pathlib.Path(checkpoint_file).write_text(key)
+    if build_cache:
+        build_cache.store(key, [f"{root}/{name}" for name in os.listdir(root)])
+
+
+# Cached legato version strings, by legato root directory and fetch checkpoint key.
+# Don't use this directly. Call get_legato_version().
+_legato_versions = {}
+
+def get_legato_version(release):
+    """
+    Get the version string of the Legato sources fetched for a release.
+    """
+    # If we've fetched it already, don't re-fetch it. The sources may have been fetched again
+    # since then, in a long-running process (see BuildDaemon).
+    cache_key = (release.legato_root, read_checkpoint(f"{release.legato_repo_root}/.fetched"))
+    if cache_key not in _legato_versions:
+        # Extract the version string from Legato's "version" file.
+        with open(f"{release.legato_root}/version", "r") as f:
+            legato_version = f.readline().strip()
+        assert legato_version
+        _legato_versions[cache_key] = legato_version
+    return _legato_versions[cache_key]
+
+
+def get_toolchain_key(release, board, module):
+    """
+    Identify the toolchain used to build software for a board and module, independently of the
+    release: a toolchain built with Yocto is identified by the key of what was built in its Yocto
+    build tree (see yocto_tree_key()), and any other toolchain by the ID of its leaf package.
+    """
+    yocto_spec = release.spec["boards"][board][module].get("yocto")
+    if yocto_spec:
+        return yocto_tree_key(yocto_source_inputs(yocto_spec))
+    return get_toolchain_package(release, board, module)
+
+
+class CompilerCache:
+    """
+    The ccache caches shared by the Legato, Octave and mangOH builds, for all boards, modules and
+    releases, so that a "make clean" (or building the same sources again in another directory,
+    e.g., for another board, or for the non-Octave SPK) doesn't mean compiling everything again.
+    They are kept outside of BUILD_DIR, so they survive a "make clean" of the whole build.
+
+    Each toolchain (see get_toolchain_key()) gets its own cache, so ccache doesn't have to check
+    the compilers themselves, which are installed in a different place for every release. Each
+    command that compiles holds a shared lock on the caches (see in_use()), in this and any other
+    process, and marks its toolchain's cache as used. Whenever a command finishes, and no other
+    one is running, the least recently used caches are removed until they fit within max_size
+    bytes (see prune()). ccache also keeps each one within max_size itself.
+
+    The builds run the cross compilers by their full paths, from the *_TOOLCHAIN_DIR variables
+    that the toolchain packages set in the leaf shell, so each of those directories gets a
+    directory of wrappers (see wrapper_dir()), and the variables are pointed at that instead. It
+    has a script for each compiler (see COMPILERS) that runs it through ccache, and a link to
+    every other tool. It also goes at the front of the PATH, for compilers run from the PATH.
+    """
+    # The names of the compilers that are wrapped, after the toolchain's prefix (e.g.,
+    # "arm-poky-linux-gnueabi-").
+    COMPILERS = ["gcc", "g++", "cc", "c++"]
+
+    # The file in each toolchain's cache whose modification time is when it was last used.
+    LAST_USED_FILE = ".last-used"
+
+    def __init__(self, cache_dir, max_size, ccache):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.ccache = ccache
+        self.lock_file = f"{cache_dir}/.lock"
+        os.makedirs(f"{cache_dir}/bin", exist_ok=True)
+
+    def toolchain_cache_dir(self, toolchain_key):
+        return f"{self.cache_dir}/{build_stage_key('ccache', toolchain_key)[:16]}"
+
+    def toolchain_dirs(self, workspace, env):
+        """
+        Get a dict mapping each *_TOOLCHAIN_DIR variable set in the leaf shell of the profile
+        selected in a leaf workspace to the directory of wrappers for its toolchain directory.
+        """
+        toolchain_dirs = {}
+        for line in run_command("leaf shell -c env", cwd=workspace, env=env,
+                                capture_output=True).splitlines():
+            name, _, value = line.partition("=")
+            if name.endswith("_TOOLCHAIN_DIR") and os.path.isdir(value):
+                toolchain_dirs[name] = self.wrapper_dir(value)
+        return toolchain_dirs
+
+    def wrapper_dir(self, toolchain_dir):
+        """
+        Get the directory of wrappers for the tools in a toolchain directory, which is named after
+        a hash of its path. It is made the first time it is needed.
+        """
+        path_hash = hashlib.sha1(f"{self.ccache} {toolchain_dir}".encode()).hexdigest()[:16]
+        wrapper_dir = f"{self.cache_dir}/bin/{path_hash}"
+        if os.path.isdir(wrapper_dir):
+            return wrapper_dir
+        temp_dir = tempfile.mkdtemp(prefix=f".incomplete-{path_hash}-", dir=f"{self.cache_dir}/bin")
+        for name in os.listdir(toolchain_dir):
+            tool = f"{toolchain_dir}/{name}"
+            if name.rpartition("-")[2] in self.COMPILERS:
+                wrapper = pathlib.Path(f"{temp_dir}/{name}")
+                wrapper.write_text(
+                    f'#!/bin/sh\nexec {shlex.quote(self.ccache)} {shlex.quote(tool)} "$@"\n')
+                wrapper.chmod(0o755)
+            else:
+                os.symlink(tool, f"{temp_dir}/{name}")
+        try:
+            os.rename(temp_dir, wrapper_dir)
+        except OSError:
+            # Another build made it at the same time.
+            shutil.rmtree(temp_dir)
+        return wrapper_dir
+
+    @contextlib.contextmanager
+    def in_use(self, toolchain_key):
+        """
+        Used in a "with" block around a command run with command() that uses a toolchain's cache,
+        to give it a file in which ccache logs the result of each compilation. When the block
+        exits, the results are added up and recorded (see report_ccache()), and the caches are
+        pruned.
+        """
+        cache_dir = self.toolchain_cache_dir(toolchain_key)
+        with open(self.lock_file, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH)
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                pathlib.Path(f"{cache_dir}/{self.LAST_USED_FILE}").touch()
+                fd, path = tempfile.mkstemp(prefix="stats-", suffix=".log", dir=cache_dir)
+                os.close(fd)
+                try:
+                    yield path
+                    report_ccache(ccache_stats(path))
+                finally:
+                    os.remove(path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.prune()
+
+    def prune(self):
+        """
+        Remove whole toolchain caches, least recently used first, until they fit within
+        max_size, unless a command is using them. The most recently used one is always kept.
+        """
+        with open(self.lock_file, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            caches = []
+            for name in os.listdir(self.cache_dir):
+                cache_dir = f"{self.cache_dir}/{name}"
+                if name == "bin" or not os.path.isdir(cache_dir):
+                    continue
+                last_used_file = f"{cache_dir}/{self.LAST_USED_FILE}"
+                last_used = (os.path.getmtime(last_used_file) if os.path.exists(last_used_file)
+                             else 0)
+                size = sum(os.lstat(os.path.join(directory, file_name)).st_size
+                           for directory, _, files in os.walk(cache_dir)
+                           for file_name in files)
+                caches.append((last_used, size, cache_dir))
+            total_size = sum(size for _, size, _ in caches)
+            removed = 0
+            for _, size, cache_dir in sorted(caches)[:-1]:
+                if total_size <= self.max_size:
+                    break
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                total_size -= size
+                removed += 1
+            if removed:
+                print(f"Pruned {removed} toolchain caches from the compiler cache, leaving"
+                      f" {total_size / 1024**3:.1f} GiB.")
+
+    def command(self, cmd, toolchain_key, toolchain_dirs, stats_log):
+        """
+        Wrap a command to be run in a leaf shell, so that the cross compilers it runs go through
+        the toolchain's cache, given the wrapper directories from toolchain_dirs(). Legato's own
+        ccache support is turned off (USE_CCACHE=0), so nothing goes through ccache twice. Paths
+        under BUILD_DIR are hashed relative to the directory that the compiler is run in, so the
+        same sources built in different directories (e.g., for different boards) can share
+        cached results.
+        """
+        wrapper_dirs = list(dict.fromkeys(toolchain_dirs.values()))
+        exports = [f"{name}={wrapper_dir}" for name, wrapper_dir in toolchain_dirs.items()]
+        return (f"export {' '.join(exports + [''])}PATH={':'.join(wrapper_dirs + ['$PATH'])}"
+                f" USE_CCACHE=0 CCACHE_DIR={self.toolchain_cache_dir(toolchain_key)}"
+                f" CCACHE_MAXSIZE={self.max_size // 1000**2}M CCACHE_COMPILERCHECK=none"
+                f" CCACHE_BASEDIR={BUILD_DIR} CCACHE_NOHASHDIR=1 CCACHE_STATSLOG={stats_log}"
+                f" && {cmd}")
+
+
+# The CompilerCache that the cross compilers go through, or None if nothing is cached.
+compiler_cache = None
+
+# The results that ccache logs for each compilation (see ccache_stats()) that count as hits and
+# misses. Anything else (e.g., linking, or running the preprocessor on its own) can't be cached.
+CCACHE_HITS = ["direct_cache_hit", "preprocessed_cache_hit"]
+CCACHE_MISSES = ["cache_miss"]
+
+
+def ccache_stats(stats_log):
+    """
+    Add up the results that ccache logged for each compilation in stats_log, which has a
+    "# <source file>" line for each compilation followed by its results. Returns a dict with the
+    numbers of compilations that were "hits", "misses" and "uncacheable".
+    """
+    stats = dict.fromkeys(["hits", "misses", "uncacheable"], 0)
+    for line in pathlib.Path(stats_log).read_text().splitlines():
+        if line.startswith("#") or not line.strip():
+            continue
+        if line in CCACHE_HITS:
+            stats["hits"] += 1
+        elif line in CCACHE_MISSES:
+            stats["misses"] += 1
+        else:
+            stats["uncacheable"] += 1
+    return stats
+
+
+def report_ccache(stats):
+    """
+    Print the compiler cache hit rate of a command and add it to the compiler cache statistics
+    of the current stage in the build report.
+    """
+    if not any(stats.values()):
+        return
+    cacheable = stats["hits"] + stats["misses"]
+    hit_rate = 100 * stats["hits"] / cacheable if cacheable else 0
+    print(f"Compiler cache: {stats['hits']} of {cacheable} compilations cached"
+          f" ({hit_rate:.0f}% hit rate), {stats['uncacheable']} uncacheable.")
+    BuildReport.current().add_to("ccache", stats)
+
+
+def build_legato(release, board, module):
+    """
+    Build the custom Legato framework for a specific module using the appropriate toolchain
+    for the board and module. The output of this is a leaf package for Legato.
+    If another board shares the Legato build for this module (see get_legato_board()), there's
+    nothing to do. If another release being built has already built it in the same directory
+    (see legato_build_dir()), it is just packaged.
+    """
+    spec = release.spec
+    legato_spec = spec.get("legato")
+    legato_board = get_legato_board(release, board, module)
+    if legato_spec and legato_board != board:
+        print(f"mangOH {board} shares the Legato Framework for {module} with {legato_board}.")
+    elif legato_spec:
+        # If there's a Legato leaf package for this board+module in the remote already,
+        # remove it.
+        package_id = legato_package_id(release, board, module)
+        remove_leaf_package(release, package_id)
+        legato_root = legato_build_dir(release, board, module)
+        clone_source_tree(release.legato_root, legato_root,
+                          f"{release.legato_repo_root}/.fetched")
+        # The ".built" checkpoint records the toolchain that the sources were last built with.
+        # It goes away when the sources are re-cloned, so if it's there and the toolchain hasn't
+        # changed, there's nothing to build.
+        toolchain_key = get_toolchain_key(release, board, module)
+        checkpoint_file = f"{legato_root}/.built"
+        built_with = read_checkpoint(checkpoint_file)
+        if built_with != toolchain_key:
+            print(f"Building the Legato Framework for {module} on {board}...")
+            # Before we can run the build, we need to set up the leaf workspace with a profile
+            # that contains all the required packages.
+            with LeafProfile(get_depends(release, board, module), release, board,
+                             module) as profile:
+                if built_with is not None:
+                    # The toolchain has changed since the last build.
+                    profile.shell("make clean", cwd=legato_root)
+                profile.shell(f"make {module}", cwd=legato_root)
+            pathlib.Path(checkpoint_file).write_text(toolchain_key)
+        # Package as leaf package and add to remote.
+        legato_version = get_legato_version(release)
+        package_dir = f"{release.staging_dir}/{board}-{module}-legato"
+        if os.path.exists(package_dir):
+            shutil.rmtree(package_dir)
+        stage_tree(legato_root, package_dir, exclude=[".git", ".cloned", ".built"])
+        write_manifest("legatoManifest.json", package_dir,
+                       manifest_variables(release, board, module, LEGATO_VERSION=legato_version))
+        create_leaf_package(release, package_id, package_dir, get_compressor(spec, "legato"))
+
+
+def octave_source_inputs(spec):
+    """Get the inputs that determine what Octave Edge Package sources get fetched."""
+    return {"url": OCTAVE_REPO, "commit": resolve_git_ref(OCTAVE_REPO, spec["octave"]["ref"])}
+
+
+def fetch_octave(release):
+    """Fetch the Octave Edge Package sources for a release."""
+    inputs = octave_source_inputs(release.spec)
+    checkpointed_fetch("Octave", release.octave_root, inputs,
+                       lambda: fetch_git_repo(OCTAVE_REPO, inputs["commit"],
+                                              dest=release.octave_root))
+
+
+def build_octave(release, board, module):
+    """
+    Build the Octave Edge Package apps and create a Leaf package containing them.
+    """
+    spec = release.spec
+    print(f"Building the Octave Edge Package for {module} on {board}...")
+    # If there's an Octave leaf package for this board+module in the remote already, remove it.
+    package_id = octave_package_id(release, board, module)
+    remove_leaf_package(release, package_id)
+    octave_root = octave_build_dir(release, board, module)
+    mangoh_root = mangoh_build_dir(release, board, module)
+    cloned = clone_source_tree(release.octave_root, octave_root,
+                               f"{release.octave_root}/.fetched")
+    clone_source_tree(release.mangoh_root, mangoh_root, f"{release.mangoh_root}/.fetched")
+    # The build system for jerryscript isn't smart enough to know that it needs to re-build
+    # certain artifacts when the toolchain is swapped out, so anything built with a different
+    # toolchain (or against different Legato or mangOH sources) has to be cleaned out first.
+    toolchain_key = build_stage_key("octave toolchain", {
+        "toolchain": get_toolchain_key(release, board, module),
+        "legato": read_checkpoint(f"{release.legato_repo_root}/.fetched"),
+        "mangoh": read_checkpoint(f"{release.mangoh_root}/.fetched"),
+        "version": spec["octave"]["version"],
+    })
+    invalidate_toolchain_artifacts(octave_root, toolchain_key, cloned)
+    depends = get_depends(release, board, module)
+    depends.append(legato_package_id(release, get_legato_board(release, board, module), module))
+    with LeafProfile(depends, release, board, module) as profile:
+        octave_version = spec["octave"]["version"]
+        profile.shell("leaf profile", cwd=target_dir(release, board, module))
+        profile.shell("leaf env", cwd=target_dir(release, board, module))
+        cmd = (
+            f"make MANGOH_ROOT={mangoh_root} DHUB_ROOT={mangoh_root}/apps/DataHub"
+            f" MANGOH_BOARD={board} VERSION={octave_version}"
+        )
+        profile.shell(cmd, cwd=octave_root)
+    # The Octave build already creates the leaf packages, so they just need to be
+    # copied into remote.
+    os.makedirs(release.staging_dir, exist_ok = True)
+    staged_package = f"{release.staging_dir}/{package_id}.leaf"
+    shutil.copy(f"{octave_root}/build/Octave-mangOH-{board}-{module}.leaf", staged_package)
+    shutil.copy(f"{octave_root}/build/Octave-mangOH-{board}-{module}.leaf.info",
+                f"{staged_package}.info")
+    release.leaf_remote.add([staged_package, f"{staged_package}.info"])
+
+
+class Downloader:
+    """
+    Downloads files over HTTP(S) (or from file:// URLs) into a content-addressed download cache,
+    so that each file is only downloaded once, even across releases.
+
+    Files are stored under "sha256/", named after their SHA-256 hash. Files being downloaded are
+    streamed into "partial/", so an interrupted download can be resumed (using an HTTP range
+    request) rather than restarted. "urls/" maps each URL that was downloaded without a known
+    hash to the hash of what it returned, so URLs are assumed to always return the same content.
+
+    The cache may be shared by several builds (in this and other processes), so each URL is
+    only fetched by one of them at a time, with a lock on a file named after it in "locks/" held
+    (see _url_lock()). The others wait, and then find the file in the cache.
+    """
+    # Number of attempts made to download a file before giving up.
+    ATTEMPTS = 3
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        # Maps the hash of each URL being fetched in this process to a lock for it.
+        self.url_locks = {}
+
+    def _path(self, kind, name):
+        os.makedirs(f"{self.cache_dir}/{kind}", exist_ok = True)
+        return f"{self.cache_dir}/{kind}/{name}"
+
+    @contextlib.contextmanager
+    def _url_lock(self, url_hash):
+        """Used in a "with" block to hold the lock on fetching a URL, given its hash."""
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url_hash, threading.Lock())
+        with url_lock, open(self._path("locks", url_hash), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def fetch(self, url, sha256=None):
+        """
+        Get a file from the cache, downloading it if necessary. If sha256 is given, the file's
+        hash must match it. Returns the path to the file in the cache.
+        """
+        url_hash = hashlib.sha1(url.encode()).hexdigest()
+        url_file = self._path("urls", url_hash)
+        with self._url_lock(url_hash):
+            if not sha256 and os.path.exists(url_file):
+                sha256 = pathlib.Path(url_file).read_text().strip()
+            if sha256 and os.path.exists(self._path("sha256", sha256)):
+                return self._path("sha256", sha256)
+            partial_file = self._path("partial", url_hash)
+            for attempt in range(1, self.ATTEMPTS + 1):
+                try:
+                    actual_sha256 = self._download(url, partial_file)
+                    break
+                except (urllib.error.URLError, http.client.HTTPException, ConnectionError) as e:
+                    if attempt == self.ATTEMPTS:
+                        raise
+                    print(f"Download of {url} failed ({e}), retrying...")
+            if sha256 and actual_sha256 != sha256:
+                os.remove(partial_file)
+                raise ValueError(f"SHA-256 of {url} is {actual_sha256}, expected {sha256}.")
+            os.replace(partial_file, self._path("sha256", actual_sha256))
+            pathlib.Path(url_file).write_text(actual_sha256)
+            return self._path("sha256", actual_sha256)
+
+    @staticmethod
+    def _download(url, partial_file):
+        """
+        Download url into partial_file, resuming from where a previous attempt left off if the
+        server supports it. Returns the SHA-256 hash of the complete file.
+        """
+        hasher = hashlib.sha256()
+        offset = os.path.getsize(partial_file) if os.path.exists(partial_file) else 0
+        request = urllib.request.Request(url, headers={"User-Agent": "mangoh-release"})
+        if offset:
+            request.add_header("Range", f"bytes={offset}-")
+        try:
+            response = urllib.request.urlopen(request, timeout=60)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # The range isn't satisfiable, so the partial file is useless. Start over.
+            os.remove(partial_file)
+            return Downloader._download(url, partial_file)
+        with response:
+            if offset and getattr(response, "status", None) == 206:
+                print(f"Resuming download of {url} at {offset} bytes...")
+                with open(partial_file, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024**2), b""):
+                        hasher.update(chunk)
+                mode = "ab"
+            else:
+                print(f"Downloading {url}...")
+                mode = "wb"
+            with open(partial_file, mode) as f:
+                for chunk in iter(lambda: response.read(1024**2), b""):
+                    hasher.update(chunk)
+                    f.write(chunk)
+        return hasher.hexdigest()
+
+    def download(self, download_spec, root):
+        """
+        Fetch a file as specified by an entry in the mangOH "wget" list into its directory
+        under root, and unpack it if the entry says to.
+        """
+        url = download_spec["url"]
+        dest_dir = f"{root}/{download_spec['dir']}"
+        dest = f"{dest_dir}/{os.path.basename(url)}"
+        os.makedirs(dest_dir, exist_ok = True)
+        stage_file(self.fetch(url, download_spec.get("sha256")), dest)
+        unpack = download_spec.get("unpack")
+        if unpack == "unzip":
+            with zipfile.ZipFile(dest) as archive:
+                for member in archive.infolist():
+                    path = archive.extract(member, dest_dir)
+                    # Keep the files' permissions, like the unzip tool does.
+                    mode = (member.external_attr >> 16) & 0o777
+                    if mode:
+                        os.chmod(path, mode)
+        elif unpack:
+            raise ValueError(f"Unsupported unpack method '{unpack}' for {url}.")
+
+    def download_all(self, download_specs, root):
+        """Fetch all the files in a mangOH "wget" list into root at the same time."""
+        if not download_specs:
+            return
+        download = BuildReport.current().bind_stage(self.download)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(download_specs)) as pool:
+            futures = [pool.submit(download, download_spec, root)
+                       for download_spec in download_specs]
+            for future in futures:
+                future.result()
 
-    def build(firmware_path):
-        shell("make clean", cwd=MANGOH_ROOT)
+
+# The Downloader used to fetch files over HTTP(S). main replaces this with one that keeps its
+# cache with the build cache, so that it survives "make clean".
+downloader = Downloader(f"{BUILD_DIR}/downloads")
+
+
+def mangoh_source_inputs(spec):
+    """Get the inputs that determine what mangOH sources (and other files) get fetched."""
+    return {
+        "url": MANGOH_MAIN_REPO,
+        "commit": resolve_git_ref(MANGOH_MAIN_REPO, spec["mangoh"]["ref"]),
+        "wget": spec["mangoh"].get("wget", []),
+    }
+
+
+def fetch_mangoh(release):
+    """Fetch the mangOH sources, and the files listed in the mangOH "wget" list, for a release."""
+    spec = release.spec
+    inputs = mangoh_source_inputs(spec)
+
+    def fetch():
+        fetch_git_repo(MANGOH_MAIN_REPO, inputs["commit"], dest=release.mangoh_root)
+        downloader.download_all(spec["mangoh"].get("wget", []), release.mangoh_root)
+
+    checkpointed_fetch("mangOH", release.mangoh_root, inputs, fetch)
+
+
+def get_mangoh_depends(release, board, module):
+    """
+    Get a list of the IDs of the leaf packages that the mangOH system for a board and module is
+    built with, which are also the dependencies of its master leaf package.
+    """
+    depends = get_depends(release, board, module)
+    depends.append(legato_package_id(release, get_legato_board(release, board, module), module))
+    depends.append(octave_package_id(release, board, module))
+    return depends
+
+
+def get_modem_firmware(release, board, module):
+    """
+    Return a tuple containing:
+    1. the file system path to the modem firmware file to be used to build the SPK,
+    2. a string containing the modem firmware version number (e.g., "13.3").
+    The modem image package must be installed in the board and module's current leaf profile.
+    """
+    module_spec = release.spec["boards"][board][module]
+    module_abbreviation = get_abbreviated_module(module)
+    path = (f"{leaf_data_dir(release, board, module)}/current/{module_abbreviation}-modem-image/"
+            f"{module_spec['modem_firmware']}")
+    # The firmware version number can be found in the leaf manifest for the firmware package.
+    firmware_manifest = None
+    with open(f"{os.path.dirname(path)}/manifest.json") as json_file:
+        firmware_manifest = json.load(json_file)
+    firmware_release = firmware_manifest["info"]["version"]
+    return path, firmware_release
+
+
+def build_mangoh_spk(release, board, module, octave):
+    """
+    Build the factory .spk file for either the Octave or non-Octave version for a particular
+    mangOH board and module. The .spk file is left in the board and module's spk staging
+    directory for build_mangoh() to package.
+    """
+    print(f"Building the mangOH {board} {module} SPK {'with' if octave else 'without'} Octave...")
+    mangoh_root = mangoh_build_dir(release, board, module, octave)
+    spk_dir = f"{release.staging_dir}/{board}-{module}-spk"
+    os.makedirs(spk_dir, exist_ok = True)
+    clone_source_tree(release.mangoh_root, mangoh_root, f"{release.mangoh_root}/.fetched")
+    with LeafProfile(get_mangoh_depends(release, board, module), release, board,
+                     module) as profile:
+        firmware_path, _ = get_modem_firmware(release, board, module)
+        shell("make clean", cwd=mangoh_root)
         make_cmd = (
             f"make {board}_spk "
             f"LEGATO_TARGET={module} "
-            f"OCTAVE_ROOT={OCTAVE_ROOT}/build "
+            f"OCTAVE_ROOT={octave_build_dir(release, board, module)}/build "
             f"MODEM_FIRMWARE={firmware_path}"
         )
-        # With Octave
-        shell(f"leaf shell -c '{make_cmd}'", cwd=MANGOH_ROOT)
-        shutil.copy(f"{MANGOH_ROOT}/build/{board}_{module}.spk",
-                    f"{staging_dir}/mangOH-{board}-{module}_{version}-octave.spk")
-        # Without Octave
-        shell("make clean", cwd=MANGOH_ROOT)
-        make_cmd = make_cmd + " OCTAVE=0"
-        shell(f"leaf shell -c '{make_cmd}'", cwd=MANGOH_ROOT)
-        shutil.copy(f"{MANGOH_ROOT}/build/{board}_{module}.spk",
-                    f"{staging_dir}/mangOH-{board}-{module}_{version}.spk")
+        if not octave:
+            make_cmd = make_cmd + " OCTAVE=0"
+        profile.shell(make_cmd, cwd=mangoh_root)
+    shutil.copy(f"{mangoh_root}/build/{board}_{module}.spk",
+                f"{spk_dir}/{spk_file_name(release, board, module, octave)}")
+
+
+def build_mangoh(release, board, module):
+    """
+    Generate the master leaf package for a particular mangOH board and module, containing the
+    factory .spk files for both the Octave and non-Octave versions (see build_mangoh_spk()),
+    and add it to the release's leaf remote.
+    """
+    spec = release.spec
+    module_spec = spec["boards"][board][module]
+    staging_dir = f"{release.staging_dir}/{board}-{module}-master"
+
+    def get_requires_list():
+        """
+        Get a list of strings, each of which contains the ID of a leaf package that
+        should be in the "requires" list of the master package.
+        """
+        return spec["mangoh"]["requires"] + module_spec.get("requires", [])
 
     def package(depends, firmware_version):
         package_name = f"mangOH-{board}-{module}"
-        package_id=f"{package_name}_{version}"
+        package_id=f"{package_name}_{release.version}"
         print(f"Creating Leaf package '{package_id}'")
         octave_version = spec["octave"]["version"]
-        legato_version = get_legato_version()
+        legato_version = get_legato_version(release)
         description = (
             f"mangOH {board} {module} "
             f"(Modem=R{firmware_version}, Legato={legato_version}, Octave={octave_version})"
@@ -521,7 +2763,7 @@ def build_mangoh(spec, board, module):
             f"leaf build manifest "
             f"-o {staging_dir} "
             f"--name {package_name} "
-            f"--version {version} "
+            f"--version {release.version} "
             f"--description '{description}' "
             f"--master true "
             f"--tag mangOH "
@@ -532,35 +2774,1668 @@ def build_mangoh(spec, board, module):
         requires = get_requires_list()
         cmd += ' ' + ' '.join([f"--requires {pkg}" for pkg in requires])
         shell(cmd)
-        create_leaf_package(package_id, staging_dir)
+        create_leaf_package(release, package_id, staging_dir, get_compressor(spec, "master"))
 
     prep_clean_dir(staging_dir)
-    depends = get_depends(spec, board, module)
-    depends.append(legato_package_id(board, module))
-    depends.append(octave_package_id(board, module))
-    with LeafProfile(depends):
-        firmware_path, firmware_version = get_modem_firmware()
-        build(firmware_path)
+    for octave in [True, False]:
+        spk_file = spk_file_name(release, board, module, octave)
+        shutil.copy(f"{release.staging_dir}/{board}-{module}-spk/{spk_file}",
+                    f"{staging_dir}/{spk_file}")
+    depends = get_mangoh_depends(release, board, module)
+    with LeafProfile(depends, release, board, module):
+        _, firmware_version = get_modem_firmware(release, board, module)
         package(depends, firmware_version)
 
 
+def delta_base_remote(release, from_version):
+    """
+    Get the directory of the leaf remote in which the master packages of an earlier release are
+    found: the earlier release's directory in the remote that the "remote" member of the spec's
+    "deltas" member names (into which it was published, see publish_release()), if there is
+    one, or else the leaf remote that the earlier release was built in.
+    """
+    remote = release.spec["deltas"].get("remote")
+    if remote:
+        return f"{remote}/{from_version}"
+    return f"{RELEASES_DIR}/{from_version}/leaf/remote"
+
+
+def build_deltas(release, board, module):
+    """
+    Generate a binary delta from each factory .spk file of each of the earlier releases listed
+    in the spec's "deltas" member to the one built for a board and module (see
+    build_mangoh_spk()), and package them in a leaf package added to the release's leaf remote,
+    along with apply_spk_delta.py, which rebuilds the full .spk files from them. The earlier
+    .spk files are taken from each earlier release's master package (see delta_base_remote()).
+    Earlier releases that didn't have the board and module are skipped.
+    """
+    spec = release.spec
+    package_id = delta_package_id(release, board, module)
+    remove_leaf_package(release, package_id)
+    staging_dir = f"{release.staging_dir}/{board}-{module}-delta"
+    prep_clean_dir(staging_dir)
+    spk_dir = f"{release.staging_dir}/{board}-{module}-spk"
+    deltas = []
+    for from_version in spec["deltas"]["from"]:
+        base_package = (f"{delta_base_remote(release, from_version)}/"
+                        f"mangOH-{board}-{module}_{from_version}.leaf")
+        if not os.path.exists(base_package):
+            print(f"There's no mangOH {board} {module} package for release {from_version},"
+                  f" so there are no deltas from it.")
+            continue
+        base_dir = f"{release.staging_dir}/{board}-{module}-delta-base/{from_version}"
+        prep_clean_dir(base_dir)
+        base_files = [spk_file_name(release, board, module, octave, from_version)
+                      for octave in [True, False]]
+        shell(f"tar -xf {base_package} -C {base_dir} {' '.join(f'./{f}' for f in base_files)}")
+        for octave, base_file in zip([True, False], base_files):
+            spk_file = spk_file_name(release, board, module, octave)
+            delta_file = f"{spk_file[:-len('.spk')]}.from-{from_version}.delta"
+            print(f"Generating the delta from {base_file} to {spk_file}...")
+            # The window has to cover the whole of the earlier .spk file, for zstd to find
+            # everything that the new one has in common with it.
+            shell(f"zstd -q -f -19 -T0 --long=31 --patch-from={base_dir}/{base_file}"
+                  f" {spk_dir}/{spk_file} -o {staging_dir}/{delta_file}")
+            deltas.append({
+                "from_version": from_version,
+                "from": base_file,
+                "from_sha256": file_hash(f"{base_dir}/{base_file}"),
+                "to": spk_file,
+                "to_sha256": file_hash(f"{spk_dir}/{spk_file}"),
+                "delta": delta_file,
+                "delta_sha256": file_hash(f"{staging_dir}/{delta_file}"),
+            })
+            delta_size = os.path.getsize(f"{staging_dir}/{delta_file}")
+            print(f"The delta is {delta_size / 1024:.0f} KiB"
+                  f" ({100 * delta_size / os.path.getsize(f'{spk_dir}/{spk_file}'):.1f}% of the"
+                  f" size of the .spk file).")
+    if not deltas:
+        print(f"There are no deltas to package for mangOH {board} {module}.")
+        return
+    with open(f"{staging_dir}/deltas.json", "w") as json_file:
+        json.dump({"board": board, "module": module, "version": release.version,
+                   "deltas": deltas}, json_file, indent=4)
+    shutil.copy(f"{SCRIPT_DIR}/apply_spk_delta.py", staging_dir)
+    # Make sure that the packaged tool can rebuild every .spk file from its delta.
+    check_dir = f"{release.staging_dir}/{board}-{module}-delta-check"
+    for from_version in dict.fromkeys(delta["from_version"] for delta in deltas):
+        prep_clean_dir(check_dir)
+        shell(f"{staging_dir}/apply_spk_delta.py {staging_dir} --from {from_version}"
+              f" --from-dir {release.staging_dir}/{board}-{module}-delta-base/{from_version}"
+              f" --output-dir {check_dir}")
+    shutil.rmtree(check_dir)
+    from_versions = ", ".join(dict.fromkeys(delta["from_version"] for delta in deltas))
+    shell(f"leaf build manifest -o {staging_dir} --name mangOH-{board}-{module}-delta"
+          f" --version {release.version}"
+          f" --description 'mangOH {board} {module} {release.version} SPK deltas from"
+          f" {from_versions}' --tag mangOH --tag {board} --tag {module}")
+    create_leaf_package(release, package_id, staging_dir, get_compressor(spec, "delta"))
+
+
+class BuildReport:
+    """
+    Records the timing and resource usage of each build stage and of every command run by it,
+    and writes them out as a JSON and an HTML report. Progress messages (the stages started and
+    finished, and the commands they run) are passed to the progress function, and each stage's
+    output is logged to a file in log_dir.
+    """
+
+    # The stage running on each thread and the report it belongs to. This is shared by all the
+    # reports, so the commands get recorded in the right one when several builds are running in
+    # the same process (see BuildDaemon).
+    local = threading.local()
+
+    def __init__(self, progress=print, log_dir=LOG_DIR):
+        self.lock = threading.Lock()
+        self.progress = progress
+        self.log_dir = log_dir
+        self.start_time = time.time()
+        # When the build (or BuildDaemon job) started running. The git mirrors and the leaf
+        # remote indexes that were last fetched before then are fetched again the next time
+        # the build uses them.
+        self.refresh_after = self.start_time
+        self.stages = []
+        # Commands that were not run by any build stage.
+        self.commands = []
+        # Maps "<url> <ref>" to the commit that the ref resolved to in this build (see
+        # resolve_git_ref()). Each build (and BuildDaemon job) has its own report, so refs are
+        # resolved again in the next one.
+        self.resolved_refs = {}
+
+    @classmethod
+    def current(cls):
+        """Get the report of the stage running on this thread, or the global build_report."""
+        return getattr(cls.local, "report", None) or build_report
+
+    def current_stage(self):
+        """Get the record of the stage running on this thread, or None."""
+        return getattr(self.local, "stage", None)
+
+    def log_file(self, name):
+        """Get the path to the log file of the stage with the given name."""
+        return f"{self.log_dir}/{name.replace(' ', '_')}.log"
+
+    def bind_stage(self, func):
+        """
+        Wrap a function so that, when it is run on another thread, its commands are still
+        recorded as part of the stage running on this thread.
+        """
+        stage = self.current_stage()
+        report = BuildReport.current()
+
+        def run_in_stage(*args):
+            self.local.stage = stage
+            self.local.report = report
+            try:
+                return func(*args)
+            finally:
+                self.local.stage = None
+                self.local.report = None
+        return run_in_stage
+
+    def record(self, name, value):
+        """Record a JSON-serializable value under name in the record of the current stage."""
+        stage = self.current_stage()
+        if stage:
+            with self.lock:
+                stage[name] = value
+
+    def add_to(self, name, counts):
+        """
+        Add a dict of counts to those recorded under name in the record of the current stage, and
+        update the hit rate, for counts of "hits" and "misses".
+        """
+        stage = self.current_stage()
+        if stage:
+            with self.lock:
+                totals = stage.setdefault(name, {})
+                for key, count in counts.items():
+                    totals[key] = totals.get(key, 0) + count
+                cacheable = totals.get("hits", 0) + totals.get("misses", 0)
+                totals["hit_rate"] = 100 * totals.get("hits", 0) / cacheable if cacheable else 0
+
+    def add_command(self, record):
+        stage = self.current_stage()
+        with self.lock:
+            (stage["commands"] if stage else self.commands).append(record)
+
+    def run_stage(self, name, depends, func):
+        """Run a build stage's function, recording it and logging its output to a file."""
+        os.makedirs(self.log_dir, exist_ok = True)
+        target = name.split(" ", 1)[1] if " " in name else ""
+        stage = {
+            "name": name,
+            "kind": name.split(" ", 1)[0],
+            "target": target,
+            "depends": list(depends),
+            "log": self.log_file(name),
+            "start": time.time(),
+            "end": None,
+            "status": "running",
+            "commands": [],
+        }
+        with self.lock:
+            self.stages.append(stage)
+        with open(stage["log"], "w"):
+            pass
+        self.local.stage = stage
+        self.local.report = self
+        try:
+            func()
+            stage["status"] = "succeeded"
+        except:
+            stage["status"] = "failed"
+            raise
+        finally:
+            self.local.stage = None
+            self.local.report = None
+            stage["end"] = time.time()
+
+    def critical_path(self):
+        """
+        Get the list of names of the stages on the critical path: the chain of dependencies that
+        led up to the stage that finished last.
+        """
+        finished = {stage["name"]: stage for stage in self.stages if stage["end"]}
+        path = []
+        stage = max(finished.values(), key=lambda stage: stage["end"], default=None)
+        while stage:
+            path.insert(0, stage["name"])
+            dependencies = [finished[name] for name in stage["depends"] if name in finished]
+            stage = max(dependencies, key=lambda stage: stage["end"], default=None)
+        return path
+
+    def summarize(self, version):
+        """
+        Get the report as a JSON-serializable object, for a build of the release with the given
+        version (or of several releases, joined with '+').
+        """
+        with self.lock:
+            stages = []
+            for stage in self.stages:
+                end = stage["end"] or time.time()
+                commands = stage["commands"]
+                stages.append(dict(stage,
+                    wall_time = end - stage["start"],
+                    cpu_time = sum(command["cpu_time"] for command in commands),
+                    max_rss_kib = max([command["max_rss_kib"] for command in commands],
+                                      default=0),
+                    bytes_written = sum(command["bytes_written"] for command in commands)))
+            critical_path = self.critical_path()
+            return {
+                "version": version,
+                "start": self.start_time,
+                "end": time.time(),
+                "stages": stages,
+                "other_commands": list(self.commands),
+                "resolved_refs": dict(self.resolved_refs),
+                "critical_path": critical_path,
+                "critical_path_time": sum(stage["wall_time"] for stage in stages
+                                          if stage["name"] in critical_path),
+            }
+
+    def write(self, version):
+        """
+        Write the JSON and HTML reports for a build of the release with the given version (or of
+        several releases, joined with '+') into REPORT_DIR. Returns the path to the JSON report.
+        """
+        os.makedirs(REPORT_DIR, exist_ok = True)
+        summary = self.summarize(version)
+        json_path = f"{REPORT_DIR}/build-report-{version}.json"
+        with open(json_path, "w") as f:
+            json.dump(summary, f, indent=4)
+        with open(f"{REPORT_DIR}/build-report-{version}.html", "w") as f:
+            f.write(self._html(summary))
+        return json_path
+
+    @staticmethod
+    def _html(summary):
+        """Render the report summary as an HTML page with a timeline of the stages."""
+        total_time = max(summary["end"] - summary["start"], 1)
+        rows = []
+        for stage in sorted(summary["stages"], key=lambda stage: (stage["target"], stage["start"])):
+            left = 100 * (stage["start"] - summary["start"]) / total_time
+            width = max(100 * stage["wall_time"] / total_time, 0.2)
+            critical = stage["name"] in summary["critical_path"]
+            rows.append(
+                f'<tr class="{stage["status"]}{" critical" if critical else ""}">'
+                f'<td>{html.escape(stage["target"])}</td><td>{html.escape(stage["kind"])}</td>'
+                f'<td>{stage["wall_time"]:.1f}</td><td>{stage["cpu_time"]:.1f}</td>'
+                f'<td>{stage["max_rss_kib"] // 1024}</td>'
+                f'<td>{stage["bytes_written"] // 1024**2}</td><td>{stage["status"]}</td>'
+                f'<td><a href="file://{html.escape(stage["log"])}">log</a></td>'
+                f'<td class="timeline"><div style="margin-left:{left:.2f}%;width:{width:.2f}%">'
+                f'</div></td></tr>')
+        critical_path = " &rarr; ".join(map(html.escape, summary["critical_path"]))
+        return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>mangOH {summary["version"]} build report</title>
+<style>
+body {{ font-family: sans-serif; }}
+td, th {{ padding: 2px 8px; text-align: left; }}
+td.timeline {{ width: 40%; }}
+td.timeline div {{ height: 1em; background: #8ab; }}
+tr.critical td.timeline div {{ background: #d54; }}
+tr.failed {{ color: #c00; }}
+</style></head><body>
+<h1>mangOH {summary["version"]} build report</h1>
+<p>Total time: {total_time:.0f} s. Critical path ({summary["critical_path_time"]:.0f} s):
+{critical_path}</p>
+<table>
+<tr><th>Target</th><th>Stage</th><th>Wall (s)</th><th>CPU (s)</th><th>Peak RSS (MiB)</th>
+<th>Written (MiB)</th><th>Status</th><th>Log</th><th>Timeline</th></tr>
+{chr(10).join(rows)}
+</table></body></html>
+"""
+
+
+build_report = BuildReport()
+
+
+# Locks serializing the build stages that build in the same shared directory, by directory, for
+# when several builds are running in the same process (see BuildDaemon). Don't use this
+# directly. Call directory_lock().
+_directory_locks = {}
+_directory_locks_lock = threading.Lock()
+
+def directory_lock(path):
+    """Get the lock that build stages must hold while building in the directory at path."""
+    with _directory_locks_lock:
+        return _directory_locks.setdefault(path, threading.Lock())
+
+
+class StageSlots:
+    """
+    Limits the number of build stages running at the same time across several builds (see
+    BuildDaemon), sharing them out fairly: whenever a slot is free, it goes to the waiting stage
+    of the build that has the fewest stages running, so one big build can't hold up the others.
+    Builds with the same number of stages running are served in the order their stages started
+    waiting.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.condition = threading.Condition()
+        # Maps each build to the number of its stages that hold slots.
+        self.running = {}
+        # The build of each stage waiting for a slot, in the order they started waiting.
+        self.waiting = []
+
+    def _next(self):
+        """Get the build whose waiting stage gets the next free slot."""
+        return min(self.waiting, key=lambda build: self.running.get(build, 0))
+
+    def acquire(self, build):
+        """Wait for a slot for one of the build's stages."""
+        with self.condition:
+            self.waiting.append(build)
+            while (sum(self.running.values()) >= self.capacity
+                   or self._next() is not build):
+                self.condition.wait()
+            self.waiting.remove(build)
+            self.running[build] = self.running.get(build, 0) + 1
+            # Another slot may still be free for the next waiting stage.
+            self.condition.notify_all()
+
+    def release(self, build):
+        """Give back the slot held by one of the build's stages."""
+        with self.condition:
+            self.running[build] -= 1
+            if not self.running[build]:
+                del self.running[build]
+            self.condition.notify_all()
+
+
+class RunJournal:
+    """
+    A persistent record of the build stages that have completed in a run of the build of one or
+    more releases, with the SHA-256 hash of each file that each stage produced (e.g., its leaf
+    packages in the release's leaf remote), so that a run that failed or was killed can be
+    resumed (see --resume and BuildGraph.run()) without redoing the stages that completed.
+
+    The journal is kept in a JSON file, which is rewritten every time a stage completes. It is
+    only resumed from if it was written for the same release specs (see key).
+    """
+    def __init__(self, path, key, resume):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        # Maps the name of each completed stage to a dict mapping the path of each of its
+        # outputs to its hash (None if it doesn't exist).
+        self.stages = {}
+        # Maps the name of each completed stage whose outputs have been checked to whether they
+        # are all still there, unchanged.
+        self.checked = {}
+        if resume:
+            try:
+                with open(path) as f:
+                    journal = json.load(f)
+            except (OSError, ValueError):
+                journal = None
+            if journal is None:
+                print("There is no journal of an earlier build of the same releases to resume.")
+            elif journal.get("key") != key:
+                print("The release specs have changed since the build being resumed, so it"
+                      " will be started over.")
+            else:
+                self.stages = journal["stages"]
+        # What the run being resumed recorded.
+        self.resumed = dict(self.stages)
+        self._save()
+
+    def _save(self):
+        """Write the journal out. Must be called with the lock held (or before it is shared)."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.new", "w") as f:
+            json.dump({"key": self.key, "stages": self.stages}, f, indent=4)
+        os.replace(f"{self.path}.new", self.path)
+
+    @staticmethod
+    def _hashes(outputs):
+        return {path: file_hash(path) if os.path.exists(path) else None for path in outputs}
+
+    def completed(self, name, outputs):
+        """
+        Check whether a stage with the given outputs completed in the run being resumed, and its
+        outputs are all still there, unchanged. Stages without outputs never count as completed.
+        """
+        with self.lock:
+            recorded = self.stages.get(name)
+        if not outputs or not recorded or sorted(recorded) != sorted(outputs):
+            return False
+        if name not in self.checked:
+            self.checked[name] = (None not in recorded.values()
+                                  and self._hashes(outputs) == recorded)
+            if not self.checked[name]:
+                print(f"The outputs of {name} have changed since it completed.")
+        return self.checked[name]
+
+    def check(self, stage_outputs):
+        """
+        Check the outputs of a number of stages (given as a dict mapping each stage's name to its
+        outputs) at the same time, so that completed() doesn't have to check them one by one.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            list(pool.map(lambda stage: self.completed(*stage), stage_outputs.items()))
+
+    def forget(self, name):
+        """Remove a stage that is about to be run again from the journal."""
+        with self.lock:
+            if self.stages.pop(name, None) is not None:
+                self._save()
+
+    def record(self, name, outputs):
+        """
+        Record that a stage has completed. Returns False if its outputs are the same as those
+        recorded when it last completed (e.g., a fetch that found its sources up to date), so
+        the stages that depend on it don't have to be run again on its account.
+        """
+        hashes = self._hashes(outputs)
+        with self.lock:
+            self.stages[name] = hashes
+            self._save()
+        return self.resumed.get(name) != hashes
+
+
+class BuildGraph:
+    """
+    A directed acyclic graph of build stages. Each stage is started as soon as all of the stages
+    that it depends on have completed, with no more than a given number of stages running at
+    the same time. Fetch stages (named "fetch ...") are mostly waiting on the network rather
+    than using the CPU, so they are limited separately.
+    """
+    def __init__(self):
+        # Maps stage name to a tuple containing the function that runs the stage, the list of
+        # names of stages it depends on, the list of shared directories it builds in, and the
+        # list of files it produces, in the order they were added.
+        self.stages = {}
+
+    def add(self, name, func, depends=(), build_dirs=(), outputs=()):
+        """
+        Add a stage. All of the stages it depends on must have been added already, which makes
+        it impossible to create a dependency loop. The stage holds the directory_lock() of each
+        of the build_dirs while it runs. The outputs are the files that the stages that depend
+        on it use, which are recorded in the RunJournal, if there is one.
+        """
+        if name in self.stages:
+            raise ValueError(f"Build stage '{name}' added twice.")
+        for dependency in depends:
+            if dependency not in self.stages:
+                raise ValueError(f"Build stage '{name}' depends on unknown stage '{dependency}'.")
+        self.stages[name] = (func, list(depends), list(build_dirs), list(outputs))
+
+    @staticmethod
+    def is_fetch_stage(name):
+        """Check whether a stage only fetches sources."""
+        return name.startswith("fetch ")
+
+    @staticmethod
+    def _run_stage(report, slots, journal, name, func, depends, build_dirs, outputs):
+        """
+        Run a stage, holding the locks on its build directories (which are taken in order, to
+        avoid deadlocks) and, if slots (a StageSlots) is given, one of its slots, then record it
+        in the journal, if given. Returns True if its outputs may have changed (see
+        RunJournal.record()).
+        """
+        locks = [directory_lock(path) for path in sorted(set(build_dirs))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            if slots:
+                slots.acquire(report)
+            try:
+                report.run_stage(name, depends, func)
+            finally:
+                if slots:
+                    slots.release(report)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return journal.record(name, outputs) if journal else True
+
+    def run(self, jobs=1, report=None, slots=None, fetch_jobs=None, journal=None):
+        """
+        Run all the stages, recording them in report (by default, the global build_report). No
+        more than jobs build stages, and fetch_jobs (by default, jobs) fetch stages, run at the
+        same time. If slots (a StageSlots) is given, each build stage must also get one of its
+        slots to run. If any stage fails, no more stages are started, the stages already running
+        are allowed to finish, and then an exception is raised.
+        If a RunJournal is given, each stage that completes is recorded in it, and the stages
+        that it says completed in an earlier run are skipped, as long as none of the stages that
+        they depend on had to be run again and produced something different. Fetch stages are
+        always run, because they are checkpointed anyway. Stages without outputs (e.g., those
+        that prepare leaf workspaces) are always run too, and count as having produced something
+        different only if one of the stages that they depend on did.
+        """
+        report = report or build_report
+        fetch_jobs = fetch_jobs or jobs
+        done = set()
+        # The stages that ran and whose outputs may have changed since the journal's record.
+        changed = set()
+        failed = []
+        running = {}
+        if journal:
+            journal.check({name: outputs for name, (_, _, _, outputs) in self.stages.items()
+                           if not self.is_fetch_stage(name)})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs + fetch_jobs) as pool:
+            while True:
+                skipped = False
+                if not failed:
+                    started = set(running.values())
+                    fetching = sum(1 for name in started if self.is_fetch_stage(name))
+                    building = len(started) - fetching
+                    for name, (func, depends, build_dirs, outputs) in self.stages.items():
+                        if (name in done or name in started
+                                or not all(dependency in done for dependency in depends)):
+                            continue
+                        if (journal and not self.is_fetch_stage(name)
+                                and not any(dependency in changed for dependency in depends)
+                                and journal.completed(name, outputs)):
+                            report.progress(f"---- Skipping {name} (completed earlier) ----")
+                            done.add(name)
+                            skipped = True
+                            continue
+                        if self.is_fetch_stage(name):
+                            if fetching >= fetch_jobs:
+                                continue
+                            fetching += 1
+                        else:
+                            if building >= jobs:
+                                continue
+                            building += 1
+                        report.progress(f"---- Starting {name} ----")
+                        if journal:
+                            journal.forget(name)
+                        future = pool.submit(self._run_stage, report,
+                                             None if self.is_fetch_stage(name) else slots,
+                                             journal, name, func, depends, build_dirs, outputs)
+                        running[future] = name
+                if not running:
+                    if skipped:
+                        # Stages that were waiting on the skipped stages may now be ready.
+                        continue
+                    break
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    _, depends, _, outputs = self.stages[name]
+                    try:
+                        outputs_changed = future.result()
+                        if outputs_changed if outputs else not changed.isdisjoint(depends):
+                            changed.add(name)
+                    except Exception as e:
+                        report.progress(f"**** {name} FAILED: {e}")
+                        report.progress(f"**** See {report.log_file(name)}")
+                        failed.append(name)
+                    else:
+                        report.progress(f"---- Finished {name} ----")
+                        done.add(name)
+        if failed:
+            raise RuntimeError(f"Build stages failed: {', '.join(failed)}")
+
+
+def add_target_stages(graph, release, board, module, shared_stages):
+    """
+    Add the stages that build Yocto (if needed), Legato, the Octave apps, and finally the mangOH
+    system and SPK for a given board and module in a release. Each of these produces leaf
+    packages, which are added to the release's leaf remote for use by the subsequent stages.
+    shared_stages maps each Yocto and Legato build directory to the last stage added that builds
+    in it. A stage that builds in a directory shared with another release's stage runs after it,
+    so it finds everything already built there, and only has to package it. The stages that
+    build in shared directories also lock them, in case another build is using them.
+    Each stage's outputs are the leaf packages it adds to the remote, and the files it leaves for
+    the stages after it (see RunJournal).
+    """
+    def after_shared(build_dir, stage):
+        """Get the list of stages that must finish before stage, which builds in build_dir."""
+        previous_stage = shared_stages.get(build_dir)
+        shared_stages[build_dir] = stage
+        return [previous_stage] if previous_stage else []
+
+    def package_file(package_id):
+        return f"{release.leaf_remote.remote_dir}/{package_id}.leaf"
+
+    def spk_file(octave):
+        return (f"{release.staging_dir}/{board}-{module}-spk/"
+                f"{spk_file_name(release, board, module, octave)}")
+
+    target = release.target(board, module)
+    graph.add(f"workspace {target}", lambda: prepare_leaf_workspace(release, board, module))
+    yocto_depends = []
+    yocto_dirs = []
+    yocto_outputs = []
+    if release.spec["boards"][board][module].get("yocto"):
+        yocto_dirs = [yocto_build_dir(release, board, module)]
+        yocto_depends = (after_shared(yocto_dirs[0], f"yocto {target}")
+                         + [release.yocto_fetch_stage(board, module)])
+        yocto_outputs = [package_file(toolchain_package_id(release, board, module)),
+                         package_file(linux_package_id(release, board, module))]
+    graph.add(f"yocto {target}", lambda: build_yocto(release, board, module), yocto_depends,
+              yocto_dirs, yocto_outputs)
+    legato_depends = [f"workspace {target}", f"yocto {target}", release.fetch_stage("legato")]
+    legato_dirs = []
+    legato_outputs = []
+    legato_board = get_legato_board(release, board, module)
+    if legato_board != board:
+        # The Legato build is shared with another board.
+        legato_depends.append(f"legato {release.target(legato_board, module)}")
+    elif release.spec.get("legato"):
+        legato_dirs = [legato_build_dir(release, board, module)]
+        legato_depends += after_shared(legato_dirs[0], f"legato {target}")
+        legato_outputs = [package_file(legato_package_id(release, board, module))]
+    graph.add(f"legato {target}", lambda: build_legato(release, board, module), legato_depends,
+              legato_dirs, legato_outputs)
+    # The SPK stages build against the Octave build tree, as well as the package.
+    graph.add(f"octave {target}", lambda: build_octave(release, board, module),
+              [f"legato {target}", release.fetch_stage("octave"), release.fetch_stage("mangoh")],
+              outputs=[package_file(octave_package_id(release, board, module)),
+                       f"{octave_build_dir(release, board, module)}/build/"
+                       f"Octave-mangOH-{board}-{module}.leaf"])
+    # The Octave and non-Octave SPKs are built at the same time, in separate directories.
+    graph.add(f"spk {target}", lambda: build_mangoh_spk(release, board, module, True),
+              [f"octave {target}"], outputs=[spk_file(True)])
+    graph.add(f"spk-no-octave {target}", lambda: build_mangoh_spk(release, board, module, False),
+              [f"octave {target}"], outputs=[spk_file(False)])
+    graph.add(f"mangoh {target}", lambda: build_mangoh(release, board, module),
+              [f"spk {target}", f"spk-no-octave {target}"],
+              outputs=[package_file(f"mangOH-{board}-{module}_{release.version}")])
+
+
+def add_delta_stage(graph, release, board, module, releases):
+    """
+    Add the stage that generates the SPK deltas for a board and module from earlier releases
+    (see build_deltas()), which waits for both SPKs, and for the master package of any of the
+    earlier releases that is being built at the same time.
+    """
+    target = release.target(board, module)
+    depends = [f"spk {target}", f"spk-no-octave {target}"]
+    for other in releases:
+        other_stage = f"mangoh {other.target(board, module)}"
+        if other.version in release.spec["deltas"]["from"] and other_stage in graph.stages:
+            depends.append(other_stage)
+    graph.add(f"delta {target}", lambda: build_deltas(release, board, module), depends,
+              outputs=[f"{release.leaf_remote.remote_dir}/"
+                       f"{delta_package_id(release, board, module)}.leaf"])
+
+
+def build_graph(releases, in_use=None):
+    """
+    Get the BuildGraph for building one or more releases. All the sources (the Octave, Legato,
+    and mangOH sources, which are common to all boards and modules, and each Yocto tree's) are
+    fetched by stages that can start straight away, and releases that fetch the same sources
+    share the stages that fetch them (see assign_shared_dirs(), which is given in_use). Each
+    board+module combination is built as soon as the sources it needs have been fetched. Builds
+    for different boards and modules are independent of each other, so they can run concurrently.
+    """
+    assign_shared_dirs(releases, in_use)
+    graph = BuildGraph()
+    for release in releases:
+        for sources, fetch, root in [("legato", fetch_legato, release.legato_repo_root),
+                                     ("octave", fetch_octave, release.octave_root),
+                                     ("mangoh", fetch_mangoh, release.mangoh_root)]:
+            if release.fetch_stage(sources) not in graph.stages:
+                graph.add(release.fetch_stage(sources), lambda fetch=fetch, release=release:
+                          fetch(release), build_dirs=[root], outputs=[f"{root}/.fetched"])
+    for release in releases:
+        for board, board_spec in release.spec["boards"].items():
+            for module, module_spec in board_spec.items():
+                name = release.yocto_fetch_stage(board, module)
+                if module_spec.get("yocto") and name not in graph.stages:
+                    yocto_dir = yocto_build_dir(release, board, module)
+                    graph.add(name, lambda release=release, board=board, module=module:
+                              fetch_yocto(release, board, module),
+                              build_dirs=[yocto_dir], outputs=[f"{yocto_dir}/.fetched"])
+    shared_stages = {}
+    for release in releases:
+        for board, board_spec in release.spec["boards"].items():
+            for module in board_spec:
+                add_target_stages(graph, release, board, module, shared_stages)
+    for release in releases:
+        if release.spec.get("deltas"):
+            for board, board_spec in release.spec["boards"].items():
+                for module in board_spec:
+                    add_delta_stage(graph, release, board, module, releases)
+    return graph
+
+
+def format_duration(seconds):
+    """Format a number of seconds like "1h02m" or "3m05s"."""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02}m" if hours else f"{minutes}m{seconds:02}s"
+
+
+def unqualified_stage_name(name):
+    """Remove the release version (see Release.stage_prefix) from a build stage name."""
+    kind, _, target = name.partition(" ")
+    return f"{kind} {target.split(':')[-1]}"
+
+
+def load_stage_history():
+    """
+    Get the wall clock times of the stages that succeeded in previous builds, from the reports
+    in REPORT_DIR. Returns a tuple containing a dict mapping stage name (without any release
+    version) to the longest time recorded for it, and a dict mapping stage kind to the mean
+    time recorded for it.
+    """
+    by_name = {}
+    by_kind = {}
+    for path in glob.glob(f"{REPORT_DIR}/build-report-*.json"):
+        try:
+            with open(path) as f:
+                stages = json.load(f)["stages"]
+        except (OSError, ValueError, KeyError):
+            continue
+        for stage in stages:
+            if stage.get("status") == "succeeded":
+                name = unqualified_stage_name(stage["name"])
+                by_name[name] = max(by_name.get(name, 0), stage["wall_time"])
+                by_kind.setdefault(stage["kind"], []).append(stage["wall_time"])
+    return by_name, {kind: sum(times) / len(times) for kind, times in by_kind.items()}
+
+
+def plan_fetch(description, root, get_inputs):
+    """
+    Work out what a checkpointed_fetch() of sources into root would do, without contacting
+    any remotes. get_inputs() returns the inputs that the fetch would be given.
+    """
+    try:
+        key = fetch_stage_key(description, get_inputs())
+    except UnresolvedRefError as e:
+        if os.path.exists(f"{root}/.fetched"):
+            return f"fetched before, but {e}"
+        return "fetch"
+    if read_checkpoint(f"{root}/.fetched") == key:
+        return "up to date"
+    if build_cache and build_cache.contains(key):
+        return "restore from cache"
+    return "fetch"
+
+
+def plan_yocto(release, board, module):
+    """Work out what build_yocto() would do for a board and module, without contacting remotes."""
+    yocto_spec = release.spec["boards"][board][module].get("yocto")
+    if not yocto_spec:
+        return "nothing to do"
+    checkpoint_file = f"{target_dir(release, board, module)}/.yocto-packaged"
+    packaged = all(os.path.exists(f"{release.leaf_remote.remote_dir}/{package_id}.leaf")
+                   for package_id in [toolchain_package_id(release, board, module),
+                                      linux_package_id(release, board, module)])
+    try:
+        source_inputs = yocto_source_inputs(yocto_spec)
+    except UnresolvedRefError as e:
+        if packaged and os.path.exists(checkpoint_file):
+            return f"built before, but {e}"
+        return "build"
+    key = yocto_build_key(release, board, module, source_inputs)
+    if packaged and read_checkpoint(checkpoint_file) == key:
+        return "up to date"
+    if build_cache and build_cache.contains(key):
+        return "restore from cache"
+    tree_checkpoint_file = f"{yocto_build_dir(release, board, module)}/.built"
+    if read_checkpoint(tree_checkpoint_file) == yocto_tree_key(source_inputs):
+        return "package"
+    return "build"
+
+
+def plan_legato(release, board, module, fetch_action):
+    """
+    Work out what build_legato() would do for a board and module, without contacting remotes,
+    given what the stage that fetches the Legato sources would do.
+    """
+    if not release.spec.get("legato"):
+        return "nothing to do"
+    if get_legato_board(release, board, module) != board:
+        return "nothing to do (shared)"
+    if fetch_action != "up to date":
+        return "build"
+    try:
+        toolchain_key = get_toolchain_key(release, board, module)
+    except UnresolvedRefError:
+        return "build"
+    if read_checkpoint(f"{legato_build_dir(release, board, module)}/.built") == toolchain_key:
+        return "package"
+    return "build"
+
+
+def check_legato_patches(spec):
+    """Get a list of the problems with the Legato "patches" list that fetch_legato() would hit."""
+    legato_spec = spec.get("legato")
+    if not legato_spec:
+        return []
+    patches = legato_spec.get("patches", [])
+    if not isinstance(patches, list):
+        return ["legato patches list is not a list"]
+    problems = []
+    for i, patch in enumerate(patches):
+        if not isinstance(patch, dict):
+            problems.append(f"legato patch {i} is not an object")
+            continue
+        if not isinstance(patch.get("dir", ""), str):
+            problems.append(f"legato patch {i}: dir is not a string")
+        cherry_pick_spec = patch.get("cherry_pick")
+        gerrit_review_spec = patch.get("gerrit_review")
+        if bool(cherry_pick_spec) == bool(gerrit_review_spec):
+            problems.append(f"legato patch {i}: exactly one of gerrit_review and cherry_pick"
+                            f" is needed")
+        elif cherry_pick_spec and not isinstance(cherry_pick_spec, str):
+            problems.append(f"legato patch {i}: cherry_pick is not a string")
+        elif gerrit_review_spec and not (
+                isinstance(gerrit_review_spec, dict)
+                and all(isinstance(gerrit_review_spec.get(member), str)
+                        for member in ["project", "patch_set"])):
+            problems.append(f"legato patch {i}: gerrit_review needs 'project' and 'patch_set'"
+                            f" strings")
+    return problems
+
+
+def known_leaf_packages(release):
+    """
+    Get the set of IDs of the packages listed in the leaf remote indexes available locally: the
+    index of the release's leaf remote and the remote indexes that leaf has cached in LEAF_CACHE.
+    Returns None if there aren't any.
+    """
+    packages = None
+    index_files = glob.glob(f"{LEAF_CACHE}/**/*.json", recursive=True)
+    for path in [f"{release.leaf_remote.remote_dir}/mangOH.json"] + index_files:
+        try:
+            with open(path) as f:
+                entries = json.load(f)["packages"]
+            ids = {f"{entry['info']['name']}_{entry['info']['version']}" for entry in entries}
+        except (OSError, ValueError, KeyError, TypeError):
+            continue
+        packages = (packages or set()) | ids
+    return packages
+
+
+def check_packages(release):
+    """
+    Get a list of the problems found with the leaf packages that the release depends on, checking
+    only what can be checked locally: that the packages are in the locally available indexes,
+    and that the modem firmware files are in the modem image packages that are installed.
+    """
+    spec = release.spec
+    problems = []
+    known_packages = known_leaf_packages(release)
+    if known_packages is None:
+        print(f"No leaf remote indexes are available locally, so the dependencies of"
+              f" {release.version} can't be checked.")
+    built_packages = set()
+    for board, board_spec in spec["boards"].items():
+        for module in board_spec:
+            built_packages.update([toolchain_package_id(release, board, module),
+                                   linux_package_id(release, board, module),
+                                   legato_package_id(release, board, module),
+                                   octave_package_id(release, board, module)])
+    for board, board_spec in spec["boards"].items():
+        for module, module_spec in board_spec.items():
+            for package in get_mangoh_depends(release, board, module):
+                package = remove_latest(package)
+                if package in built_packages or known_packages is None:
+                    continue
+                if not any(known == package or known.startswith(f"{package}_")
+                           for known in known_packages):
+                    problems.append(f"{board} {module}: leaf package {package} not found")
+            abbreviation = get_abbreviated_module(module)
+            for package in module_spec.get("depends", []):
+                package_dir = f"{LEAF_USER_ROOT}/{package}"
+                if (package.startswith(f"{abbreviation}-modem-image_")
+                        and os.path.isdir(package_dir)
+                        and not os.path.exists(f"{package_dir}/{module_spec['modem_firmware']}")):
+                    problems.append(f"{board} {module}: {module_spec['modem_firmware']} is not in"
+                                    f" {package}")
+    return problems
+
+
+def plan_build(releases, graph):
+    """
+    Print what each stage of the graph for building the releases would do and how long it is
+    likely to take (based on previous build reports), and the estimated critical path, then check
+    the specs for problems that would otherwise only show up part way through the build. This
+    doesn't run any commands or contact any remotes, so unpinned refs can't be checked.
+    Returns True if no problems were found.
+    """
+    history_by_name, history_by_kind = load_stage_history()
+    actions = {}
+    # Maps each Yocto and Legato build directory to the stage that would build in it.
+    builders = {}
+
+    def plan_shared(build_dir, stage, action):
+        """Adjust the action of a stage that builds in a directory shared by several releases."""
+        if action == "build" and build_dir in builders:
+            return f"package (built by {builders[build_dir]})"
+        if action == "build":
+            builders[build_dir] = stage
+        return action
+
+    for release in releases:
+        spec = release.spec
+        for sources, description, root, get_inputs in [
+                ("legato", "Legato", release.legato_repo_root,
+                 lambda: legato_source_inputs(spec)),
+                ("octave", "Octave", release.octave_root, lambda: octave_source_inputs(spec)),
+                ("mangoh", "mangOH", release.mangoh_root, lambda: mangoh_source_inputs(spec))]:
+            name = release.fetch_stage(sources)
+            if name in actions:
+                continue
+            if sources == "legato" and not spec.get("legato"):
+                actions[name] = "nothing to do"
+            else:
+                actions[name] = plan_fetch(description, root, get_inputs)
+            if sources == "legato" and actions[name] == "fetch":
+                # Only the patches may have changed (see PatchSnapshots).
+                try:
+                    snapshots = PatchSnapshots(root, legato_unpatched_key(get_inputs()))
+                    if snapshots.base_heads is not None:
+                        actions[name] = "patch"
+                except UnresolvedRefError:
+                    pass
+        for board, board_spec in spec["boards"].items():
+            for module in board_spec:
+                target = release.target(board, module)
+                actions[f"workspace {target}"] = "run"
+                yocto_action = plan_yocto(release, board, module)
+                actions[f"yocto {target}"] = plan_shared(
+                    yocto_build_dir(release, board, module), f"yocto {target}", yocto_action)
+                yocto_spec = board_spec[module].get("yocto")
+                fetch_name = release.yocto_fetch_stage(board, module)
+                if yocto_spec and fetch_name not in actions:
+                    if yocto_action != "build" or not executor.fetches_locally:
+                        actions[fetch_name] = "nothing to do"
+                    else:
+                        actions[fetch_name] = plan_fetch(
+                            f"Yocto {board} {module}", yocto_build_dir(release, board, module),
+                            lambda yocto_spec=yocto_spec: yocto_source_inputs(yocto_spec))
+                legato_action = plan_legato(release, board, module,
+                                            actions[release.fetch_stage("legato")])
+                if legato_action in ["build", "package"]:
+                    legato_action = plan_shared(legato_build_dir(release, board, module),
+                                                f"legato {target}", legato_action)
+                actions[f"legato {target}"] = legato_action
+                for kind in ["octave", "spk", "spk-no-octave", "mangoh"]:
+                    actions[f"{kind} {target}"] = "build"
+                if spec.get("deltas"):
+                    actions[f"delta {target}"] = "build"
+
+    estimates = {}
+    for name in graph.stages:
+        kind = name.split(" ", 1)[0]
+        if actions[name] in ["up to date", "nothing to do", "nothing to do (shared)"]:
+            estimates[name] = 0
+        elif actions[name] == "build" or actions[name].startswith("fetch"):
+            history = history_by_name.get(unqualified_stage_name(name))
+            if kind == "fetch":
+                # Each fetch stage fetches different sources, so they can't be compared.
+                estimates[name] = history
+            else:
+                estimates[name] = history if history is not None else history_by_kind.get(kind)
+        else:
+            estimates[name] = None
+
+    # The estimated critical path is the longest path through the graph. The stages were added in
+    # dependency order, so each stage's dependencies have been visited by the time it is.
+    path_time = {}
+    path = {}
+    for name, (_, depends, _, _) in graph.stages.items():
+        longest = max(depends, key=lambda dependency: path_time[dependency], default=None)
+        path[name] = (path[longest] if longest else []) + [name]
+        path_time[name] = (path_time[longest] if longest else 0) + (estimates[name] or 0)
+    critical_path = path[max(path_time, key=path_time.get)] if path_time else []
+
+    print(f"Build plan for mangOH release {', '.join(release.version for release in releases)}:")
+    width = max(map(len, graph.stages))
+    for name in graph.stages:
+        estimate = "?" if estimates[name] is None else format_duration(estimates[name])
+        marker = "*" if name in critical_path else " "
+        print(f" {marker} {name:{width}} {estimate:>8}  {actions[name]}")
+    if critical_path:
+        print(f"Estimated critical path ({format_duration(path_time[critical_path[-1]])},"
+              f" marked with *): {' -> '.join(critical_path)}")
+
+    problems = []
+    for release in releases:
+        problems += [f"{release.version}: {problem}"
+                     for problem in check_legato_patches(release.spec) + check_packages(release)]
+    for problem in problems:
+        print(f"**** {problem}")
+    return not problems
+
+
+def check_releases(releases):
+    """
+    Catch problems with the leaf manifests and packing options of the releases before spending
+    hours building them. Raises a ValueError for an unknown compressor. Returns True if all the
+    leaf manifests can be generated.
+    """
+    for release in releases:
+        for package_type in PACKAGE_TYPES:
+            get_compressor(release.spec, package_type)
+    return all([check_manifests(release) for release in releases])
+
+
+class BuildJob:
+    """
+    A request made to a BuildDaemon to build one or more releases, given their spec files.
+    The lines of progress output of the job's build are kept, so that any number of clients can
+    follow it (see watch()).
+    """
+    def __init__(self, job_id, spec_files):
+        self.id = job_id
+        self.spec_files = spec_files
+        self.releases = [Release(spec_file) for spec_file in spec_files]
+        self.versions = [release.version for release in self.releases]
+        if len(set(self.versions)) != len(self.versions):
+            raise ValueError("the same release version can't be built twice at the same time")
+        self.submitted = time.time()
+        # One of "queued", "running", "succeeded" or "failed".
+        self.status = "queued"
+        self.output = []
+        self.condition = threading.Condition()
+        self.report = BuildReport(progress=self.add_output, log_dir=f"{LOG_DIR}/job-{job_id}")
+        self.report_path = None
+        # The BuildGraph, once the job has been started.
+        self.graph = None
+
+    def add_output(self, line):
+        """Add a line to the job's progress output."""
+        print(f"[job {self.id}] {line}")
+        with self.condition:
+            self.output.append(line)
+            self.condition.notify_all()
+
+    def set_status(self, status):
+        with self.condition:
+            self.status = status
+            self.condition.notify_all()
+
+    def summary(self):
+        return {
+            "job": self.id,
+            "versions": self.versions,
+            "status": self.status,
+            "submitted": self.submitted,
+            "report": self.report_path,
+        }
+
+    def watch(self):
+        """Generate the lines of the job's progress output, as they come, until it finishes."""
+        next_line = 0
+        while True:
+            with self.condition:
+                while (next_line == len(self.output)
+                       and self.status in ["queued", "running"]):
+                    self.condition.wait()
+                lines = self.output[next_line:]
+                finished = self.status not in ["queued", "running"]
+            next_line += len(lines)
+            yield from lines
+            if finished and not lines:
+                return
+
+
+class BuildDaemon:
+    """
+    A long-running build server that builds releases on request. Clients (see submit_job()) queue
+    jobs and follow their progress through a Unix socket, over which requests and replies are
+    sent as lines of JSON.
+
+    Because it keeps running between jobs, everything the build keeps in memory stays warm: the
+    leaf remotes' index entries (see get_leaf_remote()), the prepared leaf workspaces and the
+    fetched remote indexes, the git mirrors (which are still updated once per job), and the build
+    cache metadata. Queued jobs are started, in order, as soon as no running job is building any
+    of the same release versions. All the running jobs share the same number of stage slots (see
+    StageSlots), and copies of shared directories are only shared between running jobs whose
+    specs make them identical (see assign_shared_dirs()), with the stages that build in them
+    taking turns (see directory_lock()).
+    """
+    def __init__(self, socket_path, jobs, fetch_jobs):
+        self.socket_path = socket_path
+        self.jobs = jobs
+        self.fetch_jobs = fetch_jobs
+        self.slots = StageSlots(jobs)
+        self.lock = threading.Lock()
+        # Maps job ID to BuildJob, in the order they were submitted.
+        self.build_jobs = {}
+        self.next_job_id = 1
+
+    def submit(self, spec_files):
+        """Queue a job to build the releases with the given spec files. Returns the BuildJob."""
+        with self.lock:
+            job = BuildJob(self.next_job_id, spec_files)
+            self.next_job_id += 1
+            self.build_jobs[job.id] = job
+            job.add_output(f"Queued the build of mangOH release {', '.join(job.versions)}.")
+            self._start_jobs()
+        return job
+
+    def _start_jobs(self):
+        """Start every queued job that can be started. Must be called with the lock held."""
+        running = [job for job in self.build_jobs.values() if job.status == "running"]
+        busy_versions = {version for job in running for version in job.versions}
+        for job in self.build_jobs.values():
+            if job.status == "queued" and busy_versions.isdisjoint(job.versions):
+                in_use = shared_dirs_in_use([release for other in running
+                                             for release in other.releases])
+                try:
+                    job.graph = build_graph(job.releases, in_use)
+                except Exception as e:
+                    job.add_output(f"**** {e!r}")
+                    job.set_status("failed")
+                    continue
+                job.set_status("running")
+                running.append(job)
+                busy_versions.update(job.versions)
+                threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        status = "failed"
+        try:
+            # The job may have been queued for a while.
+            job.report.refresh_after = time.time()
+            if not check_releases(job.releases):
+                raise ValueError("some leaf manifests can't be generated (see the daemon's"
+                                 " output)")
+            job.graph.run(self.jobs, job.report, self.slots, self.fetch_jobs)
+            for release in job.releases:
+                release.leaf_remote.refresh()
+            for release in job.releases:
+                job.add_output(f"==== RELEASE {release.version} BUILD COMPLETE ====")
+                job.add_output(f"The leaf packages are in {release.leaf_remote.remote_dir}")
+            status = "succeeded"
+        except Exception as e:
+            job.add_output(f"**** {e}")
+        finally:
+            job.report_path = job.report.write('+'.join(job.versions))
+            job.add_output(f"Build report written to {job.report_path}")
+            with self.lock:
+                job.set_status(status)
+                self._start_jobs()
+
+    def handle(self, request, reply):
+        """
+        Handle a request from a client, calling reply() with each object to send back.
+        The requests are:
+            {"submit": [<spec file>, ...], "watch": <bool>}: queue a job, reply with its summary,
+                and, if watch is true, follow it as for "watch".
+            {"watch": <job ID>}: reply with {"output": <line>} for each line of the job's
+                progress output, and finally with the job's summary once it has finished.
+            {"status": null}: reply with {"jobs": [<job summary>, ...]}.
+        Any error is replied with {"error": <message>}.
+        """
+        if "submit" in request:
+            try:
+                job = self.submit(request["submit"])
+            except (OSError, ValueError, AssertionError, KeyError) as e:
+                reply({"error": f"Can't build {', '.join(request['submit'])}: {e!r}"})
+                return
+            reply(job.summary())
+            if not request.get("watch"):
+                return
+        elif "watch" in request:
+            job = self.build_jobs.get(request["watch"])
+            if not job:
+                reply({"error": f"No job {request['watch']}."})
+                return
+        elif "status" in request:
+            with self.lock:
+                reply({"jobs": [job.summary() for job in self.build_jobs.values()]})
+            return
+        else:
+            reply({"error": f"Unknown request {request}."})
+            return
+        for line in job.watch():
+            reply({"output": line})
+        reply(job.summary())
+
+    def serve(self):
+        """Serve requests until the process is killed."""
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def reply(message):
+                    self.wfile.write((json.dumps(message) + "\n").encode())
+                    self.wfile.flush()
+                try:
+                    daemon.handle(json.loads(self.rfile.readline()), reply)
+                except (ValueError, AttributeError) as e:
+                    reply({"error": f"Bad request: {e}"})
+                except BrokenPipeError:
+                    # The client went away. Its job (if any) carries on.
+                    pass
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        with socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler) as server:
+            server.daemon_threads = True
+            print(f"Build daemon listening on {self.socket_path}, running up to {self.jobs}"
+                  f" build stages at the same time.")
+            server.serve_forever()
+
+
+def send_daemon_request(socket_path, request):
+    """
+    Send a request to the BuildDaemon listening on socket_path, and generate the objects that it
+    replies with.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile("rw") as connection:
+            connection.write(json.dumps(request) + "\n")
+            connection.flush()
+            for line in connection:
+                yield json.loads(line)
+
+
+def submit_job(socket_path, spec_files):
+    """
+    Submit a job to build the releases with the given spec files to the BuildDaemon listening on
+    socket_path, and print its progress output as it is built. Returns True if it succeeded.
+    """
+    request = {"submit": [os.path.abspath(spec_file) for spec_file in spec_files], "watch": True}
+    for message in send_daemon_request(socket_path, request):
+        if "error" in message:
+            print(f"**** {message['error']}")
+            return False
+        if "output" in message:
+            print(message["output"])
+        elif message["status"] in ["queued", "running"]:
+            print(f"Submitted job {message['job']}.")
+        else:
+            print(f"Job {message['job']} {message['status']}.")
+            return message["status"] == "succeeded"
+    print("**** Lost contact with the build daemon.")
+    return False
+
+
+def print_daemon_status(socket_path):
+    """Print the status of all the jobs submitted to the BuildDaemon listening on socket_path."""
+    for message in send_daemon_request(socket_path, {"status": None}):
+        for job in message["jobs"]:
+            submitted = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job["submitted"]))
+            print(f"{job['job']:>5}  {submitted}  {job['status']:<9}  {', '.join(job['versions'])}")
+
+
+class PublishTarget:
+    """
+    The place where the published mangOH leaf remote is kept, which holds a directory of leaf
+    packages for each release, and an index (mangOH.json) of all of them. Paths are relative to
+    the root of the remote.
+    """
+    def list_dir(self, path):
+        """Get a dict mapping the name of each file in a directory to its size, if it exists."""
+        raise NotImplementedError
+
+    def get(self, path, dest):
+        """Copy a file from the remote to dest."""
+        raise NotImplementedError
+
+    def put(self, src, path):
+        """
+        Copy the file at src to path, creating its directory if needed. A file that is already
+        at path is replaced atomically, if the target allows it.
+        """
+        raise NotImplementedError
+
+    def verify(self, src, path):
+        """Raise a ValueError if the file at path doesn't match the file at src."""
+        raise NotImplementedError
+
+
+class DirectoryTarget(PublishTarget):
+    """A leaf remote in a local directory (e.g., for trying out a publish)."""
+    def __init__(self, root):
+        self.root = root
+
+    def __str__(self):
+        return self.root
+
+    def list_dir(self, path):
+        directory = f"{self.root}/{path}"
+        if not os.path.isdir(directory):
+            return {}
+        return {name: os.path.getsize(f"{directory}/{name}") for name in os.listdir(directory)
+                if os.path.isfile(f"{directory}/{name}")}
+
+    def get(self, path, dest):
+        shutil.copy(f"{self.root}/{path}", dest)
+
+    def put(self, src, path):
+        dest = f"{self.root}/{path}"
+        os.makedirs(os.path.dirname(dest), exist_ok = True)
+        shutil.copy(src, f"{dest}.partial")
+        os.replace(f"{dest}.partial", dest)
+
+    def verify(self, src, path):
+        if file_hash(f"{self.root}/{path}") != file_hash(src):
+            raise ValueError(f"{path} in {self} doesn't match {src}.")
+
+
+class SftpTarget(PublishTarget):
+    """
+    A leaf remote in a directory on an SFTP server (which is all that Akamai NetStorage allows).
+    Each operation is run as a batch of sftp commands. Files are uploaded under a temporary name
+    and then renamed over the file they replace, so a file is never seen half uploaded or
+    missing. There's no shell on the server to hash files with, so files are verified by
+    downloading them again.
+    """
+    def __init__(self, host, root):
+        self.host = host
+        self.root = root
+
+    def __str__(self):
+        return f"{self.host}:{self.root}"
+
+    def _sftp(self, commands):
+        """Run a list of sftp commands on the server. Returns their output."""
+        batch = "".join(f"{command}\n" for command in commands)
+        return shell_output(f"printf %s {shlex.quote(batch)} | sftp -q -b - {self.host}")
+
+    def _path(self, path):
+        return shlex.quote(f"{self.root}/{path}".rstrip("/"))
+
+    def list_dir(self, path):
+        # A "-" in front of a command keeps the batch going if it fails (i.e., if the directory
+        # doesn't exist).
+        files = {}
+        for line in self._sftp([f"-ls -l {self._path(path)}"]).splitlines():
+            fields = line.split(maxsplit=8)
+            if len(fields) == 9 and fields[0].startswith("-"):
+                files[os.path.basename(fields[8])] = int(fields[4])
+        return files
+
+    def get(self, path, dest):
+        self._sftp([f"get {self._path(path)} {shlex.quote(dest)}"])
+
+    def put(self, src, path):
+        commands = []
+        directory = ""
+        for name in os.path.dirname(path).split("/"):
+            directory = f"{directory}/{name}" if directory else name
+            if name:
+                commands.append(f"-mkdir {self._path(directory)}")
+        partial = self._path(path + ".partial")
+        self._sftp(commands + [f"put {shlex.quote(src)} {partial}"])
+        # sftp renames over an existing file if the server supports the posix-rename extension.
+        # If it doesn't, the old file has to be removed first, leaving a moment without one.
+        try:
+            self._sftp([f"rename {partial} {self._path(path)}"])
+        except subprocess.CalledProcessError:
+            print(f"Can't rename over {path} in {self}, removing it first.")
+            self._sftp([f"-rm {self._path(path)}", f"rename {partial} {self._path(path)}"])
+
+    def verify(self, src, path):
+        copy = f"{src}.verify"
+        try:
+            self.get(path, copy)
+            matches = file_hash(copy) == file_hash(src)
+        finally:
+            if os.path.exists(copy):
+                os.remove(copy)
+        if not matches:
+            raise ValueError(f"{path} in {self} doesn't match {src}.")
+
+
+def make_publish_target(description):
+    """
+    Get the PublishTarget described by a --publish-target option value: "sftp:<host>:<path>", or
+    the path to a local directory.
+    """
+    if description.startswith("sftp:"):
+        host, _, root = description[len("sftp:"):].partition(":")
+        return SftpTarget(host, root)
+    return DirectoryTarget(os.path.abspath(description))
+
+
+def publish_release(release, target, mirror_dir, jobs, upload=True):
+    """
+    Publish the leaf packages of a release to a PublishTarget, only copying what isn't already
+    there, and without downloading any of the packages already published.
+
+    A local mirror of the published remote's metadata is kept in mirror_dir: a copy of its index
+    and a manifest of the SHA-256 hashes of the files that have been published. The new index is
+    made by replacing the release's entries in the published index with those from the index of
+    the release's own leaf remote. Files that are already published with the same contents (e.g.,
+    by an interrupted publish) are skipped, but changing a file that was already published is an
+    error. The files are uploaded in parallel (up to jobs at a time) and each one is verified
+    once it has been uploaded. The new index goes last, so it never lists a missing package.
+    If upload is False, only the new index is made. Returns the path to the new index.
+    """
+    os.makedirs(mirror_dir, exist_ok = True)
+    index_file = f"{mirror_dir}/mangOH.json"
+    new_index_file = f"{mirror_dir}/mangOH-new.json"
+    manifest_file = f"{mirror_dir}/manifest.json"
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    index = {"info": {}, "packages": []}
+    if "mangOH.json" in target.list_dir(""):
+        target.get("mangOH.json", index_file)
+        with open(index_file) as f:
+            index = json.load(f)
+    published_entries = {entry["file"]: entry for entry in index["packages"]}
+
+    # The release's leaf remote has an up-to-date index of its packages.
+    release.leaf_remote.refresh()
+    remote_dir = release.leaf_remote.remote_dir
+    with open(f"{remote_dir}/mangOH.json") as f:
+        release_entries = json.load(f)["packages"]
+    package_files = sorted(glob.glob(f"{remote_dir}/*.leaf") + glob.glob(f"{remote_dir}/*.info"))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        hashes = dict(zip(package_files, pool.map(file_hash, package_files)))
+
+    published_files = target.list_dir(release.version)
+    uploads = []
+    for path in package_files:
+        name = os.path.basename(path)
+        published_path = f"{release.version}/{name}"
+        if name not in published_files:
+            uploads.append((path, published_path))
+            continue
+        recorded_hash = manifest.get(published_path, {}).get("sha256")
+        entry_hash = published_entries.get(published_path, {}).get("hash", "")
+        if recorded_hash:
+            same = recorded_hash == hashes[path]
+        elif entry_hash.startswith("sha384:"):
+            same = entry_hash == f"sha384:{file_hash(path, 'sha384')}"
+        else:
+            same = published_files[name] == os.path.getsize(path)
+        if not same:
+            raise ValueError(f"{published_path} has already been published to {target} with"
+                             f" different contents.")
+        manifest[published_path] = {"sha256": hashes[path], "size": os.path.getsize(path)}
+
+    entries = [entry for entry in index["packages"]
+               if not entry["file"].startswith(f"{release.version}/")]
+    entries += [dict(entry, file=f"{release.version}/{entry['file']}")
+                for entry in release_entries]
+    new_index = {
+        "info": dict(index.get("info", {}),
+                     date=time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())),
+        "packages": sorted(entries, key=lambda entry: entry["file"]),
+    }
+    with open(new_index_file, "w") as f:
+        json.dump(new_index, f, indent=4)
+    print(f"The index of {target} with release {release.version} added is in {new_index_file}"
+          f" ({len(entries)} packages).")
+    if not upload:
+        return new_index_file
+
+    print(f"Publishing {len(uploads)} of the {len(package_files)} files of release"
+          f" {release.version} to {target}...")
+    manifest_lock = threading.Lock()
+
+    def upload_file(path, published_path):
+        target.put(path, published_path)
+        target.verify(path, published_path)
+        with manifest_lock:
+            manifest[published_path] = {"sha256": hashes[path], "size": os.path.getsize(path)}
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f, indent=4)
+        print(f"Published {published_path}.")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in [pool.submit(upload_file, *upload) for upload in uploads]:
+            future.result()
+    target.put(new_index_file, "mangOH.json")
+    target.verify(new_index_file, "mangOH.json")
+    os.replace(new_index_file, index_file)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+    print(f"Published release {release.version} to {target}.")
+    return index_file
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        sys.stderr.write("Expected one argument, a JSON build spec\n")
-        sys.exit(1)
-    spec = None
-    with open(sys.argv[1]) as json_file:
-        spec = json.load(json_file)
+    parser = argparse.ArgumentParser(description="Build one or more mangOH releases.")
+    parser.add_argument("specs", nargs="*", metavar="spec",
+                        help="JSON release specification file, named <version>.json")
+    parser.add_argument("--benchmark-packing", nargs="+", metavar="STAGING_DIR",
+                        help="compare the package compressors on some package staging"
+                             " directories, instead of building")
+    parser.add_argument("--check-manifests", action="store_true",
+                        help="just check that all the leaf manifests can be generated")
+    parser.add_argument("--plan", action="store_true",
+                        help="just show what each build stage would do and how long the build is"
+                             " likely to take, and check the spec, without building anything")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="maximum number of build stages to run at the same time")
+    parser.add_argument("--fetch-jobs", type=int, default=4,
+                        help="maximum number of source fetches to run at the same time, alongside"
+                             " the build stages (default: %(default)s)")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume the last build of the same release specs, skipping the stages"
+                             " that completed and whose outputs are unchanged")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="directory in which build stage outputs are cached"
+                             " (default: %(default)s)")
+    parser.add_argument("--cache-size", type=float, default=200,
+                        help="maximum size of the build cache, in GiB (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="don't store or restore build stage outputs in the build cache")
+    parser.add_argument("--mirror-dir", default=DEFAULT_MIRROR_DIR,
+                        help="directory in which local mirrors of the git repositories are kept"
+                             " (default: %(default)s)")
+    parser.add_argument("--no-mirror", action="store_true",
+                        help="fetch directly from the remote git repositories")
+    parser.add_argument("--yocto-cache-dir", default=DEFAULT_YOCTO_CACHE_DIR,
+                        help="directory in which the Yocto downloads and shared state cache"
+                             " shared by all the Yocto builds are kept (default: %(default)s)")
+    parser.add_argument("--yocto-cache-size", type=float, default=150,
+                        help="maximum total size of the shared Yocto downloads and shared state"
+                             " cache, in GiB (default: %(default)s)")
+    parser.add_argument("--no-yocto-cache", action="store_true",
+                        help="let each Yocto build tree keep its own downloads and shared state")
+    parser.add_argument("--ccache-dir", default=DEFAULT_CCACHE_DIR,
+                        help="directory in which the compiler caches shared by the Legato, Octave"
+                             " and mangOH builds are kept (default: %(default)s)")
+    parser.add_argument("--ccache-size", type=float, default=5,
+                        help="maximum total size of the compiler caches, in GiB"
+                             " (default: %(default)s)")
+    parser.add_argument("--no-ccache", action="store_true",
+                        help="don't pass the cross compilers through ccache")
+    parser.add_argument("--daemon", metavar="SOCKET",
+                        help="instead of building, run a build daemon that takes build jobs"
+                             " through a Unix socket, running up to --jobs stages at a time")
+    parser.add_argument("--submit", metavar="SOCKET",
+                        help="have the build daemon listening on a Unix socket build the"
+                             " releases, and follow its progress")
+    parser.add_argument("--daemon-status", metavar="SOCKET",
+                        help="list the jobs of the build daemon listening on a Unix socket")
+    parser.add_argument("--executor", default="local",
+                        help="where to build the Yocto trees: local, processes:<count> (worker"
+                             " processes on this machine), or ssh:<host>,<host>,... (default:"
+                             " %(default)s)")
+    parser.add_argument("--yocto-worker", metavar="REQUEST",
+                        help="build a Yocto tree as a worker for an executor (see --executor),"
+                             " as described by a JSON request, instead of building a release")
+    parser.add_argument("--publish", action="store_true",
+                        help="instead of building, publish the releases' leaf packages to the"
+                             " publish target, and add them to its index")
+    parser.add_argument("--publish-index", action="store_true",
+                        help="just make the publish target's new index, with the releases added")
+    parser.add_argument("--publish-target", default=DEFAULT_PUBLISH_TARGET,
+                        help="where to publish: sftp:<host>:<path> or a local directory"
+                             " (default: %(default)s)")
+    parser.add_argument("--publish-mirror-dir", default=DEFAULT_PUBLISH_MIRROR_DIR,
+                        help="directory in which the metadata of the published leaf remotes is"
+                             " kept (default: %(default)s)")
+    args = parser.parse_args()
+    if args.benchmark_packing:
+        benchmark_compressors(args.benchmark_packing)
+        sys.exit(0)
+    if args.daemon_status:
+        print_daemon_status(args.daemon_status)
+        sys.exit(0)
+    if args.daemon or args.yocto_worker:
+        if args.specs:
+            parser.error("build jobs are submitted to the daemon with --submit")
+    elif not args.specs:
+        parser.error("a JSON build spec is required")
+    elif args.submit:
+        sys.exit(0 if submit_job(args.submit, args.specs) else 1)
+    releases = [Release(spec_file) for spec_file in args.specs]
+    versions = [release.version for release in releases]
+    if len(set(versions)) != len(versions):
+        parser.error("the same release version can't be built twice at the same time")
+    if args.yocto_worker:
+        # The worker's result is all that goes to the standard output. Everything else (i.e., the
+        # output of setting up and of the build) goes to the standard error, which ends up in the
+        # stage's log.
+        sys.stdout.flush()
+        result_file = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
 
-    # Extract the release version from the specification file name.
-    filename = os.path.basename(sys.argv[1].strip())
-    assert filename.endswith('.json')
-    version = filename[:-5]
-    assert version
-    print(f"Building mangOH release version {version}...");
+    if not check_releases(releases):
+        sys.exit(1)
+    if args.check_manifests:
+        print(f"All leaf manifests for release {', '.join(versions)} can be generated.")
+        sys.exit(0)
+    try:
+        options = [f"--cache-dir {shlex.quote(args.cache_dir)} --cache-size {args.cache_size}",
+                   f"--mirror-dir {shlex.quote(args.mirror_dir)}",
+                   f"--yocto-cache-dir {shlex.quote(args.yocto_cache_dir)}"
+                   f" --yocto-cache-size {args.yocto_cache_size}"]
+        if args.no_cache:
+            options[0] = "--no-cache"
+        if args.no_mirror:
+            options[1] = "--no-mirror"
+        if args.no_yocto_cache:
+            options[2] = "--no-yocto-cache"
+        executor = make_executor(args.executor, " ".join(options))
+    except ValueError as e:
+        parser.error(str(e))
+    if args.plan:
+        offline = True
+        if not args.no_cache:
+            build_cache = BuildCache(args.cache_dir, int(args.cache_size * 1024**3))
+        sys.exit(0 if plan_build(releases, build_graph(releases)) else 1)
+    if args.publish or args.publish_index:
+        publish_target = make_publish_target(args.publish_target)
+        target_hash = hashlib.sha1(args.publish_target.encode()).hexdigest()[:12]
+        for release in releases:
+            publish_release(release, publish_target, f"{args.publish_mirror_dir}/{target_hash}",
+                            args.jobs, upload=args.publish)
+        sys.exit(0)
+    if releases:
+        print(f"Building mangOH release version {', '.join(versions)}...");
 
     # Prepare the build directory tree and the process environment.
     os.makedirs(BUILD_DIR, exist_ok = True)
+    if not args.no_cache:
+        build_cache = BuildCache(args.cache_dir, int(args.cache_size * 1024**3))
+        downloader = Downloader(f"{args.cache_dir}/downloads")
+    if not args.no_mirror:
+        git_mirrors = GitMirrors(args.mirror_dir)
+    if not args.no_yocto_cache:
+        yocto_caches = YoctoCaches(args.yocto_cache_dir, int(args.yocto_cache_size * 1024**3))
+    if not args.no_ccache:
+        if shutil.which("ccache"):
+            compiler_cache = CompilerCache(args.ccache_dir, int(args.ccache_size * 1024**3),
+                                           shutil.which("ccache"))
+        else:
+            print("ccache isn't installed, so the Legato, Octave and mangOH builds won't use a"
+                  " compiler cache.")
     sandbox_leaf()
     gerrit_user = os.environ.get("GERRIT_USER")
     if not gerrit_user:
@@ -569,29 +4444,26 @@ if __name__ == '__main__':
             raise ValueError("Unable to find user name in either GERRIT_USER or USER"
                          " environment variables.")
         os.environ["GERRIT_USER"] = gerrit_user
+    if args.yocto_worker:
+        json.dump(run_yocto_worker(json.loads(args.yocto_worker)), result_file)
+        result_file.close()
+        sys.exit(0)
+    if args.daemon:
+        BuildDaemon(args.daemon, args.jobs, args.fetch_jobs).serve()
 
-    # Add a local file system directory as a leaf remote into which we will place leaf
-    # packages as we create them.
-    shell("leaf remote remove local 2> /dev/null", check=False)
-    shell(f"leaf remote add local file://{LEAF_REMOTE}/mangOH.json")
-
-    # Fetch the Octave, Legato, and mangOH sources. These are common to all boards and modules.
-    fetch_legato(spec)
-    fetch_octave(spec)
-    fetch_mangoh(spec)
-
-    # For each board+module combination, build Yocto (if needed), Legato, the Octave apps, and
-    # finally the mangOH system and SPK.
-    # Each step produces leaf packages, which are added to the leaf remote for use by subsequent
-    # steps.
-    boards = spec["boards"]
-    for board, board_spec in boards.items():
-        for module in board_spec:
-            build_yocto(spec, board, module)
-            build_legato(spec, board, module)
-            build_octave(spec, board, module)
-            build_mangoh(spec, board, module)
-
-    print(f"==== RELEASE {version} BUILD COMPLETE ====")
-    print(f"The following leaf packages were generated in {LEAF_REMOTE}:")
-    shell(f"ls {LEAF_REMOTE} --ignore='*.json' --ignore='*.info'")
+    graph = build_graph(releases)
+    journal = RunJournal(f"{JOURNAL_DIR}/{'+'.join(versions)}.json",
+                         build_stage_key("journal", [release.spec for release in releases]),
+                         args.resume)
+    try:
+        graph.run(args.jobs, fetch_jobs=args.fetch_jobs, journal=journal)
+        for release in releases:
+            release.leaf_remote.refresh()
+    finally:
+        print(f"Build report written to {build_report.write('+'.join(versions))}")
+
+    for release in releases:
+        remote_dir = release.leaf_remote.remote_dir
+        print(f"==== RELEASE {release.version} BUILD COMPLETE ====")
+        print(f"The following leaf packages were generated in {remote_dir}:")
+        shell(f"ls {remote_dir} --ignore='*.json' --ignore='*.info'")
@@ -0,0 +1,36 @@
+# Shared setup for the tests of the build script. The script isn't a package, so its directory
+# is put on the module search path to import it, along with the benchmark's (see
+# bench/run_bench.py), whose synthetic sources and stand-in tools the tests also use.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+
+import pytest
+
+import mangoh_release
+
+
+@pytest.fixture
+def report(tmp_path):
+    """A BuildReport that keeps its progress messages in a list, and its logs in tmp_path."""
+    messages = []
+    report = mangoh_release.BuildReport(progress=messages.append, log_dir=str(tmp_path / "logs"))
+    report.messages = messages
+    return report
+
+
+@pytest.fixture
+def build_dir(tmp_path, monkeypatch):
+    """Point the build script's build directory (and the directories in it) at tmp_path/build."""
+    build_dir = str(tmp_path / "build")
+    monkeypatch.setattr(mangoh_release, "BUILD_DIR", build_dir)
+    for name, subdir in [("RELEASES_DIR", "releases"), ("LOG_DIR", "logs"),
+                         ("REPORT_DIR", "reports"), ("JOURNAL_DIR", "journals")]:
+        monkeypatch.setattr(mangoh_release, name, f"{build_dir}/{subdir}")
+    return build_dir
@@ -0,0 +1,136 @@
+# Tests of the build cache (BuildCache), and of the keys that its entries for the Yocto and
+# Legato sources are stored under.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import time
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch, report):
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    return mangoh_release.BuildCache(str(tmp_path / "cache"), max_size=10**6)
+
+
+def make_output(path, name, size):
+    """Make a directory at path holding a file of the given size, and return the file's path."""
+    os.makedirs(path, exist_ok=True)
+    with open(f"{path}/{name}", "wb") as f:
+        f.write(os.urandom(size))
+    return f"{path}/{name}"
+
+
+def test_store_and_restore(cache, tmp_path):
+    output = make_output(tmp_path / "out", "sources.tar", 1000)
+    os.makedirs(tmp_path / "out" / "tree" / "sub")
+    (tmp_path / "out" / "tree" / "sub" / "file").write_text("tree\n")
+    cache.store("k1", [output, str(tmp_path / "out" / "tree")])
+
+    assert cache.contains("k1")
+    assert not cache.contains("k2")
+    assert not cache.restore("k2", str(tmp_path / "dest"))
+    # Anything already in the destination with the same name is replaced.
+    make_output(tmp_path / "dest" / "tree", "stale", 10)
+    assert cache.restore("k1", str(tmp_path / "dest"))
+    assert (tmp_path / "dest" / "sources.tar").read_bytes() == open(output, "rb").read()
+    assert (tmp_path / "dest" / "tree" / "sub" / "file").read_text() == "tree\n"
+    assert not (tmp_path / "dest" / "tree" / "stale").exists()
+
+
+def test_store_replaces_entry(cache, tmp_path):
+    cache.store("k1", [make_output(tmp_path / "a", "output", 100)])
+    cache.store("k1", [make_output(tmp_path / "b", "other", 100)])
+
+    cache.restore("k1", str(tmp_path / "dest"))
+    assert os.listdir(tmp_path / "dest") == ["other"]
+    assert not [name for name in os.listdir(tmp_path / "cache") if "incomplete" in name]
+
+
+def test_evicts_least_recently_used(cache, tmp_path):
+    # Each entry takes a little over 400 kB, so only two fit.
+    cache.max_size = 1000 * 1000
+    for key in ["k1", "k2"]:
+        cache.store(key, [make_output(tmp_path / key, "output", 400 * 1000)])
+        time.sleep(0.01)
+    # Using k1 makes k2 the least recently used.
+    cache.restore("k1", str(tmp_path / "dest"))
+    time.sleep(0.01)
+    cache.store("k3", [make_output(tmp_path / "k3", "output", 400 * 1000)])
+
+    assert [cache.contains(key) for key in ["k1", "k2", "k3"]] == [True, False, True]
+    assert not (tmp_path / "cache" / "k2").exists()
+    # Another process sharing the cache reads the same entries from disk.
+    other = mangoh_release.BuildCache(str(tmp_path / "cache"), max_size=1000 * 1000)
+    other.store("k4", [make_output(tmp_path / "k4", "output", 400 * 1000)])
+    assert [other.contains(key) for key in ["k1", "k3", "k4"]] == [False, True, True]
+
+
+@pytest.fixture
+def sources_dir(tmp_path, monkeypatch, report):
+    """
+    Make a repo manifest repository, listing two projects, in tmp_path/sources. The remote's
+    fetch URL is relative to the manifest repository's URL (so "." is its parent directory),
+    and one of the projects is in an included manifest.
+    """
+    sources_dir = tmp_path / "sources"
+    run_bench.write_git_config(f"{tmp_path}/gitconfig", str(sources_dir))
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", f"{tmp_path}/gitconfig")
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    run_bench.make_git_repo(f"{sources_dir}/meta-swi", {"README": "meta-swi\n"})
+    run_bench.make_git_repo(f"{sources_dir}/meta-mangoh", {"README": "meta-mangoh\n"})
+    run_bench.make_git_repo(f"{sources_dir}/manifest", {
+        "default.xml": '<manifest>\n  <remote name="origin" fetch="."/>\n'
+                       '  <default remote="origin" revision="master"/>\n'
+                       '  <project name="meta-swi" path="meta-swi"/>\n'
+                       '  <include name="mangoh.xml"/>\n</manifest>\n',
+        "mangoh.xml": '<manifest>\n  <project name="meta-mangoh" revision="release"/>\n'
+                      '</manifest>\n'})
+    run_bench.add_commit(f"{sources_dir}/meta-mangoh", "fix", "fix\n", "release")
+    return sources_dir
+
+
+def test_source_key_follows_manifest_projects(sources_dir, tmp_path, monkeypatch, report):
+    """A project's branch moving changes the key, even though the manifest hasn't changed."""
+    yocto_spec = {"manifest_repo": f"{sources_dir}/manifest/", "base_manifest": "default.xml"}
+
+    def source_key():
+        # Each build resolves the refs afresh.
+        monkeypatch.setattr(mangoh_release, "build_report", mangoh_release.BuildReport(
+            progress=report.progress, log_dir=str(tmp_path / "logs")))
+        inputs = mangoh_release.yocto_source_inputs(yocto_spec)
+        return mangoh_release.yocto_tree_key(inputs), inputs["project_commits"]
+
+    key, project_commits = source_key()
+    assert project_commits == sorted([
+        f"{sources_dir}/meta-mangoh " + run_bench.git(
+            "rev-parse", "release", cwd=f"{sources_dir}/meta-mangoh"),
+        f"{sources_dir}/meta-swi " + run_bench.git(
+            "rev-parse", "master", cwd=f"{sources_dir}/meta-swi")])
+    assert source_key()[0] == key
+    run_bench.add_commit(f"{sources_dir}/meta-mangoh", "fix2", "fix 2\n", "release")
+    assert source_key()[0] != key
+
+
+def test_manifest_read_from_mirror_offline(sources_dir, tmp_path, monkeypatch):
+    manifest_repo = f"{sources_dir}/manifest"
+    commit = run_bench.git("rev-parse", "HEAD", cwd=manifest_repo)
+    monkeypatch.setattr(mangoh_release, "offline", True)
+    with pytest.raises(mangoh_release.UnresolvedRefError):
+        mangoh_release.manifest_projects(manifest_repo, commit, "default.xml")
+
+    mirrors = mangoh_release.GitMirrors(str(tmp_path / "mirrors"))
+    monkeypatch.setattr(mangoh_release, "git_mirrors", mirrors)
+    with pytest.raises(mangoh_release.UnresolvedRefError):
+        mangoh_release.manifest_projects(manifest_repo, commit, "default.xml")
+    # An earlier build mirrored it.
+    mirrors.update(manifest_repo)
+
+    assert mangoh_release.manifest_projects(manifest_repo, commit, "default.xml") == [
+        (f"{sources_dir}/meta-swi", "master"), (f"{sources_dir}/meta-mangoh", "release")]
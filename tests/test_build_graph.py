@@ -0,0 +1,120 @@
+# Tests of running build stages in dependency order (BuildGraph), and of sharing out the
+# stage slots between builds (StageSlots).
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import time
+import threading
+
+import pytest
+
+import mangoh_release
+
+
+class Recorder:
+    """Makes stage functions that record when they start and finish."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def stage(self, name, fail=False, duration=0.05):
+        def run():
+            with self.lock:
+                self.events.append(("start", name))
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(duration)
+            with self.lock:
+                self.running -= 1
+                self.events.append(("end", name))
+            if fail:
+                raise ValueError(f"{name} failed")
+        return run
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+
+def test_stages_run_after_their_dependencies(report):
+    recorder = Recorder()
+    graph = mangoh_release.BuildGraph()
+    graph.add("fetch a", recorder.stage("fetch a"))
+    graph.add("build a", recorder.stage("build a"), ["fetch a"])
+    graph.add("build b", recorder.stage("build b"), ["fetch a"])
+    graph.add("package", recorder.stage("package"), ["build a", "build b"])
+
+    graph.run(jobs=2, report=report)
+
+    assert len(recorder.events) == 8
+    for name, depends in [("build a", ["fetch a"]), ("build b", ["fetch a"]),
+                          ("package", ["build a", "build b"])]:
+        for dependency in depends:
+            assert recorder.index("end", dependency) < recorder.index("start", name)
+    # The two independent stages ran at the same time.
+    assert recorder.max_running == 2
+
+
+def test_jobs_limit_stages_running_at_once(report):
+    recorder = Recorder()
+    graph = mangoh_release.BuildGraph()
+    for index in range(6):
+        graph.add(f"build {index}", recorder.stage(f"build {index}"))
+
+    graph.run(jobs=3, report=report)
+
+    assert recorder.max_running == 3
+
+
+def test_failure_stops_dependents_and_new_stages(report):
+    recorder = Recorder()
+    graph = mangoh_release.BuildGraph()
+    graph.add("build a", recorder.stage("build a", fail=True))
+    graph.add("build b", recorder.stage("build b", duration=0.2))
+    graph.add("package a", recorder.stage("package a"), ["build a"])
+    graph.add("build c", recorder.stage("build c"))
+
+    with pytest.raises(RuntimeError, match="Build stages failed: build a"):
+        graph.run(jobs=2, report=report)
+
+    # The stage already running when "build a" failed was allowed to finish, but nothing else
+    # was started.
+    assert ("end", "build b") in recorder.events
+    assert ("start", "package a") not in recorder.events
+    assert ("start", "build c") not in recorder.events
+    assert "**** build a FAILED: build a failed" in report.messages
+
+
+def test_stages_added_out_of_order_are_rejected():
+    graph = mangoh_release.BuildGraph()
+    graph.add("build a", lambda: None)
+    with pytest.raises(ValueError, match="unknown stage"):
+        graph.add("package a", lambda: None, ["build b"])
+    with pytest.raises(ValueError, match="added twice"):
+        graph.add("build a", lambda: None)
+
+
+def test_free_slot_goes_to_build_with_fewest_stages_running():
+    slots = mangoh_release.StageSlots(2)
+    slots.acquire("big")
+    slots.acquire("big")
+    order = []
+
+    def acquire(build):
+        slots.acquire(build)
+        order.append(build)
+
+    waiters = [threading.Thread(target=acquire, args=[build]) for build in ["big", "small"]]
+    for waiter in waiters:
+        waiter.start()
+        # Make sure that the big build's stage starts waiting first.
+        while waiter.is_alive() and len(slots.waiting) < waiters.index(waiter) + 1:
+            time.sleep(0.01)
+    slots.release("big")
+    waiters[1].join(timeout=5)
+    assert order == ["small"]
+    slots.release("big")
+    waiters[0].join(timeout=5)
+    assert order == ["small", "big"]
+    assert slots.running == {"big": 1, "small": 1}
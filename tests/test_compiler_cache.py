@@ -0,0 +1,103 @@
+# Tests of the compiler cache (CompilerCache), with a stand-in for ccache that caches object
+# files by a hash of the compiler's arguments and the source, and the host's gcc as the
+# "cross" compiler.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import sys
+import time
+import shutil
+import pathlib
+import subprocess
+
+import pytest
+
+import mangoh_release
+
+
+# Runs "ccache COMPILER ARGS...", logging a hit or miss for each compilation to CCACHE_STATSLOG
+# as ccache does.
+FAKE_CCACHE = """\
+import os, sys, shutil, hashlib, subprocess
+compiler, *args = sys.argv[1:]
+output = args[args.index("-o") + 1]
+source = next(arg for arg in args if arg.endswith(".c"))
+key = hashlib.sha256((" ".join(args) + open(source).read()).encode()).hexdigest()
+cached = os.path.join(os.environ["CCACHE_DIR"], key)
+with open(os.environ["CCACHE_STATSLOG"], "a") as log:
+    log.write(f"# {source}\\n")
+    if os.path.exists(cached):
+        log.write("direct_cache_hit\\n")
+        shutil.copy(cached, output)
+        sys.exit(0)
+    log.write("cache_miss\\n")
+subprocess.run([compiler, *args], check=True)
+shutil.copy(output, cached)
+"""
+
+# Runs "leaf shell -c COMMAND" with the variables that a toolchain package sets.
+FAKE_LEAF = """\
+#!/bin/sh
+export WP76XX_TOOLCHAIN_DIR={toolchain_dir} WP76XX_TOOLCHAIN_PREFIX=arm-poky-linux-gnueabi-
+exec sh -c "$3"
+"""
+
+
+@pytest.fixture
+def tools(tmp_path, monkeypatch):
+    if not shutil.which("gcc"):
+        pytest.skip("needs gcc")
+    bin_dir = tmp_path / "bin"
+    toolchain_dir = tmp_path / "toolchain" / "arm-poky-linux-gnueabi"
+    bin_dir.mkdir()
+    toolchain_dir.mkdir(parents=True)
+    (bin_dir / "ccache").write_text(f"#!{sys.executable}\n{FAKE_CCACHE}")
+    (bin_dir / "leaf").write_text(FAKE_LEAF.format(toolchain_dir=toolchain_dir))
+    for tool in ["ccache", "leaf"]:
+        (bin_dir / tool).chmod(0o755)
+    os.symlink(shutil.which("gcc"), toolchain_dir / "arm-poky-linux-gnueabi-gcc")
+    os.symlink(shutil.which("ar"), toolchain_dir / "arm-poky-linux-gnueabi-ar")
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    return bin_dir, toolchain_dir
+
+
+def test_compilers_run_by_full_path_go_through_cache(tools, tmp_path, capsys):
+    bin_dir, toolchain_dir = tools
+    cache = mangoh_release.CompilerCache(str(tmp_path / "ccache"), 1024**3,
+                                         str(bin_dir / "ccache"))
+    (tmp_path / "main.c").write_text("int main(void) { return 0; }\n")
+    toolchain_dirs = cache.toolchain_dirs(str(tmp_path), None)
+    wrapper_dir = toolchain_dirs["WP76XX_TOOLCHAIN_DIR"]
+    assert os.readlink(f"{wrapper_dir}/arm-poky-linux-gnueabi-ar") == \
+        str(toolchain_dir / "arm-poky-linux-gnueabi-ar")
+    # The wrappers are only made once.
+    assert cache.toolchain_dirs(str(tmp_path), None) == toolchain_dirs
+
+    for _ in range(2):
+        with cache.in_use("toolchain") as stats_log:
+            cmd = cache.command("$WP76XX_TOOLCHAIN_DIR/arm-poky-linux-gnueabi-gcc -c main.c"
+                                " -o main.o", "toolchain", toolchain_dirs, stats_log)
+            subprocess.run(["leaf", "shell", "-c", cmd], cwd=tmp_path, check=True)
+
+    output = capsys.readouterr().out
+    assert "0 of 1 compilations cached (0% hit rate)" in output
+    assert "1 of 1 compilations cached (100% hit rate)" in output
+    assert (tmp_path / "main.o").exists()
+
+
+def test_prune_removes_least_recently_used_toolchain_caches(tmp_path):
+    cache = mangoh_release.CompilerCache(str(tmp_path), 3 * 1024**2, "ccache")
+    for age, toolchain_key in enumerate(["new", "old", "older"]):
+        with cache.in_use(toolchain_key):
+            pass
+        cache_dir = cache.toolchain_cache_dir(toolchain_key)
+        pathlib.Path(cache_dir, "result").write_bytes(bytes(1024**2 + 1))
+        last_used = time.time() - 1000 * age
+        os.utime(f"{cache_dir}/{cache.LAST_USED_FILE}", (last_used, last_used))
+    cache.prune()
+
+    assert os.path.isdir(cache.toolchain_cache_dir("new"))
+    assert os.path.isdir(cache.toolchain_cache_dir("old"))
+    assert not os.path.exists(cache.toolchain_cache_dir("older"))
+    assert os.path.isdir(tmp_path / "bin")
@@ -0,0 +1,101 @@
+# Tests of the SPK deltas from earlier releases (build_deltas()), and of rebuilding the SPK files
+# from them with apply_spk_delta.py, using the benchmark's stand-in for leaf.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+OLD_VERSION = "0.0.0-old"
+
+
+@pytest.fixture
+def release(tmp_path, monkeypatch, build_dir, report):
+    if not shutil.which("zstd"):
+        pytest.skip("needs zstd")
+    monkeypatch.setenv("PATH", f"{run_bench.BENCH_DIR}/stubs:{os.environ['PATH']}")
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    spec = run_bench.release_spec(str(tmp_path / "sources"), 1, 1, [])
+    spec["deltas"] = {"from": [OLD_VERSION, "0.0.0-missing"],
+                      "remote": str(tmp_path / "published")}
+    spec_file = tmp_path / f"{run_bench.VERSION}.json"
+    spec_file.write_text(json.dumps(spec))
+    return mangoh_release.Release(str(spec_file))
+
+
+def write_spk_files(spk_dir, release, version, contents):
+    """Write the board1 wp70xx SPK files (with and without Octave) of a release version."""
+    os.makedirs(spk_dir, exist_ok=True)
+    names = []
+    for octave in [True, False]:
+        name = mangoh_release.spk_file_name(release, "board1", "wp70xx", octave, version)
+        with open(f"{spk_dir}/{name}", "wb") as f:
+            f.write(contents + (b"octave" if octave else b""))
+        names.append(name)
+    return names
+
+
+def publish_old_release(release, published_dir, spk_dir, contents):
+    """
+    Put the earlier release's master package, holding its SPK files (which are written to
+    spk_dir), where publish_release() puts it. Returns the names of the SPK files.
+    """
+    names = write_spk_files(spk_dir, release, OLD_VERSION, contents)
+    os.makedirs(f"{published_dir}/{OLD_VERSION}")
+    subprocess.run(["tar", "-cf", f"{published_dir}/{OLD_VERSION}/mangOH-board1-wp70xx_"
+                    f"{OLD_VERSION}.leaf", "-C", spk_dir, *[f"./{name}" for name in names]],
+                   check=True)
+    return names
+
+
+def test_deltas_from_published_release_round_trip(release, tmp_path):
+    old_contents = os.urandom(256 * 1024)
+    new_contents = old_contents[:100000] + b"changed" + old_contents[100000:]
+    old_dir = tmp_path / "old-spk"
+    old_files = publish_old_release(release, tmp_path / "published", old_dir, old_contents)
+    new_dir = f"{release.staging_dir}/board1-wp70xx-spk"
+    new_files = write_spk_files(new_dir, release, None, new_contents)
+
+    mangoh_release.build_deltas(release, "board1", "wp70xx")
+
+    package = (f"{release.leaf_remote.remote_dir}/"
+               f"{mangoh_release.delta_package_id(release, 'board1', 'wp70xx')}.leaf")
+    delta_dir = tmp_path / "delta"
+    os.makedirs(delta_dir)
+    subprocess.run(["tar", "-xf", package, "-C", delta_dir], check=True)
+    with open(delta_dir / "deltas.json") as f:
+        deltas = json.load(f)["deltas"]
+    # There's no package for the missing release, so there are no deltas from it.
+    assert [(delta["from"], delta["to"]) for delta in deltas] == list(zip(old_files, new_files))
+    assert all(os.path.getsize(delta_dir / delta["delta"]) < len(new_contents) / 10
+               for delta in deltas)
+
+    result = subprocess.run([sys.executable, delta_dir / "apply_spk_delta.py", delta_dir,
+                             "--from-dir", old_dir, "--output-dir", tmp_path / "rebuilt"])
+    assert result.returncode == 0
+    for name in new_files:
+        assert (tmp_path / "rebuilt" / name).read_bytes() == open(f"{new_dir}/{name}", "rb").read()
+
+
+def test_apply_rejects_wrong_base(release, tmp_path):
+    old_dir = tmp_path / "old-spk"
+    old_files = publish_old_release(release, tmp_path / "published", old_dir, b"old" * 1000)
+    write_spk_files(f"{release.staging_dir}/board1-wp70xx-spk", release, None, b"new" * 1000)
+    mangoh_release.build_deltas(release, "board1", "wp70xx")
+    delta_dir = f"{release.staging_dir}/board1-wp70xx-delta"
+
+    (old_dir / old_files[0]).write_bytes(b"something else")
+    result = subprocess.run([sys.executable, f"{delta_dir}/apply_spk_delta.py", delta_dir,
+                             "--from-dir", old_dir, "--output-dir", tmp_path / "rebuilt"],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert result.returncode != 0
+    assert "isn't the" in result.stdout
@@ -0,0 +1,111 @@
+# Tests of the download cache (Downloader), against a local HTTP server.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import hashlib
+import threading
+import http.server
+import concurrent.futures
+
+import pytest
+
+import mangoh_release
+
+
+CONTENT = bytes(range(256)) * 4096
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves CONTENT at any path, honouring "Range: bytes=N-" requests, and counts requests."""
+    requests = []
+
+    def do_GET(self):
+        RangeHandler.requests.append((self.path, self.headers.get("Range")))
+        offset = 0
+        if self.headers.get("Range"):
+            offset = int(self.headers["Range"].removeprefix("bytes=").rstrip("-"))
+            if offset >= len(CONTENT):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {offset}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(CONTENT) - offset))
+        self.end_headers()
+        self.wfile.write(CONTENT[offset:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.requests = []
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_resumes_partial_download(server, tmp_path):
+    downloader = mangoh_release.Downloader(str(tmp_path))
+    url = f"{server}/file.bin"
+    sha256 = hashlib.sha256(CONTENT).hexdigest()
+    url_hash = hashlib.sha1(url.encode()).hexdigest()
+    os.makedirs(tmp_path / "partial")
+    (tmp_path / "partial" / url_hash).write_bytes(CONTENT[:100000])
+
+    path = downloader.fetch(url, sha256)
+
+    assert RangeHandler.requests == [("/file.bin", "bytes=100000-")]
+    assert path == str(tmp_path / "sha256" / sha256)
+    assert open(path, "rb").read() == CONTENT
+    assert not os.path.exists(tmp_path / "partial" / url_hash)
+    # It's in the cache now, so it isn't downloaded again, even without its hash.
+    assert downloader.fetch(url) == path
+    assert len(RangeHandler.requests) == 1
+
+
+def test_fetch_rejects_checksum_mismatch(server, tmp_path):
+    downloader = mangoh_release.Downloader(str(tmp_path))
+    url = f"{server}/file.bin"
+
+    with pytest.raises(ValueError, match="SHA-256"):
+        downloader.fetch(url, "0" * 64)
+
+    assert os.listdir(tmp_path / "partial") == []
+    assert not os.path.exists(tmp_path / "sha256" / ("0" * 64))
+    assert not os.path.exists(tmp_path / "urls" / hashlib.sha1(url.encode()).hexdigest())
+
+
+def test_concurrent_fetches_of_same_url_download_once(server, tmp_path):
+    url = f"{server}/file.bin"
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        paths = list(executor.map(
+            lambda _: mangoh_release.Downloader(str(tmp_path)).fetch(url), range(4)))
+
+    assert len(set(paths)) == 1
+    assert open(paths[0], "rb").read() == CONTENT
+    assert RangeHandler.requests == [("/file.bin", None)]
+
+
+def test_download_all_records_in_stage_report(tmp_path, monkeypatch, report):
+    # The stage runs in a report of its own (as a build daemon's job does), not build_report.
+    monkeypatch.setattr(mangoh_release, "build_report", mangoh_release.BuildReport(
+        progress=report.progress, log_dir=str(tmp_path / "other-logs")))
+    downloader = mangoh_release.Downloader(str(tmp_path))
+    seen = []
+    monkeypatch.setattr(downloader, "download", lambda download_spec, root: seen.append(
+        (mangoh_release.BuildReport.current(),
+         mangoh_release.BuildReport.current().current_stage()["name"])))
+
+    report.run_stage("mangoh target", [], lambda: downloader.download_all(
+        [{"url": f"http://example.com/{i}", "dir": "."} for i in range(3)], str(tmp_path)))
+
+    assert seen == [(report, "mangoh target")] * 3
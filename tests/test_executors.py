@@ -0,0 +1,78 @@
+# Tests of building Yocto trees in worker processes (ProcessExecutor): the requests sent to the
+# workers, the results they send back, and the checks on the files copied back from them.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import pathlib
+
+import pytest
+
+import mangoh_release
+
+
+TREE_NAME = "yocto-board1-wp76xx"
+OUTPUTS = {
+    "build_bin/tmp/deploy/sdk/poky-swi-ext-glibc-x86_64-meta-toolchain-swi-armv7a-neon-"
+    "toolchain-swi-SWI9X06Y_02.32.02.00.sh": b"#!/bin/sh\n# toolchain\n",
+    "build_bin/tmp/deploy/images/swi-mdm9x28-wp/yocto_wp76xx.4k.cwe": b"cwe" * 1000,
+}
+
+
+@pytest.fixture
+def executor(build_dir, monkeypatch, report):
+    """
+    A ProcessExecutor with two workers, each of which has already built the tree, so the worker
+    processes don't need the Yocto sources or tools.
+    """
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    monkeypatch.setenv("GERRIT_USER", "tester")
+    executor = mangoh_release.ProcessExecutor(2, "--no-cache --no-mirror --no-yocto-cache")
+    for worker in executor.workers:
+        tree_dir = f"{worker}/build/{TREE_NAME}"
+        for path, contents in OUTPUTS.items():
+            os.makedirs(os.path.dirname(f"{tree_dir}/{path}"), exist_ok=True)
+            pathlib.Path(f"{tree_dir}/{path}").write_bytes(contents)
+        pathlib.Path(f"{tree_dir}/.built").write_text("tree-key")
+    return executor
+
+
+def build(executor, build_dir):
+    executor.build_yocto_tree({"manifest_repo": "unused"}, "board1", "wp76xx",
+                              f"{build_dir}/{TREE_NAME}", {}, "tree-key")
+
+
+def test_outputs_copied_back_from_worker(executor, build_dir, report):
+    build(executor, build_dir)
+
+    for path, contents in OUTPUTS.items():
+        assert pathlib.Path(f"{build_dir}/{TREE_NAME}/{path}").read_bytes() == contents
+    assert pathlib.Path(f"{build_dir}/{TREE_NAME}/.built").read_text() == "tree-key"
+    # The worker ran in its own directory, and only the request went on its command line.
+    [command] = [command for command in report.commands if "--yocto-worker" in command["command"]]
+    assert command["cwd"] == executor.workers[0]
+    assert '"name": "yocto-board1-wp76xx"' in command["command"]
+
+
+def test_rejects_output_not_matching_worker_hash(executor, build_dir, monkeypatch):
+    def corrupting_copy(worker, path, dest):
+        pathlib.Path(dest).write_bytes(pathlib.Path(path).read_bytes()[:-1])
+    monkeypatch.setattr(executor, "copy_output", corrupting_copy)
+
+    with pytest.raises(ValueError, match="was corrupted when copied from worker 1"):
+        build(executor, build_dir)
+
+    assert not os.path.exists(f"{build_dir}/{TREE_NAME}/.built")
+    # The worker is free again.
+    assert executor.busy == set()
+
+
+def test_tree_goes_back_to_worker_that_built_it(executor):
+    assert executor._acquire("tree1") == executor.workers[0]
+    # The other tree goes to the free worker.
+    assert executor._acquire("tree2") == executor.workers[1]
+    executor._release(executor.workers[0])
+    executor._release(executor.workers[1])
+    assert executor._acquire("tree2") == executor.workers[1]
+    # tree3 has no worker of its own, so it goes to the one that has built the fewest trees.
+    assert executor._acquire("tree3") == executor.workers[0]
@@ -0,0 +1,90 @@
+# Tests of fetching git repositories and their submodules through local mirrors (GitMirrors),
+# offline, from local bare repositories.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import shutil
+import concurrent.futures
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+@pytest.fixture
+def remotes(tmp_path, monkeypatch, report):
+    """
+    Make bare "remote" repositories: "app", which has "lib" as a submodule in "lib". Returns the
+    directory they're in.
+    """
+    remote_dir = tmp_path / "remotes"
+    work_dir = tmp_path / "work"
+    run_bench.write_git_config(f"{tmp_path}/gitconfig", str(tmp_path))
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", f"{tmp_path}/gitconfig")
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    run_bench.make_git_repo(f"{work_dir}/lib", {"lib.c": "int lib;\n"})
+    run_bench.git("clone", "-q", "--bare", f"{work_dir}/lib", f"{remote_dir}/lib.git",
+                  cwd=tmp_path)
+    run_bench.make_git_repo(f"{work_dir}/app", {"app.c": "int app;\n"})
+    run_bench.git("submodule", "add", "-q", f"{remote_dir}/lib.git", "lib", cwd=f"{work_dir}/app")
+    run_bench.git("commit", "-q", "-m", "Add lib", cwd=f"{work_dir}/app")
+    run_bench.git("clone", "-q", "--bare", f"{work_dir}/app", f"{remote_dir}/app.git",
+                  cwd=tmp_path)
+    return remote_dir
+
+
+def test_clone_with_submodules_through_mirrors(remotes, tmp_path, monkeypatch):
+    mirrors = mangoh_release.GitMirrors(str(tmp_path / "mirrors"))
+    monkeypatch.setattr(mangoh_release, "git_mirrors", mirrors)
+    app_url = f"{remotes}/app.git"
+
+    mangoh_release.fetch_git_repo(app_url, "master", str(tmp_path / "app"))
+
+    assert (tmp_path / "app" / "lib" / "lib.c").exists()
+    assert sorted(os.listdir(tmp_path / "mirrors" / "git")) == sorted(
+        os.path.basename(mirrors.git_mirror_path(f"{remotes}/{name}.git")) + suffix
+        for name in ["app", "lib"] for suffix in ["", ".lock"])
+    # The clones point at the real remotes, not the mirrors.
+    assert run_bench.git("remote", "get-url", "origin", cwd=tmp_path / "app") == app_url
+    assert run_bench.git("remote", "get-url", "origin", cwd=tmp_path / "app" / "lib") == \
+        f"{remotes}/lib.git"
+
+    # Everything comes from the mirrors, which are only updated once per build, so the remotes
+    # aren't needed to clone again.
+    shutil.rmtree(remotes)
+    mangoh_release.fetch_git_repo(app_url, "master", str(tmp_path / "app2"))
+    assert (tmp_path / "app2" / "lib" / "lib.c").exists()
+
+
+def test_mirror_updated_by_several_processes_at_once(remotes, tmp_path, monkeypatch):
+    # Each GitMirrors stands for another process using the same mirrors.
+    url = f"{remotes}/app.git"
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        paths = list(pool.map(
+            lambda _: mangoh_release.GitMirrors(str(tmp_path / "mirrors")).update(url),
+            range(4)))
+
+    assert len(set(paths)) == 1
+    assert run_bench.git("rev-parse", "master", cwd=paths[0]) == \
+        run_bench.git("rev-parse", "master", cwd=remotes / "app.git")
+    assert not os.path.exists(f"{paths[0]}.incomplete")
+
+
+def test_mirror_refreshed_once_per_build(remotes, tmp_path, monkeypatch, report):
+    mirrors = mangoh_release.GitMirrors(str(tmp_path / "mirrors"))
+    url = f"{remotes}/app.git"
+    path = mirrors.update(url)
+    run_bench.git("push", "-q", url, "master:other", cwd=tmp_path / "work" / "app")
+
+    # Not again in the same build...
+    mirrors.update(url)
+    assert "other" not in run_bench.git("branch", cwd=path)
+    # ...but it is in the next one, e.g. the next job of a BuildDaemon, which has its own report,
+    # even while an earlier job is still running.
+    job_report = mangoh_release.BuildReport(progress=report.progress,
+                                            log_dir=str(tmp_path / "job-logs"))
+    job_report.run_stage("fetch legato", [], lambda: mirrors.update(url))
+    assert "other" in run_bench.git("branch", cwd=path)
@@ -0,0 +1,70 @@
+# Tests of indexing the local leaf remote (LeafRemote), using the benchmark's stand-in for leaf.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import json
+import glob
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch, report):
+    monkeypatch.setenv("PATH", f"{run_bench.BENCH_DIR}/stubs:{os.environ['PATH']}")
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    return mangoh_release.LeafRemote(str(tmp_path / "remote"))
+
+
+def pack(tmp_path, name, version):
+    """Pack a leaf package, as create_leaf_package() does. Returns its .leaf and .info files."""
+    staging_dir = tmp_path / "staging" / name
+    os.makedirs(staging_dir)
+    (staging_dir / "file").write_text(f"{name} {version}\n")
+    mangoh_release.shell(f"leaf build manifest -o {staging_dir} --name {name}"
+                         f" --version {version} --tag mangOH")
+    package_file = f"{tmp_path}/staging/{name}_{version}.leaf"
+    mangoh_release.shell(f"leaf build pack -o {package_file} -i {staging_dir} -- .")
+    return glob.glob(f"{package_file}*")
+
+
+def read_packages(index_file):
+    with open(index_file) as f:
+        return sorted(json.load(f)["packages"], key=lambda entry: entry["file"])
+
+
+def test_index_from_info_files_matches_leaf_build_index(remote, tmp_path, report):
+    remote.add(pack(tmp_path, "mangOH-board1-wp76xx", "1.0"))
+    remote.add(pack(tmp_path, "mangOH-board1-wp76xx-legato", "1.0"))
+    remote.refresh()
+    # Without any further changes, it isn't regenerated.
+    remote.refresh()
+
+    assert remote.generation == 1
+    assert not [command for command in report.commands if "build index" in command["command"]]
+    mangoh_release.shell("leaf build index -o indexed.json *.leaf", cwd=remote.remote_dir)
+    assert (read_packages(f"{remote.remote_dir}/mangOH.json")
+            == read_packages(f"{remote.remote_dir}/indexed.json"))
+
+    remote.remove("mangOH-board1-wp76xx-legato_1.0")
+    remote.refresh()
+    assert [entry["file"] for entry in read_packages(f"{remote.remote_dir}/mangOH.json")] == \
+        ["mangOH-board1-wp76xx_1.0.leaf"]
+
+
+def test_index_falls_back_to_leaf_build_index(remote, tmp_path, report):
+    # A package without a .info file (e.g., copied in by hand).
+    package_files = pack(tmp_path, "mangOH-board1-wp76xx", "1.0")
+    remote.add([path for path in package_files if path.endswith(".leaf")])
+    remote.add(pack(tmp_path, "mangOH-board1-wp76xx-legato", "1.0"))
+    remote.refresh()
+
+    assert [command["command"] for command in report.commands
+            if "build index" in command["command"]] == \
+        ["leaf build index -o .mangOH-new.json *.leaf"]
+    assert [entry["file"] for entry in read_packages(f"{remote.remote_dir}/mangOH.json")] == \
+        ["mangOH-board1-wp76xx-legato_1.0.leaf", "mangOH-board1-wp76xx_1.0.leaf"]
+    assert not os.path.exists(f"{remote.remote_dir}/.mangOH-new.json")
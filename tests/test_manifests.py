@@ -0,0 +1,74 @@
+# Tests of rendering the leaf manifest templates (render_manifest()) and of checking them for a
+# release before it is built (check_manifests()).
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import json
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+@pytest.fixture
+def script_dir(tmp_path, monkeypatch):
+    """Look for the manifest templates in tmp_path instead of the script's directory."""
+    monkeypatch.setattr(mangoh_release, "SCRIPT_DIR", str(tmp_path))
+    return tmp_path
+
+
+def make_release(tmp_path):
+    spec_file = tmp_path / f"{run_bench.VERSION}.json"
+    spec_file.write_text(json.dumps(run_bench.release_spec(str(tmp_path / "sources"), 2, 1, [])))
+    return mangoh_release.Release(str(spec_file))
+
+
+def test_values_are_escaped(script_dir):
+    (script_dir / "template.json").write_text(
+        '{"info": {"name": "mangOH-%MANGOH_BOARD%", "description": "%DESCRIPTION%"}}\n')
+    description = 'Build #3 of "yellow" in C:\\mangOH\\ (100% done)\n'
+
+    text = mangoh_release.render_manifest("template.json", {"MANGOH_BOARD": "yellow",
+                                                            "DESCRIPTION": description})
+
+    assert json.loads(text)["info"] == {"name": "mangOH-yellow", "description": description}
+
+
+def test_all_unresolved_variables_reported_at_once(script_dir):
+    (script_dir / "template.json").write_text(
+        '{"name": "%MANGOH_BOARD%-%TARGET%", "version": "%VERSION%", "legato": "%LEGATO%",'
+        ' "again": "%TARGET%"}\n')
+
+    with pytest.raises(ValueError) as error:
+        mangoh_release.render_manifest("template.json", {"MANGOH_BOARD": "yellow",
+                                                         "VERSION": ""})
+
+    assert str(error.value) == "template.json: no value for LEGATO, TARGET, VERSION"
+
+
+def test_invalid_json_reported(script_dir):
+    (script_dir / "template.json").write_text('{"name": "%MANGOH_BOARD%",}\n')
+
+    with pytest.raises(ValueError, match="template.json: rendered manifest is not valid JSON"):
+        mangoh_release.render_manifest("template.json", {"MANGOH_BOARD": "yellow"})
+
+
+def test_release_manifests_can_be_generated(tmp_path, build_dir):
+    assert mangoh_release.check_manifests(make_release(tmp_path))
+
+
+def test_check_reports_every_problem(tmp_path, build_dir, script_dir, capsys):
+    release = make_release(tmp_path)
+    (script_dir / "toolchainManifest.json").write_text('{"name": "%TARGET%-%KERNEL%"}\n')
+    (script_dir / "linuxManifest.json").write_text('{"name": "%TARGET%"}\n')
+    (script_dir / "legatoManifest.json").write_text(
+        '{"name": "%TARGET%", "depends": "%TOOLCHAIN%", "version": "%LEGATO_VERSION%"}\n')
+
+    assert not mangoh_release.check_manifests(release)
+
+    # Only board1 builds a Yocto toolchain, and both have Legato.
+    assert capsys.readouterr().out.splitlines() == [
+        f"**** {run_bench.VERSION} board1 wp70xx: toolchainManifest.json: no value for KERNEL",
+        f"**** {run_bench.VERSION} board1 wp70xx: legatoManifest.json: no value for TOOLCHAIN",
+        f"**** {run_bench.VERSION} board2 wp70xx: legatoManifest.json: no value for TOOLCHAIN"]
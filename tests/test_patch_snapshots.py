@@ -0,0 +1,76 @@
+# Tests of re-patching the Legato sources from snapshots (PatchSnapshots) when the list of
+# patches changes, with the synthetic sources and the repo stand-in of the benchmark.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import types
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+@pytest.fixture
+def legato(tmp_path, monkeypatch, report):
+    """
+    Set up the synthetic Legato sources, with four fixes on a branch, and get a function that
+    fetches them with a given list of those fixes applied, returning the files in the tree and
+    the patches that the fetch applied and whether it fetched the tree.
+    """
+    sources_dir = str(tmp_path / "sources")
+    os.makedirs(sources_dir)
+    run_bench.write_git_config(f"{tmp_path}/gitconfig", sources_dir)
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", f"{tmp_path}/gitconfig")
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.setenv("PATH", f"{run_bench.BENCH_DIR}/stubs:{os.environ['PATH']}")
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    monkeypatch.setattr(mangoh_release, "build_cache", None)
+    monkeypatch.setattr(mangoh_release, "git_mirrors", None)
+    run_bench.make_git_repo(f"{sources_dir}/legato", {"version": "19.11.3-test\n"})
+    fixes = [run_bench.add_commit(f"{sources_dir}/legato", f"fix{i}.txt", f"Fix {i}\n", "fixes")
+             for i in range(4)]
+    run_bench.make_git_repo(f"{sources_dir}/manifest", {"legato.xml": (
+        f'<manifest>\n  <remote name="test" fetch="{sources_dir}"/>\n'
+        f'  <default remote="test" revision="master"/>\n'
+        f'  <project name="legato" path="legato"/>\n</manifest>\n')})
+    repo_root = str(tmp_path / "build" / "legato")
+    os.makedirs(repo_root)
+
+    def fetch(applied):
+        release = types.SimpleNamespace(
+            spec={"legato": {"manifest_repo": f"{sources_dir}/manifest",
+                             "base_manifest": "legato.xml",
+                             "patches": [{"purpose": f"Fix {i}", "cherry_pick": fixes[i]}
+                                         for i in applied]}},
+            legato_repo_root=repo_root, legato_root=f"{repo_root}/legato")
+        report.commands.clear()
+        mangoh_release.fetch_legato(release)
+        files = sorted(name for name in os.listdir(release.legato_root) if name.startswith("fix"))
+        commands = [command["command"] for command in report.commands]
+        picked = [fixes.index(command.split()[-1]) for command in commands
+                  if command.startswith("git cherry-pick ") and command != "git cherry-pick --quit"]
+        return files, picked, any(command.startswith("repo init") for command in commands)
+
+    return fetch
+
+
+def test_changed_patches_rewind_to_longest_unchanged_prefix(legato, capsys):
+    assert legato([0, 1, 2]) == (["fix0.txt", "fix1.txt", "fix2.txt"], [0, 1, 2], True)
+
+    # Only the last patch changed: the first two are kept, and the tree isn't fetched again.
+    assert legato([0, 1, 3]) == (["fix0.txt", "fix1.txt", "fix3.txt"], [3], False)
+    assert "with 2 of the 3 patches already applied" in capsys.readouterr().out
+
+    # Going back to the earlier list just restores its snapshot.
+    assert legato([0, 1, 2]) == (["fix0.txt", "fix1.txt", "fix2.txt"], [], False)
+
+    # A list with no prefix in common starts from the unpatched tree.
+    assert legato([3]) == (["fix3.txt"], [3], False)
+    assert "with 0 of the 1 patches already applied" in capsys.readouterr().out
+
+
+def test_unchanged_patches_arent_fetched_again(legato):
+    legato([0, 1])
+    assert legato([0, 1]) == (["fix0.txt", "fix1.txt"], [], False)
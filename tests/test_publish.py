@@ -0,0 +1,90 @@
+# Tests of publishing to an SFTP server (SftpTarget), with a stand-in for sftp that runs its
+# batch commands on a local directory.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import sys
+
+import pytest
+
+import mangoh_release
+
+
+# Runs "sftp -q -b - HOST" batches on the local filesystem. Without posix-rename (if
+# FAKE_SFTP_NO_POSIX_RENAME is set), rename fails if the new name exists, as in SFTP v3.
+FAKE_SFTP = """\
+import os, sys, shlex, shutil
+log = open(os.environ["FAKE_SFTP_LOG"], "a")
+for line in sys.stdin.read().splitlines():
+    log.write(line + "\\n")
+    ignore = line.startswith("-")
+    command, *args = shlex.split(line.lstrip("-"))
+    try:
+        if command == "put" or command == "get":
+            shutil.copy(args[0], args[1])
+        elif command == "rename":
+            if os.path.exists(args[1]) and os.environ.get("FAKE_SFTP_NO_POSIX_RENAME"):
+                raise OSError("rename over an existing file")
+            os.replace(args[0], args[1])
+        elif command == "rm":
+            os.remove(args[0])
+        elif command == "mkdir":
+            os.mkdir(args[0])
+    except OSError as e:
+        if not ignore:
+            sys.exit(f"{line}: {e}")
+"""
+
+
+@pytest.fixture
+def target(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "sftp").write_text(f"#!{sys.executable}\n{FAKE_SFTP}")
+    (bin_dir / "sftp").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_SFTP_LOG", str(tmp_path / "sftp.log"))
+    (tmp_path / "remote").mkdir()
+    return mangoh_release.SftpTarget("host", str(tmp_path / "remote"))
+
+
+def sftp_commands(tmp_path):
+    return [line.split()[0] for line in (tmp_path / "sftp.log").read_text().splitlines()]
+
+
+def test_put_renames_over_existing_file(target, tmp_path):
+    (tmp_path / "remote" / "mangOH.json").write_text("old")
+    (tmp_path / "mangOH.json").write_text("new")
+
+    target.put(str(tmp_path / "mangOH.json"), "mangOH.json")
+
+    assert (tmp_path / "remote" / "mangOH.json").read_text() == "new"
+    assert sftp_commands(tmp_path) == ["put", "rename"]
+    target.verify(str(tmp_path / "mangOH.json"), "mangOH.json")
+
+
+def test_put_removes_old_file_without_posix_rename(target, tmp_path, monkeypatch):
+    monkeypatch.setenv("FAKE_SFTP_NO_POSIX_RENAME", "1")
+    (tmp_path / "remote" / "mangOH.json").write_text("old")
+    (tmp_path / "mangOH.json").write_text("new")
+
+    target.put(str(tmp_path / "mangOH.json"), "mangOH.json")
+
+    assert (tmp_path / "remote" / "mangOH.json").read_text() == "new"
+    assert sftp_commands(tmp_path) == ["put", "rename", "-rm", "rename"]
+    assert os.listdir(tmp_path / "remote") == ["mangOH.json"]
+
+
+def test_verify_compares_contents_of_large_files(target, tmp_path):
+    content = os.urandom(3 * 1024**2)
+    (tmp_path / "remote" / "0.6.0").mkdir()
+    (tmp_path / "remote" / "0.6.0" / "a.leaf").write_bytes(content[:-1] + b"x")
+    (tmp_path / "a.leaf").write_bytes(content)
+
+    with pytest.raises(ValueError, match="doesn't match"):
+        target.verify(str(tmp_path / "a.leaf"), "0.6.0/a.leaf")
+    assert not os.path.exists(tmp_path / "a.leaf.verify")
+
+    target.put(str(tmp_path / "a.leaf"), "0.6.0/a.leaf")
+    target.verify(str(tmp_path / "a.leaf"), "0.6.0/a.leaf")
@@ -0,0 +1,97 @@
+# Tests of resuming a build (BuildGraph.run() with a RunJournal): only the stages that completed
+# and whose inputs haven't changed are skipped.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import pytest
+
+import mangoh_release
+
+
+class Build:
+    """
+    A build of "fetch sources" -> "build a" -> "build b" -> "package", in which each stage
+    writes an output file with contents given by self.contents (by default, derived from its
+    input), and fails if it is in self.failing.
+    """
+    STAGES = ["fetch sources", "build a", "build b", "package"]
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.contents = {"fetch sources": "v1"}
+        self.failing = set()
+        self.ran = []
+
+    def output(self, name):
+        return str(self.tmp_path / name.replace(" ", "_"))
+
+    def stage(self, name, dependency):
+        def run():
+            self.ran.append(name)
+            if name in self.failing:
+                raise ValueError(f"{name} failed")
+            contents = self.contents.get(name)
+            if contents is None:
+                with open(self.output(dependency)) as f:
+                    contents = f"{name} of {f.read()}"
+            with open(self.output(name), "w") as f:
+                f.write(contents)
+        return run
+
+    def run(self, report, key="specs", resume=True):
+        self.ran = []
+        graph = mangoh_release.BuildGraph()
+        dependency = None
+        for name in self.STAGES:
+            graph.add(name, self.stage(name, dependency), [dependency] if dependency else [],
+                      outputs=[self.output(name)])
+            dependency = name
+        journal = mangoh_release.RunJournal(str(self.tmp_path / "journal.json"), key, resume)
+        graph.run(report=report, journal=journal)
+        return self.ran
+
+
+@pytest.fixture
+def build(tmp_path):
+    return Build(tmp_path)
+
+
+def test_resume_skips_only_stages_completed_before_failure(build, report):
+    build.failing = {"build b"}
+    with pytest.raises(RuntimeError):
+        build.run(report)
+    build.failing = set()
+
+    assert build.run(report) == ["fetch sources", "build b", "package"]
+    assert "---- Skipping build a (completed earlier) ----" in report.messages
+    assert build.run(report) == ["fetch sources"]
+
+
+def test_unchanged_output_stops_reruns(build, report):
+    build.run(report)
+    # The sources changed, but building them gives the same result.
+    build.contents = {"fetch sources": "v2", "build a": "same"}
+    assert build.run(report) == ["fetch sources", "build a", "build b", "package"]
+    build.contents = {"fetch sources": "v3", "build a": "same"}
+    assert build.run(report) == ["fetch sources", "build a"]
+
+
+def test_changed_output_file_reruns_its_stage(build, report):
+    build.run(report)
+    with open(build.output("build a"), "a") as f:
+        f.write("tampered")
+    # Building it again restores what the later stages used.
+    assert build.run(report) == ["fetch sources", "build a"]
+
+    with open(build.output("build a"), "a") as f:
+        f.write("tampered")
+    build.contents["build a"] = "different"
+    assert build.run(report) == ["fetch sources", "build a", "build b", "package"]
+
+
+def test_journal_of_other_specs_or_without_resume_is_ignored(build, report):
+    build.run(report)
+
+    assert build.run(report, key="other specs") == Build.STAGES
+    assert build.run(report, key="other specs", resume=False) == Build.STAGES
+    assert build.run(report, key="other specs") == ["fetch sources"]
@@ -0,0 +1,46 @@
+# Tests of which boards and modules share a Legato build.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import json
+
+import mangoh_release
+import run_bench
+
+
+def make_release(tmp_path, boards, modules):
+    """
+    Get the Release for the benchmark's synthetic spec, in which every other board builds its
+    own Yocto toolchain for each module (from the same Yocto spec), and the others use the same
+    pre-built toolchain package.
+    """
+    spec_file = tmp_path / f"{run_bench.VERSION}.json"
+    spec_file.write_text(json.dumps(run_bench.release_spec(str(tmp_path / "sources"), boards,
+                                                           modules, [])))
+    return mangoh_release.Release(str(spec_file))
+
+
+def test_boards_with_same_toolchain_share_legato_build(tmp_path, build_dir):
+    release = make_release(tmp_path, 4, 2)
+    for module in ["wp70xx", "wp71xx"]:
+        build_dirs = {board: mangoh_release.legato_build_dir(release, board, module)
+                      for board in ["board1", "board2", "board3", "board4"]}
+        # Boards 1 and 3 build the toolchain with Yocto, and 2 and 4 use a pre-built one.
+        assert build_dirs["board1"] == build_dirs["board3"]
+        assert build_dirs["board2"] == build_dirs["board4"]
+        assert build_dirs["board1"] != build_dirs["board2"]
+        assert [mangoh_release.get_legato_board(release, board, module)
+                for board in build_dirs] == ["board1", "board2", "board1", "board2"]
+    assert (mangoh_release.legato_build_dir(release, "board1", "wp70xx")
+            != mangoh_release.legato_build_dir(release, "board1", "wp71xx"))
+
+
+def test_shared_legato_build_is_only_built_once(tmp_path, build_dir):
+    release = make_release(tmp_path, 4, 1)
+    graph = mangoh_release.build_graph([release])
+
+    building = [name for name, (_, _, build_dirs, _) in graph.stages.items()
+                if name.startswith("legato ") and build_dirs]
+    assert building == ["legato board1-wp70xx", "legato board2-wp70xx"]
+    _, depends, _, _ = graph.stages["legato board3-wp70xx"]
+    assert "legato board1-wp70xx" in depends
@@ -0,0 +1,89 @@
+# Tests of staging files and trees into leaf packages without copying them (stage_file() and
+# stage_tree()), and of the fallbacks when the file system can't share the data.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import errno
+
+import pytest
+
+import mangoh_release
+
+
+@pytest.fixture
+def src(tmp_path):
+    """A Legato-like tree with git metadata and checkpoint files in it, which aren't staged."""
+    root = tmp_path / "src"
+    os.makedirs(root / "framework" / "lib")
+    os.makedirs(root / ".git" / "objects")
+    os.makedirs(root / "apps" / ".git")
+    (root / "framework" / "lib" / "liblegato.so").write_bytes(os.urandom(64 * 1024))
+    (root / "bin").mkdir()
+    (root / "bin" / "mksys").write_text("#!/bin/sh\n")
+    os.chmod(root / "bin" / "mksys", 0o755)
+    (root / "version").write_text("19.11.3\n")
+    (root / ".cloned").write_text("key\n")
+    (root / ".git" / "HEAD").write_text("ref: refs/heads/master\n")
+    (root / "apps" / ".git" / "config").write_text("[core]\n")
+    (root / "apps" / "app.adef").write_text("executables: {}\n")
+    os.symlink("framework/lib", root / "lib")
+    os.symlink("../version", root / "bin" / "version")
+    return root
+
+
+def tree_contents(root):
+    """Get a dict describing every file, directory and symbolic link under root."""
+    contents = {}
+    for directory, subdirs, files in os.walk(root):
+        for name in subdirs + files:
+            path = os.path.join(directory, name)
+            relative_path = os.path.relpath(path, root)
+            if os.path.islink(path):
+                contents[relative_path] = ("link", os.readlink(path))
+            elif os.path.isdir(path):
+                contents[relative_path] = ("dir", os.stat(path).st_mode)
+            else:
+                with open(path, "rb") as f:
+                    contents[relative_path] = ("file", os.stat(path).st_mode, f.read())
+    return contents
+
+
+def stage(src, dest, monkeypatch, reflink=True, hardlink=True):
+    """Stage src into dest as the Legato package does, with some staging methods unavailable."""
+    def fail(errno_value):
+        def failing(*args):
+            raise OSError(errno_value, os.strerror(errno_value))
+        return failing
+
+    with monkeypatch.context() as patch:
+        if not reflink:
+            patch.setattr(mangoh_release.fcntl, "ioctl", fail(errno.EOPNOTSUPP))
+        if not hardlink:
+            patch.setattr(mangoh_release.os, "link", fail(errno.EXDEV))
+        return mangoh_release.stage_tree(str(src), str(dest), exclude=[".git", ".cloned"])
+
+
+def test_exclusions_are_skipped(src, tmp_path, monkeypatch):
+    stage(src, tmp_path / "dest", monkeypatch)
+
+    assert sorted(tree_contents(tmp_path / "dest")) == [
+        "apps", "apps/app.adef", "bin", "bin/mksys", "bin/version", "framework",
+        "framework/lib", "framework/lib/liblegato.so", "lib", "version"]
+
+
+def test_hardlink_and_copy_give_same_tree(src, tmp_path, monkeypatch):
+    total_bytes = sum(os.path.getsize(path) for path in [
+        src / "framework" / "lib" / "liblegato.so", src / "bin" / "mksys", src / "version",
+        src / "apps" / "app.adef"])
+
+    linked = stage(src, tmp_path / "linked", monkeypatch, reflink=False)
+    copied = stage(src, tmp_path / "copied", monkeypatch, reflink=False, hardlink=False)
+
+    assert linked == {"reflink": 0, "hardlink": total_bytes, "copy": 0}
+    assert copied == {"reflink": 0, "hardlink": 0, "copy": total_bytes}
+    assert tree_contents(tmp_path / "linked") == tree_contents(tmp_path / "copied")
+    assert os.path.samefile(src / "version", tmp_path / "linked" / "version")
+    assert not os.path.samefile(src / "version", tmp_path / "copied" / "version")
+    assert os.stat(tmp_path / "copied" / "bin" / "mksys").st_mode & 0o777 == 0o755
+
@@ -0,0 +1,71 @@
+# Tests of cleaning what was built in a source tree when it is next built with a different
+# toolchain (invalidate_toolchain_artifacts()), in the tree and all of its submodules.
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import pathlib
+
+import pytest
+
+import mangoh_release
+import run_bench
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch, report):
+    """
+    A clone of a repository with a submodule that has a submodule of its own, with build
+    outputs (untracked files) in all three.
+    """
+    run_bench.write_git_config(f"{tmp_path}/gitconfig", str(tmp_path))
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", f"{tmp_path}/gitconfig")
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.setattr(mangoh_release, "build_report", report)
+    sources = tmp_path / "sources"
+    run_bench.make_git_repo(f"{sources}/inner", {"inner.c": "int inner;\n"})
+    run_bench.make_git_repo(f"{sources}/outer", {"outer.c": "int outer;\n"})
+    run_bench.git("submodule", "add", "-q", f"{sources}/inner", "inner", cwd=f"{sources}/outer")
+    run_bench.git("commit", "-q", "-m", "Add inner", cwd=f"{sources}/outer")
+    run_bench.make_git_repo(f"{sources}/legato", {
+        "Makefile": "clean:\n\trm -f build/legato.o\n", "main.c": "int main;\n"})
+    run_bench.git("submodule", "add", "-q", f"{sources}/outer", "modules/outer",
+                  cwd=f"{sources}/legato")
+    run_bench.git("commit", "-q", "-m", "Add outer", cwd=f"{sources}/legato")
+    root = tmp_path / "legato"
+    run_bench.git("clone", "-q", "--recurse-submodules", f"{sources}/legato", root, cwd=tmp_path)
+    for path in ["build/legato.o", "modules/outer/outer.o", "modules/outer/inner/inner.o",
+                 ".cloned"]:
+        os.makedirs(os.path.dirname(root / path), exist_ok=True)
+        (root / path).write_text("built\n")
+    return root
+
+
+def built_files(root):
+    return sorted(str(path.relative_to(root)) for path in pathlib.Path(root).glob("**/*.o"))
+
+
+def test_cleaned_only_when_toolchain_changes(repo, report):
+    all_built = ["build/legato.o", "modules/outer/inner/inner.o", "modules/outer/outer.o"]
+    # Just cloned, so there's nothing to clean yet.
+    assert not mangoh_release.invalidate_toolchain_artifacts(str(repo), "toolchain1", True)
+    assert not mangoh_release.invalidate_toolchain_artifacts(str(repo), "toolchain1", False)
+    assert built_files(repo) == all_built
+    assert (repo / ".toolchain").read_text() == "toolchain1"
+
+    assert mangoh_release.invalidate_toolchain_artifacts(str(repo), "toolchain2", False)
+
+    assert built_files(repo) == []
+    assert (repo / ".cloned").exists()
+    assert (repo / ".toolchain").read_text() == "toolchain2"
+    # The submodules were found from git's records, and each one was cleaned.
+    assert sorted(command["cwd"] for command in report.commands
+                  if command["command"].startswith("git clean")) == \
+        [str(repo), f"{repo}/modules/outer", f"{repo}/modules/outer/inner"]
+    assert not mangoh_release.invalidate_toolchain_artifacts(str(repo), "toolchain2", False)
+
+
+def test_unknown_toolchain_is_cleaned(repo):
+    # Built before the toolchain was recorded.
+    assert mangoh_release.invalidate_toolchain_artifacts(str(repo), "toolchain1", False)
+    assert built_files(repo) == []
@@ -0,0 +1,92 @@
+# Tests of the Yocto download and shared state caches shared by all the Yocto builds
+# (YoctoCaches), and of reading the shared state hit rate from BitBake's logs (sstate_stats()).
+#
+# Copyright (C) Sierra Wireless Inc.
+
+import os
+import time
+import fcntl
+import pathlib
+
+import pytest
+
+import mangoh_release
+
+
+@pytest.fixture
+def caches(tmp_path):
+    return mangoh_release.YoctoCaches(str(tmp_path / "yocto-cache"), max_size=10**6)
+
+
+def write_file(path, size, age):
+    """Write a file of the given size, last used age seconds ago."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pathlib.Path(path).write_bytes(b"x" * size)
+    used = time.time() - age
+    os.utime(path, (used, used))
+
+
+def test_build_tree_pointed_at_caches(caches, tmp_path):
+    caches.configure(str(tmp_path / "yocto"))
+
+    conf = (tmp_path / "yocto" / "build_bin" / "conf" / "auto.conf").read_text()
+    assert f'DL_DIR = "{caches.download_dir}"\n' in conf
+    assert f'SSTATE_DIR = "{caches.sstate_dir}"\n' in conf
+
+
+def test_prune_removes_least_recently_used_with_companions(caches, tmp_path):
+    downloads = caches.download_dir
+    sstate = caches.sstate_dir
+    write_file(f"{downloads}/old.tar.gz", 400 * 1000, age=400)
+    write_file(f"{downloads}/old.tar.gz.done", 0, age=400)
+    write_file(f"{sstate}/ab/sstate:old:do_compile.tgz", 300 * 1000, age=300)
+    write_file(f"{sstate}/ab/sstate:old:do_compile.tgz.siginfo", 1000, age=300)
+    write_file(f"{downloads}/git2/github.com.old/HEAD", 100, age=200)
+    write_file(f"{downloads}/git2/github.com.old/objects/pack/pack.pack", 300 * 1000, age=200)
+    write_file(f"{downloads}/new.tar.gz", 400 * 1000, age=100)
+    write_file(f"{downloads}/new.tar.gz.done", 0, age=100)
+    write_file(f"{sstate}/cd/sstate:new:do_compile.tgz", 300 * 1000, age=0)
+    write_file(f"{sstate}/cd/sstate:new:do_compile.tgz.siginfo", 1000, age=0)
+
+    caches.prune()
+
+    remaining = sorted(str(path.relative_to(tmp_path / "yocto-cache"))
+                       for path in (tmp_path / "yocto-cache").glob("**/*")
+                       if path.is_file() and path.name != ".lock")
+    assert remaining == ["downloads/new.tar.gz", "downloads/new.tar.gz.done",
+                         "sstate-cache/cd/sstate:new:do_compile.tgz",
+                         "sstate-cache/cd/sstate:new:do_compile.tgz.siginfo"]
+
+
+def test_not_pruned_while_in_use(caches):
+    write_file(f"{caches.download_dir}/old.tar.gz", 2 * 10**6, age=100)
+    with open(caches.lock_file, "a") as lock_file:
+        # Another build is using the caches.
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        with caches.in_use():
+            pass
+        assert os.path.exists(f"{caches.download_dir}/old.tar.gz")
+    with caches.in_use():
+        pass
+    assert not os.path.exists(f"{caches.download_dir}/old.tar.gz")
+
+
+def test_sstate_summaries_parsed(tmp_path):
+    log_dir = tmp_path / "yocto" / "build_bin" / "tmp" / "log" / "cooker" / "swi-mdm9x28-wp"
+    start_time = time.time() - 10
+    os.makedirs(log_dir)
+    # An earlier build's log isn't counted.
+    (log_dir / "20200101000000.log").write_text(
+        "NOTE: Sstate summary: Wanted 5 Local 5 Mirrors 0 Missed 0 Current 0 (100% match)\n")
+    os.utime(log_dir / "20200101000000.log", (start_time - 100, start_time - 100))
+    (log_dir / "20200102000000.log").write_text(
+        "NOTE: Preparing RunQueue\n"
+        "NOTE: Sstate summary: Wanted 1234 Local 1000 Mirrors 4 Missed 230 Current 10"
+        " (81% match, 1% complete)\n"
+        "NOTE: Executing Tasks\n")
+    # Older BitBake versions say "Found", and have no "Mirrors".
+    (log_dir / "20200102000100.log").write_text(
+        "NOTE: Sstate summary: Wanted 100 Found 90 Missed 10 Current 5 (90% match)\n")
+
+    assert mangoh_release.sstate_stats(str(tmp_path / "yocto"), start_time) == {
+        "wanted": 1334, "found": 1094, "missed": 240, "current": 15}